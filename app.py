@@ -1,8 +1,8 @@
-import httpx
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
 from pydantic import BaseModel
 from datetime import datetime, timezone, timedelta
 import json
+import time
 import uuid
 import logging
 import hmac
@@ -12,25 +12,54 @@ from fastapi.middleware.cors import CORSMiddleware
 from py3xui import Client
 import random
 import string
-import asyncpg
+import asyncio
+import breaker
+import campaigns
+import client_index
 import config as cfg
+import invalidation
+import logs
+import payments
+import metrics
+import migrations
+import notifications
+import placement
+import reconcile
+import scheduler
+import sessions
+import user_cache
+from sessions import current_user, ensure_same_user
 from contextlib import asynccontextmanager
-from xui_utils import get_best_panel, get_api_by_name, get_active_subscriptions, extend_subscription, create_sub_panel_subscriptions, \
-    extend_sub_panel_subscriptions
+from xui_utils import get_best_panel, get_active_subscriptions, create_subscription_on_panels, \
+    extend_subscription_on_panels, login_panels, close_panels, panel_status, PANELS, SUB_PANELS
 from database import add_payment_to_db, add_subscription_to_db, update_subscriptions_on_db, create_trial_user, \
-    get_trial_status, get_referrals, apply_referral_bonus_db, add_product_to_db
-from yookassa import Configuration, Payment
+    get_trial_status, get_referrals_page, get_referral_counts, claim_referral_bonus, release_referral_bonus, \
+    referral_exists, add_product_to_db, record_payment_event, \
+    get_payment_status, get_fulfillment, claim_fulfillment, complete_fulfillment, release_fulfillment, unit_of_work, init_pool, \
+    reserve_fulfillment_target, get_payment_owner, enqueue_notifications, metrics_collector, ping, create_campaign, get_campaign, \
+    close_lock_connections
 
 
 
 
 pool = None
 
-Configuration.account_id = cfg.YOOKASSA_SHOP_ID
-Configuration.secret_key = cfg.YOOKASSA_SECRET_KEY
+# Доверять X-Forwarded-For при проверке адреса отправителя уведомлений YooKassa (приложение за прокси).
+# Берётся последний адрес: его добавил наш прокси, остальные передал клиент и может подделать
+WEBHOOK_TRUST_FORWARDED = getattr(cfg, "WEBHOOK_TRUST_FORWARDED", False)
+# Как часто спрашивать YooKassa о платеже, по которому ещё не пришло уведомление
+PAYMENT_POLL_FALLBACK_INTERVAL = getattr(cfg, "PAYMENT_POLL_FALLBACK_INTERVAL", 60)
+# Через сколько секунд незавершённое исполнение платежа (упавший воркер) можно перехватить
+FULFILLMENT_LEASE = getattr(cfg, "FULFILLMENT_LEASE", 300)
+# Сколько /readyz ждёт ответа БД
+READINESS_TIMEOUT = getattr(cfg, "READINESS_TIMEOUT", 2)
+# Размер страницы /api/referrals по умолчанию и наибольший
+REFERRALS_PAGE_SIZE = getattr(cfg, "REFERRALS_PAGE_SIZE", 50)
+REFERRALS_MAX_PAGE_SIZE = getattr(cfg, "REFERRALS_MAX_PAGE_SIZE", 200)
+_gateway_checks = {}
 
 # Настройка логирования
-logging.basicConfig(level=logging.INFO)
+logs.setup_logging()
 logger = logging.getLogger(__name__)
 
 # Настройка CORS
@@ -41,20 +70,34 @@ logger = logging.getLogger(__name__)
 async def lifespan(app: FastAPI):
     # Startup logic
     global pool
-    pool = await asyncpg.create_pool(
-        cfg.DSN,
-        min_size=2,
-        max_size=5,
-        max_inactive_connection_lifetime=300
-    )
+    pool = await init_pool()
     logger.info("Database pool initialized")
+    metrics.register_collector(metrics_collector(pool))
+    await migrations.migrate(pool)
+    await login_panels()
+    index_refresher = asyncio.create_task(client_index.run_refresher(PANELS + SUB_PANELS))
+    load_sampler = asyncio.create_task(placement.run_sampler(PANELS))
+    expiry_scheduler = asyncio.create_task(scheduler.run(pool))
+    notification_worker = asyncio.create_task(notifications.run(pool))
+    campaign_resumer = asyncio.create_task(campaigns.run_resumer(pool))
+    cache_invalidator = asyncio.create_task(invalidation.run(pool))
 
     try:
         yield  # Application runs here
     finally:
         # Shutdown logic
+        index_refresher.cancel()
+        load_sampler.cancel()
+        expiry_scheduler.cancel()
+        notification_worker.cancel()
+        campaign_resumer.cancel()
+        cache_invalidator.cancel()
+        await close_panels()
+        await close_lock_connections()
+        await payments.gateway.close()
         await pool.close()
         logger.info("Database pool closed")
+        logs.stop_logging()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -64,7 +107,10 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
+app.add_middleware(breaker.BudgetMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
 
 def generate_sub(length=16):
     chars = string.ascii_lowercase + string.digits
@@ -76,16 +122,14 @@ def verify_init_data(init_data: str) -> dict:
         if not init_data:
             raise HTTPException(status_code=422, detail="init_data is empty")
         parsed_data = dict(urllib.parse.parse_qsl(init_data))
-        logger.info(f"Parsed init_data: {parsed_data}")
         received_hash = parsed_data.pop('hash', None)
         if not received_hash:
             raise HTTPException(status_code=422, detail="Hash not found")
         data_check_string = '\n'.join(f'{k}={v}' for k, v in sorted(parsed_data.items()))
-        secret_key = hmac.new("WebAppData".encode(), cfg.MAIN_API_TOKEN.encode(), hashlib.sha256).digest()
-        computed_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
-        if computed_hash != received_hash:
+        computed_hash = hmac.new(sessions.WEBAPP_SECRET, data_check_string.encode(), hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(computed_hash, received_hash):
             raise HTTPException(status_code=401, detail="Invalid auth data")
-        user_data = urllib.parse.parse_qs(init_data).get('user', [''])[0]
+        user_data = parsed_data.get('user')
         if not user_data:
             raise HTTPException(status_code=422, detail="User data not found")
         try:
@@ -106,6 +150,32 @@ async def root():
     return {"status": "OK"}
 
 
+@app.get("/healthz")
+async def healthz():
+    """Liveness: процесс жив и обрабатывает запросы"""
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz(response: Response):
+    """Readiness: БД отвечает и доступна хотя бы одна основная панель для новых подписок"""
+    try:
+        await asyncio.wait_for(ping(pool), READINESS_TIMEOUT)
+        database = "ok"
+    except Exception as e:
+        database = f"error: {e!r}"
+    panels = panel_status()
+    ready = database == "ok" and any(panels[panel["name"]] == "ok" for panel in PANELS)
+    if not ready:
+        response.status_code = 503
+    return {"status": "ready" if ready else "not_ready", "database": database, "panels": panels}
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 class AuthData(BaseModel):
     init_data: str
 
@@ -130,6 +200,14 @@ class ApplyReferralBonusData(BaseModel):
     referee_id: int
     email: str | None = None
 
+class CampaignData(BaseModel):
+    days: int
+    description: str | None = None
+    # Продлеваются подписки, действовавшие в этот момент (например, начало сбоя); по умолчанию - сейчас
+    active_at: datetime | None = None
+    panel: str | None = None
+    exclude_trials: bool = True
+
 class CheckPaymentData(BaseModel):
     payment_id: str
 
@@ -143,13 +221,16 @@ class BuyProductData(BaseModel):
 
 @app.post("/api/auth")
 async def auth(data: AuthData):
-    logger.info(f"Received init_data: {data.init_data}")
     try:
         user_data = verify_init_data(data.init_data)
         tg_id = user_data['user']['id']
         first_name = user_data['user'].get('first_name', '')
-        logger.info(f"Authenticated user: {tg_id}")
-        return {"user": {"telegram_id": tg_id, "first_name": first_name}}
+        logger.info("Authenticated user: %s", tg_id, extra={"sample": True})
+        return {
+            "user": {"telegram_id": tg_id, "first_name": first_name},
+            "token": sessions.issue_token(tg_id),
+            "expires_in": sessions.SESSION_TTL
+        }
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -157,11 +238,28 @@ async def auth(data: AuthData):
         raise HTTPException(status_code=500, detail=f"Auth error: {str(e)}")
 
 
+def cached_response(request: Request, response: Response, etag, body):
+    """Ответ с ETag из user_cache: 304, если у клиента то же содержимое, иначе тело; без ETag - просто тело"""
+    if etag is None:
+        return body
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if user_cache.not_modified(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return body
+
+
 @app.get("/api/subscriptions")
-async def get_subscriptions(tg_id: int):
-    logger.info(f"Fetching subscriptions for tg_id: {tg_id}")
+async def get_subscriptions(tg_id: int, request: Request, response: Response, session_tg_id: int = Depends(current_user)):
+    ensure_same_user(session_tg_id, tg_id)
+    cached = user_cache.lookup(user_cache.SUBSCRIPTIONS, tg_id)
+    if cached:
+        return cached_response(request, response, *cached)
+    logger.info("Fetching subscriptions for tg_id: %s", tg_id, extra={"sample": True})
     try:
-        subscriptions = get_active_subscriptions(tg_id)
+        started = user_cache.begin()
+        unavailable = []
+        subscriptions = await get_active_subscriptions(tg_id, unavailable)
         formatted_subscriptions = [
             {
                 "email": sub['email'],
@@ -173,38 +271,67 @@ async def get_subscriptions(tg_id: int):
             }
             for sub in subscriptions
         ]
-        logger.info(f"Subscriptions fetched: {formatted_subscriptions}")
-        return {"subscriptions": formatted_subscriptions}
+        logger.debug("Subscriptions fetched for tg_id %s: %d", tg_id, len(formatted_subscriptions))
+        # Подписки с недоступных панелей в ответ не попали; такой неполный ответ не кэшируется
+        body = {"subscriptions": formatted_subscriptions, "unavailable_panels": unavailable}
+        if unavailable:
+            return body
+        # Ответ меняется сам, когда истекает одна из подписок (is_expired)
+        stale_at = min((sub['expiry_date'].timestamp() for sub in subscriptions if not sub['is_expired']), default=None)
+        etag = user_cache.store(user_cache.SUBSCRIPTIONS, tg_id, started, body, stale_at)
+        return cached_response(request, response, etag, body)
     except Exception as e:
         logger.error(f"Error fetching subscriptions: {e}")
         raise HTTPException(status_code=500, detail=f"Error fetching subscriptions: {str(e)}")
 
 
 @app.get("/api/referrals")
-async def get_referrals_endpoint(tg_id: int):
-    logger.info(f"Fetching referrals for tg_id: {tg_id}")
+async def get_referrals_endpoint(tg_id: int, request: Request, response: Response, after: str | None = None,
+                                 limit: int = REFERRALS_PAGE_SIZE, session_tg_id: int = Depends(current_user)):
+    """Страница рефералов по ключу referee_id: следующая запрашивается с after=next_after"""
+    ensure_same_user(session_tg_id, tg_id)
+    limit = max(1, min(limit, REFERRALS_MAX_PAGE_SIZE))
+    # Кэшируется только первая страница стандартного размера - её мини-приложение запрашивает при каждом открытии
+    cacheable = after is None and limit == REFERRALS_PAGE_SIZE
+    if cacheable:
+        cached = user_cache.lookup(user_cache.REFERRALS, tg_id)
+        if cached:
+            return cached_response(request, response, *cached)
+    logger.info("Fetching referrals for tg_id: %s", tg_id, extra={"sample": True})
     try:
-        referrals = await get_referrals(str(tg_id), pool)
+        started = user_cache.begin()
+        referrals = await get_referrals_page(str(tg_id), after, limit, pool)
+        total, bonused = await get_referral_counts(str(tg_id), pool)
         formatted_referrals = [
             {
                 "referee_id": ref['referee_id'],
                 "bonus_applied": ref['bonus_applied'],
-                "bonus_date": ref['bonus_date'] if ref['bonus_date'] else None
+                "bonus_date": ref['bonus_date'].strftime("%Y-%m-%d %H:%M:%S") if ref['bonus_date'] else None
             }
             for ref in referrals
         ]
-        logger.info(f"Referrals fetched: {formatted_referrals}")
-        return {"referrals": formatted_referrals}
+        logger.debug("Referrals fetched for tg_id %s: %d", tg_id, len(formatted_referrals))
+        body = {
+            "referrals": formatted_referrals,
+            "total": total,
+            "bonused": bonused,
+            "next_after": formatted_referrals[-1]["referee_id"] if len(formatted_referrals) == limit else None
+        }
+        if cacheable:
+            etag = user_cache.store(user_cache.REFERRALS, tg_id, started, body)
+            return cached_response(request, response, etag, body)
+        return body
     except Exception as e:
         logger.error(f"Error fetching referrals: {e}")
         raise HTTPException(status_code=500, detail=f"Error fetching referrals: {str(e)}")
 
 @app.post("/api/buy-product")
-async def buy_product(data: BuyProductData):
+async def buy_product(data: BuyProductData, session_tg_id: int = Depends(current_user)):
+    ensure_same_user(session_tg_id, data.tg_id)
     try:
         amount = data.amount
 
-        payment = Payment.create({
+        payment = await payments.gateway.create({
             "amount": {"value": str(amount), "currency": "RUB"},
             "confirmation": {"type": "redirect", "return_url": "https://your-app.com/payment"},
             "capture": True,
@@ -229,8 +356,9 @@ async def buy_product(data: BuyProductData):
         raise HTTPException(status_code=500, detail="Ошибка при создании оплаты товара")
 
 @app.post("/api/buy-subscription")
-async def buy_subscription(data: BuySubscriptionData):
-    logger.info(f"Creating subscription for tg_id: {data.tg_id}, days: {data.days}")
+async def buy_subscription(data: BuySubscriptionData, session_tg_id: int = Depends(current_user)):
+    ensure_same_user(session_tg_id, data.tg_id)
+    logger.info("Creating subscription for tg_id: %s, days: %s", data.tg_id, data.days)
     try:
         if data.days not in [7, 30, 90, 180, 360]:
             raise HTTPException(status_code=400, detail="Invalid subscription period")
@@ -240,7 +368,7 @@ async def buy_subscription(data: BuySubscriptionData):
         # Вычисляем дату окончания
         expiry_date = datetime.now(timezone.utc) + timedelta(days=data.days)
 
-        payment = Payment.create({
+        payment = await payments.gateway.create({
             "amount": {"value": str(amount), "currency": "RUB"},
             "confirmation": {"type": "redirect", "return_url": "https://your-app.com/payment"},
             "capture": True,
@@ -249,7 +377,7 @@ async def buy_subscription(data: BuySubscriptionData):
         })
 
         payment_id = payment.id
-        logger.info(f"Payment created for tg_id: {data.tg_id}, payment_id: {payment_id}")
+        logger.info("Payment created for tg_id: %s, payment_id: %s", data.tg_id, payment_id)
         return {
             "email": email,
             "payment_url": payment.confirmation.confirmation_url,
@@ -261,12 +389,13 @@ async def buy_subscription(data: BuySubscriptionData):
         raise HTTPException(status_code=500, detail=f"Error creating subscription: {str(e)}")
 
 @app.post("/api/extend-subscription")
-async def extend_subscription_endpoint(data: ExtendSubscriptionData):
-    logger.info(f"Extending subscription for tg_id: {data.tg_id}, email: {data.email}, days: {data.days}")
+async def extend_subscription_endpoint(data: ExtendSubscriptionData, session_tg_id: int = Depends(current_user)):
+    ensure_same_user(session_tg_id, data.tg_id)
+    logger.info("Extending subscription for tg_id: %s, email: %s, days: %s", data.tg_id, data.email, data.days)
     try:
         if data.days not in [7, 30, 90, 180, 360]:
             raise HTTPException(status_code=400, detail="Invalid subscription period")
-        subscriptions = get_active_subscriptions(data.tg_id)
+        subscriptions = await get_active_subscriptions(data.tg_id)
         selected_sub = next((sub for sub in subscriptions if sub['email'] == data.email), None)
         if not selected_sub:
             raise HTTPException(status_code=404, detail="Subscription not found")
@@ -278,7 +407,7 @@ async def extend_subscription_endpoint(data: ExtendSubscriptionData):
         start_date = datetime.now(timezone.utc) if selected_sub['is_expired'] else selected_sub['expiry_date']
         expiry_date = start_date + timedelta(days=data.days)
 
-        payment = Payment.create({
+        payment = await payments.gateway.create({
             "amount": {"value": str(amount), "currency": "RUB"},
             "confirmation": {"type": "redirect", "return_url": "https://your-app.com/payment"},
             "capture": True,
@@ -287,7 +416,7 @@ async def extend_subscription_endpoint(data: ExtendSubscriptionData):
         })
 
         payment_id = payment.id
-        logger.info(f"Payment created for extending subscription: {data.email}, payment_id: {payment_id}")
+        logger.info("Payment created for extending subscription: %s, payment_id: %s", data.email, payment_id)
         return {
             "email": data.email,
             "payment_url": payment.confirmation.confirmation_url,
@@ -298,166 +427,265 @@ async def extend_subscription_endpoint(data: ExtendSubscriptionData):
         logger.error(f"Error extending subscription: {e}")
         raise HTTPException(status_code=500, detail=f"Error extending subscription: {str(e)}")
 
-@app.post("/api/check-payment-status")
-async def check_payment_status(data: CheckPaymentData):
-    try:
-        payment = Payment.find_one(data.payment_id)
-        logger.info(f"Payment status for payment_id: {data.payment_id}: {payment.status}")
-        logger.info(f"Full payment object: {payment.__dict__}")
-        logger.info(f"Full payment object: {payment.metadata['is_extension']}")
-        if payment.status == 'succeeded':
-            metadata = payment.metadata
-            tg_id = int(metadata['tg_id'])
-            days = int(metadata['days'])
-            email = metadata['email']
-            is_extension = metadata['is_extension']
-
-            subscriptions = get_active_subscriptions(tg_id)
-            selected_sub = next((sub for sub in subscriptions if sub['email'] == email), None)
-
-            expiry_time = (datetime.now(timezone.utc) + timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
-
-            logger.info(f"Selected_sub: {selected_sub}")
-            logger.info(f"is_extension: {is_extension}")
-
-            if is_extension and selected_sub:
-                # Продление подписки
-                api = get_api_by_name(selected_sub['panel'])
-                client_found = False
-                inbounds = api.inbound.get_list()
-                for inbound in inbounds:
-                    for client in inbound.settings.clients:
-                        if client.email == email and client.tg_id == tg_id:
-                            extend_subscription(client.email, client.id, days, tg_id, client.sub_id, api)
-                            extend_sub_panel_subscriptions(client.email, days, tg_id, client.sub_id)
-                            new_expiry = (datetime.now(timezone.utc) if selected_sub['is_expired'] else selected_sub['expiry_date']) + timedelta(days=days)
-                            expiry_time = new_expiry.strftime("%Y-%m-%d %H:%M:%S")
-                            await update_subscriptions_on_db(str(tg_id), email, selected_sub['panel'], expiry_time, pool)
-                            await add_payment_to_db(str(tg_id), payment.id, 'Продление', expiry_time, payment.amount.value, email, pool)
-                            client_found = True
-                            break
-                    if client_found:
-                        break
-                if not client_found:
-                    raise HTTPException(status_code=404, detail="Client not found")
-            else:
-                # Новая подписка
-                if selected_sub:
-                    raise HTTPException(status_code=400, detail="Subscription with this email already exists")
-                current_panel = get_best_panel()
-                if not current_panel:
-                    raise HTTPException(status_code=500, detail="No available panels")
-                subscription_id = generate_sub(16)
-                expiry = int(datetime.strptime(expiry_time, "%Y-%m-%d %H:%M:%S").timestamp() * 1000)
-                new_client = Client(
-                    id=str(uuid.uuid4()),
-                    enable=True,
-                    tg_id=int(tg_id),
-                    expiry_time=expiry,
-                    flow="xtls-rprx-vision",
-                    email=email,
-                    sub_id=subscription_id,
-                    limit_ip=5
-                )
-                api = get_api_by_name(current_panel['name'])
-                api.client.add(1, [new_client])
-                create_sub_panel_subscriptions(email, int(tg_id), subscription_id, expiry)
-
-                await add_subscription_to_db(str(tg_id), email, current_panel['name'], expiry_time, pool)
-                await add_payment_to_db(str(tg_id), payment.id, 'Покупка', expiry_time, payment.amount.value, email, pool)
+async def fulfill_subscription_payment(payment):
+    """Выдача или продление подписки по оплаченному платежу; записи в БД и отметка об исполнении - одной транзакцией"""
+    metadata = payment.metadata
+    tg_id = int(metadata['tg_id'])
+    days = int(metadata['days'])
+    email = metadata['email']
+    is_extension = metadata['is_extension']
+
+    unavailable = []
+    subscriptions = await get_active_subscriptions(tg_id, unavailable)
+    if unavailable:
+        # По неполному списку продление превратилось бы в новую подписку; исполнение повторится позже
+        raise HTTPException(status_code=503, detail=f"Panels unavailable: {', '.join(unavailable)}")
+    selected_sub = next((sub for sub in subscriptions if sub['email'] == email), None)
+
+    logger.debug("Fulfilling %s: is_extension=%s, subscription found=%s", email, is_extension, selected_sub is not None)
+
+    if is_extension and selected_sub:
+        # Продление подписки
+        expiry_date = (datetime.now(timezone.utc) if selected_sub['is_expired'] else selected_sub['expiry_date']) + timedelta(days=days)
+        expiry_date = await reserve_fulfillment_target(payment.id, expiry_date, pool)
+        outcome = await extend_subscription_on_panels(
+            selected_sub['panel'], email, int(expiry_date.timestamp() * 1000), tg_id, selected_sub['sub_id'], pool
+        )
+        logger.info("Extension outcome for %s: %s", email, outcome)
+        if not outcome[selected_sub['panel']]:
+            raise HTTPException(status_code=500, detail="Failed to extend subscription on panel")
+        result = {"status": "succeeded", "days": days, "expiry_date": expiry_date.strftime("%Y-%m-%d %H:%M:%S")}
+        async with unit_of_work(pool) as conn:
+            await update_subscriptions_on_db(str(tg_id), email, selected_sub['panel'], expiry_date, conn)
+            await add_payment_to_db(str(tg_id), payment.id, 'Продление', expiry_date, payment.amount.value, email, conn)
+            await complete_fulfillment(payment.id, result, conn)
+    else:
+        # Новая подписка
+        expiry_date = await reserve_fulfillment_target(payment.id, datetime.now(timezone.utc) + timedelta(days=days), pool)
+        if selected_sub:
+            if abs((selected_sub['expiry_date'] - expiry_date).total_seconds()) >= 1:
+                raise HTTPException(status_code=400, detail="Subscription with this email already exists")
+            # Клиент создан прошлой попыткой этого платежа, не дошедшей до записи в БД
+            result = {"status": "succeeded", "days": days, "expiry_date": expiry_date.strftime("%Y-%m-%d %H:%M:%S")}
+            async with unit_of_work(pool) as conn:
+                await add_subscription_to_db(str(tg_id), email, selected_sub['panel'], expiry_date, conn)
+                await add_payment_to_db(str(tg_id), payment.id, 'Покупка', expiry_date, payment.amount.value, email, conn)
+                await complete_fulfillment(payment.id, result, conn)
+            return result
+        current_panel = get_best_panel()
+        if not current_panel:
+            raise HTTPException(status_code=500, detail="No available panels")
+        subscription_id = generate_sub(16)
+        expiry = int(expiry_date.timestamp() * 1000)
+        new_client = Client(
+            id=str(uuid.uuid4()),
+            enable=True,
+            tg_id=int(tg_id),
+            expiry_time=expiry,
+            flow="xtls-rprx-vision",
+            email=email,
+            sub_id=subscription_id,
+            limit_ip=5
+        )
+        outcome = await create_subscription_on_panels(current_panel, 1, new_client, pool)
+        logger.info("Provisioning outcome for %s: %s", email, outcome)
+        if not outcome[current_panel['name']]:
+            raise HTTPException(status_code=500, detail="Failed to create subscription on panel")
 
-            return {
-                "status": payment.status,
-                "days": days,
-                "expiry_date": expiry_time
-            }
-        else:
-            return {"status": payment.status}
-    except Exception as e:
-        logger.error(f"Error checking payment status: {e}")
-        raise HTTPException(status_code=500, detail=f"Error checking payment status: {str(e)}")
+        result = {"status": "succeeded", "days": days, "expiry_date": expiry_date.strftime("%Y-%m-%d %H:%M:%S")}
+        async with unit_of_work(pool) as conn:
+            await add_subscription_to_db(str(tg_id), email, current_panel['name'], expiry_date, conn)
+            await add_payment_to_db(str(tg_id), payment.id, 'Покупка', expiry_date, payment.amount.value, email, conn)
+            await complete_fulfillment(payment.id, result, conn)
 
-@app.post("/api/check-product-payment")
-async def check_product_payment(data: CheckPaymentData):
-    try:
-        payment = Payment.find_one(data.payment_id)
-        logger.info(f"[Product] Payment status for {data.payment_id}: {payment.status}")
+    return result
 
-        if payment.status != 'succeeded':
-            return {"status": payment.status}
 
-        metadata = getattr(payment, "metadata", None)
-        if not metadata or not metadata.get("is_product"):
-            logger.error(f"[Product] Metadata missing or invalid for payment {payment.id}")
-            raise HTTPException(status_code=500, detail="Invalid or missing metadata")
+async def fulfill_product_payment(payment):
+    """Исполнение оплаченного заказа товара; записи в БД и отметка об исполнении - одной транзакцией"""
+    metadata = getattr(payment, "metadata", None)
+    if not metadata or not metadata.get("is_product"):
+        logger.error(f"[Product] Metadata missing or invalid for payment {payment.id}")
+        raise HTTPException(status_code=500, detail="Invalid or missing metadata")
 
+    message = (
+        f"✅ Оплачен товар:\n"
+        f"Telegram ID: {metadata['tg_id']}\n"
+        f"Товар: {metadata['product']}\n"
+        f"Логин: {metadata['login']}\n"
+        f"Пароль: {metadata['password']}"
+    )
+
+    result = {
+        "status": "succeeded",
+        "product": metadata['product']
+    }
+    async with unit_of_work(pool) as conn:
         await add_product_to_db(
-            tg_id=metadata['tg_id'],
+            tg_id=str(metadata['tg_id']),
             product=metadata['product'],
             login=metadata['login'],
             days=int(metadata['days']),
-            pool=pool
+            pool=conn
         )
-
-        message = (
-            f"✅ Оплачен товар:\n"
-            f"Telegram ID: {metadata['tg_id']}\n"
-            f"Товар: {metadata['product']}\n"
-            f"Логин: {metadata['login']}\n"
-            f"Пароль: {metadata['password']}"
-        )
-
-        async with httpx.AsyncClient() as client:
-            await client.post(
-                f"https://api.telegram.org/bot{cfg.ORDER_BOT_TOKEN}/sendMessage",
-                json={"chat_id": cfg.ADMIN_TOKEN_1, "text": message},
-            )
-            await client.post(
-                f"https://api.telegram.org/bot{cfg.ORDER_BOT_TOKEN}/sendMessage",
-                json={"chat_id": cfg.ADMIN_TOKEN_2, "text": message},
-            )
-
-
-
         await add_payment_to_db(
             str(metadata['tg_id']),
             payment.id,
             metadata['product'],
-            datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+            datetime.now(timezone.utc),
             payment.amount.value,
             metadata['login'],
-            pool
+            conn
         )
+        await enqueue_notifications("order", [cfg.ADMIN_TOKEN_1, cfg.ADMIN_TOKEN_2], [message, message], conn)
+        await complete_fulfillment(payment.id, result, conn)
+    notifications.wake()
 
-        return {
-            "status": "succeeded",
-            "product": metadata['product']
-        }
+    return result
 
+
+async def fulfill_payment(payment):
+    """Однократное исполнение оплаченного заказа на всех воркерах.
+
+    Повторные вызовы получают записанный результат; None - заказ сейчас исполняет другой запрос."""
+    is_product = bool(payment.metadata.get("is_product"))
+    if not await claim_fulfillment(payment.id, "product" if is_product else "subscription", FULFILLMENT_LEASE, pool):
+        fulfillment = await get_fulfillment(payment.id, pool)
+        return fulfillment['result'] if fulfillment and fulfillment['status'] == 'done' else None
+    try:
+        if is_product:
+            result = await fulfill_product_payment(payment)
+        else:
+            result = await fulfill_subscription_payment(payment)
+    except Exception:
+        await release_fulfillment(payment.id, pool)
+        raise
+    return result
+
+
+async def process_payment(payment):
+    """Запись итогового статуса платежа и исполнение заказа; возвращает результат исполнения"""
+    await record_payment_event(payment.id, f"payment.{payment.status}", payment.status, payment.audit_payload(), pool)
+    if payment.status == 'succeeded':
+        return await fulfill_payment(payment)
+    return None
+
+
+def gateway_check_due(payment_id):
+    """Можно ли сейчас спросить YooKassa о платеже, по которому ещё нет уведомления"""
+    now = time.monotonic()
+    if now - _gateway_checks.get(payment_id, float("-inf")) < PAYMENT_POLL_FALLBACK_INTERVAL:
+        return False
+    _gateway_checks[payment_id] = now
+    if len(_gateway_checks) > 10000:
+        for key, checked_at in list(_gateway_checks.items()):
+            if now - checked_at >= PAYMENT_POLL_FALLBACK_INTERVAL:
+                del _gateway_checks[key]
+    return True
+
+
+async def get_local_payment_state(payment_id, tg_id):
+    """Состояние платежа из журнала исполнения и событий; в YooKassa идём, только если уведомление задерживается.
+    Платёж другого пользователя - 403: результат исполнения содержит выданную подписку"""
+    owner = await get_payment_owner(payment_id, pool)
+    if owner is not None and owner != str(tg_id):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    fulfillment = await get_fulfillment(payment_id, pool)
+    if fulfillment and fulfillment['status'] == 'done':
+        return {"status": "succeeded", "result": fulfillment['result']}
+    status = 'succeeded' if fulfillment else await get_payment_status(payment_id, pool)
+    # Уведомления ещё нет, либо оплата прошла, но исполнение не завершено и его, возможно, нужно перехватить
+    if status in (None, 'succeeded') and gateway_check_due(payment_id):
+        payment = await payments.gateway.find_one(payment_id)
+        if str(payment.metadata.get('tg_id')) != str(tg_id):
+            raise HTTPException(status_code=403, detail="Forbidden")
+        if payment.status in ('succeeded', 'canceled'):
+            return {"status": payment.status, "result": await process_payment(payment)}
+        return {"status": payment.status, "result": None}
+    return {"status": status or "pending", "result": None}
+
+
+@app.post("/api/yookassa-webhook")
+async def yookassa_webhook(request: Request):
+    address = request.client.host if request.client else ""
+    if WEBHOOK_TRUST_FORWARDED and request.headers.get("x-forwarded-for"):
+        address = request.headers["x-forwarded-for"].split(",")[-1].strip()
+    if not payments.is_yookassa_address(address):
+        logger.warning(f"Rejected YooKassa notification from {address}")
+        raise HTTPException(status_code=403, detail="Forbidden")
+    try:
+        notification = await request.json()
+        event = notification.get("event")
+        payment_id = (notification.get("object") or {}).get("id")
+        if event not in ("payment.succeeded", "payment.canceled") or not payment_id:
+            return {"status": "ignored"}
+        # Статус берём из API YooKassa, а не из тела уведомления
+        payment = await payments.gateway.find_one(payment_id)
+        if f"payment.{payment.status}" != event:
+            logger.warning(f"Notification {event} for {payment_id} does not match status {payment.status}")
+            return {"status": "ignored"}
+        await process_payment(payment)
+        logger.info("YooKassa notification processed: %s %s", event, payment_id)
+        return {"status": "ok"}
+    except Exception as e:
+        logger.error(f"Error processing YooKassa notification: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="Error processing notification")
+
+
+@app.post("/api/check-payment-status")
+async def check_payment_status(data: CheckPaymentData, session_tg_id: int = Depends(current_user)):
+    try:
+        state = await get_local_payment_state(data.payment_id, session_tg_id)
+        logger.info("Payment status for payment_id: %s: %s", data.payment_id, state['status'], extra={"sample": True})
+        if state['status'] == 'succeeded':
+            # Пока заказ исполняется, клиент продолжает опрос
+            return state['result'] or {"status": "pending"}
+        return {"status": state['status']}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error checking payment status: {e}")
+        raise HTTPException(status_code=500, detail=f"Error checking payment status: {str(e)}")
+
+@app.post("/api/check-product-payment")
+async def check_product_payment(data: CheckPaymentData, session_tg_id: int = Depends(current_user)):
+    try:
+        state = await get_local_payment_state(data.payment_id, session_tg_id)
+        logger.info("[Product] Payment status for %s: %s", data.payment_id, state['status'], extra={"sample": True})
+        if state['status'] == 'succeeded':
+            return state['result'] or {"status": "pending"}
+        return {"status": state['status']}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"[Product] Error checking payment: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Ошибка при проверке оплаты товара")
 
 @app.post("/api/cancel-payment")
-async def cancel_payment(data: CheckPaymentData):
+async def cancel_payment(data: CheckPaymentData, session_tg_id: int = Depends(current_user)):
     try:
-        payment = Payment.find_one(data.payment_id)
-        logger.info(f"Cancelling payment for payment_id: {data.payment_id}, current status: {payment.status}")
+        payment = await payments.gateway.find_one(data.payment_id)
+        if str(payment.metadata.get('tg_id')) != str(session_tg_id):
+            raise HTTPException(status_code=403, detail="Forbidden")
+        logger.info("Cancelling payment for payment_id: %s, current status: %s", data.payment_id, payment.status)
         if payment.status == 'pending':
-            Payment.cancel(data.payment_id)
-            logger.info(f"Payment {data.payment_id} cancelled successfully")
+            await payments.gateway.cancel(data.payment_id)
+            logger.info("Payment %s cancelled successfully", data.payment_id)
             return {"status": "cancelled"}
         else:
             logger.warning(f"Cannot cancel payment {data.payment_id}, status: {payment.status}")
             return {"status": payment.status}
+    except HTTPException as e:
+        raise e
     except Exception as e:
         logger.error(f"Error cancelling payment: {e}")
         raise HTTPException(status_code=500, detail=f"Error cancelling payment: {str(e)}")
 
 
 @app.post("/api/activate-trial")
-async def activate_trial(data: TrialSubscriptionData):
-    logger.info(f"Activating trial subscription for tg_id: {data.tg_id}")
+async def activate_trial(data: TrialSubscriptionData, session_tg_id: int = Depends(current_user)):
+    ensure_same_user(session_tg_id, data.tg_id)
+    logger.info("Activating trial subscription for tg_id: %s", data.tg_id)
     try:
         trial_status = await get_trial_status(str(data.tg_id), pool)
         if trial_status == 1:
@@ -467,8 +695,9 @@ async def activate_trial(data: TrialSubscriptionData):
         if not current_panel:
             raise HTTPException(status_code=500, detail="No available panels")
         subscription_id = generate_sub(16)
-        expiry_time = (datetime.now(timezone.utc) + timedelta(days=3)).strftime("%Y-%m-%d %H:%M:%S")
-        expiry = int(datetime.strptime(expiry_time, "%Y-%m-%d %H:%M:%S").timestamp() * 1000)
+        expiry_date = datetime.now(timezone.utc) + timedelta(days=3)
+        expiry_time = expiry_date.strftime("%Y-%m-%d %H:%M:%S")
+        expiry = int(expiry_date.timestamp() * 1000)
         new_client = Client(
             id=str(uuid.uuid4()),
             enable=True,
@@ -479,13 +708,15 @@ async def activate_trial(data: TrialSubscriptionData):
             sub_id=subscription_id,
             limit_ip=5
         )
-        api = get_api_by_name(current_panel['name'])
-        api.client.add(1, [new_client])
-        create_sub_panel_subscriptions(email, int(data.tg_id), subscription_id, expiry)
-        await add_subscription_to_db(str(data.tg_id), email, current_panel['name'], expiry_time, pool)
-        await create_trial_user(str(data.tg_id), pool)
+        outcome = await create_subscription_on_panels(current_panel, 1, new_client, pool)
+        logger.info("Provisioning outcome for %s: %s", email, outcome)
+        if not outcome[current_panel['name']]:
+            raise HTTPException(status_code=500, detail="Failed to create subscription on panel")
+        async with unit_of_work(pool) as conn:
+            await add_subscription_to_db(str(data.tg_id), email, current_panel['name'], expiry_date, conn)
+            await create_trial_user(str(data.tg_id), conn)
         subscription_key = current_panel["create_key"](new_client)
-        logger.info(f"Trial subscription created for tg_id: {data.tg_id}, email: {email}")
+        logger.info("Trial subscription created for tg_id: %s, email: %s", data.tg_id, email)
         return {
             "email": email,
             "panel": current_panel['name'],
@@ -500,7 +731,8 @@ async def activate_trial(data: TrialSubscriptionData):
         raise HTTPException(status_code=500, detail=f"Error creating trial subscription: {str(e)}")
 
 @app.post("/api/submit-order")
-async def submit_order(order: dict):
+async def submit_order(order: dict, session_tg_id: int = Depends(current_user)):
+    ensure_same_user(session_tg_id, order.get('telegram_id') or 0)
     if not order.get('login') or not order.get('password'):
         raise HTTPException(status_code=400, detail="Login and password cannot be empty")
 
@@ -514,52 +746,62 @@ async def submit_order(order: dict):
 
     product = order['product'].split(" ")[0]
 
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(
-                f"https://api.telegram.org/bot{cfg.ORDER_BOT_TOKEN}/sendMessage",
-                json={
-                    "chat_id": cfg.ADMIN_TOKEN_1,
-                    "text": message,
-                },
-            )
-
-            await add_product_to_db(str(order['telegram_id']), product, order['login'], order['days'], pool)
-
-            if response.status_code != 200:
-                raise HTTPException(status_code=500, detail="Failed to send message to Telegram")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error sending message: {str(e)}")
+    try:
+        async with unit_of_work(pool) as conn:
+            await add_product_to_db(str(order['telegram_id']), product, order['login'], order['days'], conn)
+            await enqueue_notifications("order", [cfg.ADMIN_TOKEN_1], [message], conn)
+        notifications.wake()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error submitting order: {str(e)}")
 
     return {"status": "Order submitted successfully"}
 
 
 @app.post("/api/apply-referral-bonus")
-async def apply_referral_bonus(data: ApplyReferralBonusData):
-    logger.info(f"Applying referral bonus for tg_id: {data.tg_id}, referee_id: {data.referee_id}, email: {data.email}")
+async def apply_referral_bonus(data: ApplyReferralBonusData, session_tg_id: int = Depends(current_user)):
+    ensure_same_user(session_tg_id, data.tg_id)
+    logger.info("Applying referral bonus for tg_id: %s, referee_id: %s, email: %s",
+                data.tg_id, data.referee_id, data.email)
+    referrer_id, referee_id = str(data.tg_id), str(data.referee_id)
+    claimed_at = None
+    granted = False
     try:
-        referrals = await get_referrals(str(data.tg_id), pool)
-        logger.info(f"Referrals for tg_id {data.tg_id}: {referrals}")
-        referral = next((ref for ref in referrals if ref['referee_id'] == str(data.referee_id)), None)
-        if not referral:
-            logger.error(f"Referral not found for tg_id: {data.tg_id}, referee_id: {data.referee_id}")
-            raise HTTPException(status_code=404, detail="Referral not found")
-        if referral['bonus_applied']:
-            raise HTTPException(status_code=400, detail="Bonus already applied")
-
-        subscriptions = get_active_subscriptions(data.tg_id)
+        unavailable = []
+        subscriptions = await get_active_subscriptions(data.tg_id, unavailable)
+        if unavailable:
+            raise HTTPException(status_code=503, detail=f"Panels unavailable: {', '.join(unavailable)}")
         non_trial_subs = [sub for sub in subscriptions if not sub['email'].startswith("DE-FRA-TRIAL-")]
-        logger.info(f"Non-trial subscriptions: {non_trial_subs}")
+        logger.debug("Non-trial subscriptions for tg_id %s: %d", data.tg_id, len(non_trial_subs))
+        selected_sub = None
+        if len(non_trial_subs) == 1:
+            # Условие 2: Автоматически продлить единственную подписку на 7 дней
+            selected_sub = non_trial_subs[0]
+        elif len(non_trial_subs) > 1:
+            # Условие 3: Требуется выбор подписки
+            if not data.email:
+                raise HTTPException(status_code=400, detail="Email required for extension")
+            selected_sub = next((sub for sub in non_trial_subs if sub['email'] == data.email), None)
+            if not selected_sub:
+                raise HTTPException(status_code=404, detail="Subscription not found")
+
+        # Бонус отмечается до работы с панелями: параллельный запрос получит отказ, а не второй бонус
+        claimed_at = await claim_referral_bonus(referrer_id, referee_id, pool)
+        if claimed_at is None:
+            if not await referral_exists(referrer_id, referee_id, pool):
+                logger.error(f"Referral not found for tg_id: {data.tg_id}, referee_id: {data.referee_id}")
+                raise HTTPException(status_code=404, detail="Referral not found")
+            raise HTTPException(status_code=400, detail="Bonus already applied")
 
-        if len(non_trial_subs) == 0:
+        if selected_sub is None:
             # Условие 1: Создать новую подписку на 7 дней
             email = f"DE-FRA-USER-{data.tg_id}-{uuid.uuid4().hex[:6]}"
             current_panel = get_best_panel()
             if not current_panel:
                 raise HTTPException(status_code=500, detail="No available panels")
             subscription_id = generate_sub(16)
-            expiry_time = (datetime.now(timezone.utc) + timedelta(days=7)).strftime("%Y-%m-%d %H:%M:%S")
-            expiry = int(datetime.strptime(expiry_time, "%Y-%m-%d %H:%M:%S").timestamp() * 1000)
+            expiry_date = datetime.now(timezone.utc) + timedelta(days=7)
+            expiry_time = expiry_date.strftime("%Y-%m-%d %H:%M:%S")
+            expiry = int(expiry_date.timestamp() * 1000)
             new_client = Client(
                 id=str(uuid.uuid4()),
                 enable=True,
@@ -570,14 +812,17 @@ async def apply_referral_bonus(data: ApplyReferralBonusData):
                 sub_id=subscription_id,
                 limit_ip=5
             )
-            api = get_api_by_name(current_panel['name'])
-            api.client.add(1, [new_client])
-            create_sub_panel_subscriptions(email, int(data.tg_id), subscription_id, expiry)
-            await add_subscription_to_db(str(data.tg_id), email, current_panel['name'], expiry_time, pool)
-            await add_payment_to_db(str(data.tg_id), "REFERRAL_BONUS", 'Реферальный бонус', expiry_time, 0, email, pool)
+            outcome = await create_subscription_on_panels(current_panel, 1, new_client, pool)
+            logger.info("Provisioning outcome for %s: %s", email, outcome)
+            if not outcome[current_panel['name']]:
+                raise HTTPException(status_code=500, detail="Failed to create subscription on panel")
+            granted = True
+            async with unit_of_work(pool) as conn:
+                await add_subscription_to_db(referrer_id, email, current_panel['name'], expiry_date, conn)
+                await add_payment_to_db(referrer_id, "REFERRAL_BONUS", 'Реферальный бонус', expiry_date, 0, email, conn)
+            user_cache.bump(data.tg_id, user_cache.REFERRALS)
             subscription_key = current_panel["create_key"](new_client)
-            await apply_referral_bonus_db(str(data.tg_id), str(data.referee_id), pool)
-            logger.info(f"Referral bonus created subscription for tg_id: {data.tg_id}, email: {email}")
+            logger.info("Referral bonus created subscription for tg_id: %s, email: %s", data.tg_id, email)
             return {
                 "email": email,
                 "panel": current_panel['name'],
@@ -585,68 +830,88 @@ async def apply_referral_bonus(data: ApplyReferralBonusData):
                 "expiry_date": expiry_time,
                 "days": 7
             }
-        elif len(non_trial_subs) == 1:
-            # Условие 2: Автоматически продлить единственную подписку на 7 дней
-            selected_sub = non_trial_subs[0]
-            selected_email = selected_sub['email']
-            api = get_api_by_name(selected_sub['panel'])
-            client_found = False
-            inbounds = api.inbound.get_list()
-            for inbound in inbounds:
-                for client in inbound.settings.clients:
-                    if client.email == selected_email and client.tg_id == data.tg_id:
-                        extend_subscription(client.email, client.id, 7, data.tg_id, client.sub_id, api)
-                        extend_sub_panel_subscriptions(client.email, 7, int(data.tg_id), client.sub_id)
-                        new_expiry = (datetime.now(timezone.utc) if selected_sub['is_expired'] else selected_sub['expiry_date']) + timedelta(days=7)
-                        expiry_time = new_expiry.strftime("%Y-%m-%d %H:%M:%S")
-                        await update_subscriptions_on_db(str(client.tg_id), selected_email, selected_sub['panel'], expiry_time, pool)
-                        client_found = True
-                        break
-                if client_found:
-                    break
-            if not client_found:
-                raise HTTPException(status_code=404, detail="Client not found")
-            await apply_referral_bonus_db(str(data.tg_id), str(data.referee_id), pool)
-            logger.info(f"Referral bonus extended subscription for tg_id: {data.tg_id}, email: {selected_email}, new_expiry: {expiry_time}")
-            return {
-                "email": selected_email,
-                "panel": selected_sub['panel'],
-                "expiry_date": expiry_time,
-                "days": 7
-            }
-        else:
-            # Условие 3: Требуется выбор подписки
-            selected_email = data.email
-            if not selected_email:
-                raise HTTPException(status_code=400, detail="Email required for extension")
-            selected_sub = next((sub for sub in non_trial_subs if sub['email'] == selected_email), None)
-            if not selected_sub:
-                raise HTTPException(status_code=404, detail="Subscription not found")
-            api = get_api_by_name(selected_sub['panel'])
-            client_found = False
-            inbounds = api.inbound.get_list()
-            for inbound in inbounds:
-                for client in inbound.settings.clients:
-                    if client.email == selected_email and client.tg_id == data.tg_id:
-                        extend_subscription(client.email, client.id, 7, data.tg_id, client.sub_id, api)
-                        extend_sub_panel_subscriptions(client.email, 7, int(data.tg_id), client.sub_id)
-                        new_expiry = (datetime.now(timezone.utc) if selected_sub['is_expired'] else selected_sub['expiry_date']) + timedelta(days=7)
-                        expiry_time = new_expiry.strftime("%Y-%m-%d %H:%M:%S")
-                        await update_subscriptions_on_db(str(client.tg_id), selected_email, selected_sub['panel'], expiry_time, pool)
-                        client_found = True
-                        break
-                if client_found:
-                    break
-            if not client_found:
-                raise HTTPException(status_code=404, detail="Client not found")
-            await apply_referral_bonus_db(str(data.tg_id), str(data.referee_id), pool)
-            logger.info(f"Referral bonus extended subscription for tg_id: {data.tg_id}, email: {selected_email}, new_expiry: {expiry_time}")
-            return {
-                "email": selected_email,
-                "panel": selected_sub['panel'],
-                "expiry_date": expiry_time,
-                "days": 7
-            }
+
+        selected_email = selected_sub['email']
+        new_expiry = (datetime.now(timezone.utc) if selected_sub['is_expired'] else selected_sub['expiry_date']) + timedelta(days=7)
+        outcome = await extend_subscription_on_panels(
+            selected_sub['panel'], selected_email, int(new_expiry.timestamp() * 1000), data.tg_id, selected_sub['sub_id'], pool
+        )
+        logger.info("Extension outcome for %s: %s", selected_email, outcome)
+        if not outcome[selected_sub['panel']]:
+            raise HTTPException(status_code=500, detail="Failed to extend subscription on panel")
+        granted = True
+        expiry_time = new_expiry.strftime("%Y-%m-%d %H:%M:%S")
+        await update_subscriptions_on_db(referrer_id, selected_email, selected_sub['panel'], new_expiry, pool)
+        user_cache.bump(data.tg_id, user_cache.REFERRALS)
+        logger.info("Referral bonus extended subscription for tg_id: %s, email: %s, new_expiry: %s",
+                    data.tg_id, selected_email, expiry_time)
+        return {
+            "email": selected_email,
+            "panel": selected_sub['panel'],
+            "expiry_date": expiry_time,
+            "days": 7
+        }
     except Exception as e:
+        # Если на панели ничего не выдано, отметку снимаем, чтобы бонус можно было получить повторно
+        if claimed_at is not None and not granted:
+            await release_referral_bonus(referrer_id, referee_id, claimed_at, pool)
+        if isinstance(e, HTTPException):
+            raise
         logger.error(f"Error applying referral bonus: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Error applying referral bonus: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Error applying referral bonus: {str(e)}")
+
+
+@app.post("/api/admin/reconcile")
+async def reconcile_endpoint(repair: bool = False, _: None = Depends(sessions.admin_key)):
+    if reconcile.is_running():
+        raise HTTPException(status_code=409, detail="Reconciliation is already running")
+    logger.info(f"Reconciliation requested, repair={repair}")
+    # Сверка обходит все панели и не укладывается в бюджет HTTP-запроса
+    return await breaker.detached(reconcile.run(pool, repair=repair))
+
+
+def format_campaign(row):
+    return {
+        "id": row['id'],
+        "description": row['description'],
+        "days": row['days'],
+        "status": row['status'],
+        "created_at": row['created_at'].strftime("%Y-%m-%d %H:%M:%S"),
+        "finished_at": row['finished_at'].strftime("%Y-%m-%d %H:%M:%S") if row['finished_at'] else None,
+        "total": row['total'],
+        "done": row['done'],
+        "failed": row['failed'],
+    }
+
+
+@app.post("/api/admin/campaigns")
+async def create_campaign_endpoint(data: CampaignData, _: None = Depends(sessions.admin_key)):
+    if data.days <= 0:
+        raise HTTPException(status_code=422, detail="days must be positive")
+    active_at = data.active_at or datetime.now(timezone.utc)
+    if active_at.tzinfo is None:
+        active_at = active_at.replace(tzinfo=timezone.utc)
+    campaign_id, count = await create_campaign(data.description, data.days, active_at, data.panel, data.exclude_trials, pool)
+    logger.info(f"Campaign {campaign_id} created: +{data.days} days for {count} subscriptions")
+    campaigns.start(campaign_id, pool)
+    return {"id": campaign_id, "subscriptions": count}
+
+
+@app.get("/api/admin/campaigns/{campaign_id}")
+async def get_campaign_endpoint(campaign_id: int, _: None = Depends(sessions.admin_key)):
+    row = await get_campaign(campaign_id, pool)
+    if not row:
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    return format_campaign(row)
+
+
+@app.post("/api/admin/campaigns/{campaign_id}/resume")
+async def resume_campaign_endpoint(campaign_id: int, _: None = Depends(sessions.admin_key)):
+    """Повтор подписок, которые не удалось продлить"""
+    row = await get_campaign(campaign_id, pool)
+    if not row:
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    if row['status'] == 'finished':
+        raise HTTPException(status_code=409, detail="Campaign is already finished")
+    campaigns.start(campaign_id, pool)
+    return {"id": campaign_id, "status": "started"}
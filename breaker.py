@@ -0,0 +1,165 @@
+"""Автомат отключения недоступных панелей и общий бюджет времени HTTP-запроса на запросы к панелям"""
+import asyncio
+import contextvars
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import config as cfg
+import metrics
+
+# Окно, по которому считается доля неудачных запросов, секунды
+BREAKER_WINDOW = getattr(cfg, "BREAKER_WINDOW", 60)
+# Меньше запросов в окне - слишком мало данных, автомат не срабатывает
+BREAKER_MIN_CALLS = getattr(cfg, "BREAKER_MIN_CALLS", 5)
+# Доля неудачных запросов в окне, при которой панель отключается
+BREAKER_FAILURE_RATE = getattr(cfg, "BREAKER_FAILURE_RATE", 0.5)
+# Запрос дольше этого времени считается неудачным, даже если панель ответила
+BREAKER_SLOW_CALL = getattr(cfg, "BREAKER_SLOW_CALL", 5)
+# Сколько секунд отключённая панель не получает запросов до пробных
+BREAKER_OPEN_TIME = getattr(cfg, "BREAKER_OPEN_TIME", 30)
+# Одновременных пробных запросов к панели после паузы
+BREAKER_HALF_OPEN_CALLS = getattr(cfg, "BREAKER_HALF_OPEN_CALLS", 1)
+# Бюджет одного HTTP-запроса к приложению на все запросы к панелям, секунды
+PANEL_REQUEST_BUDGET = getattr(cfg, "PANEL_REQUEST_BUDGET", 20)
+# Запросы с этими префиксами пути выполняются без бюджета: сверка и кампании обходят все панели
+PANEL_BUDGET_EXEMPT = getattr(cfg, "PANEL_BUDGET_EXEMPT", ("/api/admin/",))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+TRANSITIONS = metrics.Counter("panel_breaker_transitions_total", "Panel circuit breaker state changes", ("panel", "state"))
+REJECTED = metrics.Counter("panel_breaker_rejected_total", "Panel calls rejected by an open circuit breaker", ("panel",))
+
+_breakers = []
+# Момент loop.time(), к которому должны завершиться все запросы к панелям текущего HTTP-запроса
+_deadline = contextvars.ContextVar("panel_deadline", default=None)
+
+
+class PanelUnavailable(Exception):
+    """Панель отключена автоматом: запрос отклонён без обращения к ней"""
+
+
+class CircuitBreaker:
+    """closed - запросы идут и учитываются; open - отклоняются сразу; half_open - после паузы идут пробные,
+    успешная проба закрывает автомат, неудачная снова открывает"""
+
+    def __init__(self, name):
+        self.name = name
+        self.state = CLOSED
+        # (время завершения, неудача) запросов за последние BREAKER_WINDOW секунд
+        self._calls = deque()
+        self._opened_at = 0.0
+        self._probes = 0
+        _breakers.append(self)
+
+    def available(self):
+        """Можно ли сейчас отправить запрос, без изменения состояния"""
+        return self.state != OPEN or time.monotonic() - self._opened_at >= BREAKER_OPEN_TIME
+
+    def current_state(self):
+        """Состояние для метрик и /readyz: после паузы открытый автомат ждёт пробного запроса"""
+        return HALF_OPEN if self.state == OPEN and self.available() else self.state
+
+    def acquire(self):
+        """Разрешение на запрос; возвращает True для пробного запроса, иначе False.
+        Отключённая панель - PanelUnavailable"""
+        if self.state == OPEN and self.available():
+            self._transition(HALF_OPEN)
+        if self.state == OPEN or (self.state == HALF_OPEN and self._probes >= BREAKER_HALF_OPEN_CALLS):
+            REJECTED.inc(self.name)
+            raise PanelUnavailable(f"Панель {self.name} временно отключена после серии ошибок")
+        if self.state == HALF_OPEN:
+            self._probes += 1
+            return True
+        return False
+
+    def record(self, probe, ok, elapsed):
+        """Итог запроса: ok - True/False, None - запрос отменён вызывающим кодом"""
+        failed = ok is False or elapsed >= BREAKER_SLOW_CALL
+        if probe:
+            self._probes -= 1
+            if self.state != HALF_OPEN or (ok is None and not failed):
+                return
+            if failed:
+                self._open()
+            else:
+                self._transition(CLOSED)
+            return
+        if self.state != CLOSED or (ok is None and not failed):
+            return
+        now = time.monotonic()
+        self._calls.append((now, failed))
+        while now - self._calls[0][0] > BREAKER_WINDOW:
+            self._calls.popleft()
+        if len(self._calls) >= BREAKER_MIN_CALLS:
+            failures = sum(1 for _, call_failed in self._calls if call_failed)
+            if failures / len(self._calls) >= BREAKER_FAILURE_RATE:
+                self._open()
+
+    def _open(self):
+        self._opened_at = time.monotonic()
+        self._transition(OPEN)
+
+    def _transition(self, state):
+        self.state = state
+        self._calls.clear()
+        TRANSITIONS.inc(self.name, state)
+        if state == OPEN:
+            logging.warning(f"Панель {self.name} отключена на {BREAKER_OPEN_TIME} с после серии ошибок")
+        else:
+            logging.info(f"Автомат панели {self.name}: {state}")
+
+
+def _collect():
+    return [
+        ("panel_breaker_state", "gauge", "Panel circuit breaker state: 0 closed, 1 half-open, 2 open",
+         [({"panel": breaker.name}, STATE_VALUES[breaker.current_state()]) for breaker in _breakers]),
+    ]
+
+
+metrics.register_collector(_collect)
+
+
+@contextmanager
+def budget(seconds):
+    """Общий бюджет на запросы к панелям внутри блока; None - без ограничения (фоновые задачи)"""
+    deadline = None if seconds is None else asyncio.get_running_loop().time() + seconds
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def timeout(limit=None):
+    """asyncio.timeout до меньшего из limit секунд и остатка бюджета"""
+    deadline = _deadline.get()
+    if limit is not None:
+        limited = asyncio.get_running_loop().time() + limit
+        deadline = limited if deadline is None else min(deadline, limited)
+    return asyncio.timeout_at(deadline)
+
+
+def detached(coro):
+    """Задача вне бюджета вызвавшего запроса: её результат ждут и другие запросы со своими бюджетами"""
+    context = contextvars.copy_context()
+    context.run(_deadline.set, None)
+    return asyncio.get_running_loop().create_task(coro, context=context)
+
+
+class BudgetMiddleware:
+    """ASGI-middleware: один бюджет PANEL_REQUEST_BUDGET на все запросы к панелям в рамках HTTP-запроса,
+    чтобы одна медленная панель не держала запрос дольше него"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(tuple(PANEL_BUDGET_EXEMPT)):
+            return await self.app(scope, receive, send)
+        with budget(PANEL_REQUEST_BUDGET):
+            await self.app(scope, receive, send)
@@ -0,0 +1,199 @@
+"""Кампании массового продления подписок, например компенсация после сбоя"""
+import asyncio
+import json
+import logging
+from collections import defaultdict
+
+from py3xui import Client
+
+import breaker
+import client_index
+import config as cfg
+from database import claim_campaign, extend_campaign_lease, get_campaign_items, get_directory_entries_bulk, \
+    complete_campaign_items, fail_campaign_items, finish_campaign, get_unfinished_campaigns, record_campaign_panel_targets
+from xui_utils import PANELS, SUB_PANELS, PANEL_DEADLINE, inbound_lock
+
+# Подписок в одном пакете: один UPDATE users и одна запись inbound на панели на пакет
+CAMPAIGN_BATCH_SIZE = getattr(cfg, "CAMPAIGN_BATCH_SIZE", 200)
+# Одновременных записей inbound на одну панель
+CAMPAIGN_PANEL_CONCURRENCY = getattr(cfg, "CAMPAIGN_PANEL_CONCURRENCY", 2)
+# Через сколько секунд кампанию упавшего экземпляра может продолжить другой
+CAMPAIGN_LEASE = getattr(cfg, "CAMPAIGN_LEASE", 300)
+# Как часто искать прерванные кампании
+CAMPAIGN_RESUME_INTERVAL = getattr(cfg, "CAMPAIGN_RESUME_INTERVAL", 60)
+
+# Срок на панели, отличающийся от целевого меньше чем на это значение, считается уже продлённым, мс
+EXPIRY_MATCH_TOLERANCE = 1000
+DAY_MS = 24 * 3600 * 1000
+
+_running = set()
+_tasks = set()
+
+
+def _to_ms(dt):
+    return int(dt.timestamp() * 1000)
+
+
+def _new_expiry(current, target, recorded, created_ms, days_ms):
+    """Новый срок клиента или None, если менять не нужно.
+
+    recorded - срок, который кампания уже записывала на эту панель. Срок на панели может расходиться с БД,
+    поэтому целевой срок из БД признаёт применённую кампанию только без такой записи. Если срок на панели
+    не дошёл до записанного, запись не состоялась и повторяется. Срок, продлённый пользователем после
+    создания кампании (или после её записи), получает дни кампании сверху. 0 и отрицательные значения -
+    бессрочный клиент и отсчёт с первого подключения, их кампания не трогает."""
+    if current <= 0:
+        return None
+    if recorded is not None:
+        if abs(current - recorded) <= EXPIRY_MATCH_TOLERANCE:
+            return None
+        if current < recorded:
+            return recorded
+    elif abs(current - target) <= EXPIRY_MATCH_TOLERANCE:
+        return None
+    return max(current, created_ms) + days_ms
+
+
+async def _update_inbound(campaign_id, panel, inbound_id, targets, created_ms, days_ms, pool):
+    """Новые сроки всех клиентов пакета в одном inbound одной записью inbound.
+    targets - {email: (целевой срок из БД, записанный ранее на эту панель срок или None)}"""
+    async with inbound_lock(panel, inbound_id, exclusive=True):
+        inbound = await panel["api"].inbound.get_raw(inbound_id)
+        settings = json.loads(inbound["settings"])
+        changed = []
+        for client in settings.get("clients", []):
+            email = client.get("email")
+            if email not in targets:
+                continue
+            expiry = _new_expiry(client.get("expiryTime", 0), *targets[email], created_ms, days_ms)
+            if expiry is not None:
+                client["expiryTime"] = expiry
+                client["enable"] = True
+                changed.append(client)
+        if not changed:
+            return
+        await record_campaign_panel_targets(
+            campaign_id, panel["name"], {client["email"]: client["expiryTime"] for client in changed}, pool
+        )
+        inbound["settings"] = json.dumps(settings, ensure_ascii=False)
+        await panel["api"].inbound.update_raw(inbound_id, inbound)
+    for client in changed:
+        try:
+            client_index.put_client(panel["name"], inbound_id, Client.model_validate(client))
+        except Exception as e:
+            # Панель уже обновлена, снимок догонит её при следующем обновлении
+            logging.warning(f"Кампания: не удалось обновить кэш клиента {client.get('email')}: {e}")
+
+
+async def _apply_on_panel(campaign_id, panel, targets, directory, created_ms, days_ms, errors, pool):
+    by_inbound = defaultdict(dict)
+    for email, target in targets.items():
+        inbound_id = directory[email].get(panel["name"])
+        if inbound_id is None:
+            try:
+                entry = await client_index.find_by_email(panel, email)
+            except Exception as e:
+                errors[email] = f"{panel['name']}: {e!r}"
+                continue
+            # Клиента нет на панели: это расхождение для сверки, а не ошибка кампании
+            if entry is None:
+                continue
+            inbound_id = entry[0]
+        by_inbound[inbound_id][email] = target
+
+    semaphore = asyncio.Semaphore(CAMPAIGN_PANEL_CONCURRENCY)
+
+    async def apply(inbound_id, inbound_targets):
+        async with semaphore:
+            try:
+                await asyncio.wait_for(
+                    _update_inbound(campaign_id, panel, inbound_id, inbound_targets, created_ms, days_ms, pool),
+                    PANEL_DEADLINE
+                )
+            except Exception as e:
+                logging.error(f"Кампания: не удалось обновить inbound {inbound_id} на панели {panel['name']}: {e!r}")
+                for email in inbound_targets:
+                    errors[email] = f"{panel['name']}: {e!r}"
+
+    await asyncio.gather(*(apply(inbound_id, inbound_targets) for inbound_id, inbound_targets in by_inbound.items()))
+
+
+async def _apply_batch(campaign, items, pool):
+    """Продление пакета на всех панелях; возвращает {email: ошибка} для не продлённых хотя бы на одной"""
+    directory = defaultdict(dict)
+    for row in await get_directory_entries_bulk([item["email"] for item in items], pool):
+        directory[row["email"]][row["panel"]] = row["inbound_id"]
+    created_ms = _to_ms(campaign["created_at"])
+    days_ms = campaign["days"] * DAY_MS
+    errors = {}
+    operations = []
+    for panel in PANELS + SUB_PANELS:
+        targets = {
+            item["email"]: (_to_ms(item["target_expiry"]), item["panel_targets"].get(panel["name"]))
+            for item in items if panel in SUB_PANELS or item["panel"] == panel["name"]
+        }
+        if targets:
+            operations.append(_apply_on_panel(campaign["id"], panel, targets, directory, created_ms, days_ms, errors, pool))
+    await asyncio.gather(*operations)
+    return errors
+
+
+async def run(campaign_id, pool):
+    """Выполнение или продолжение кампании по пакетам с отметкой о каждом пакете в БД.
+    Возвращает итоговый статус или None, если кампанию сейчас выполняет другой экземпляр"""
+    if campaign_id in _running:
+        return None
+    campaign = await claim_campaign(campaign_id, CAMPAIGN_LEASE, pool)
+    if campaign is None:
+        return None
+    _running.add(campaign_id)
+    try:
+        after = ""
+        done_total = failed_total = 0
+        while True:
+            items = await get_campaign_items(campaign_id, after, CAMPAIGN_BATCH_SIZE, pool)
+            if not items:
+                break
+            errors = await _apply_batch(campaign, items, pool)
+            done = [item["email"] for item in items if item["email"] not in errors]
+            if done:
+                await complete_campaign_items(campaign_id, done, pool)
+            if errors:
+                await fail_campaign_items(campaign_id, errors, pool)
+            await extend_campaign_lease(campaign_id, CAMPAIGN_LEASE, pool)
+            done_total += len(done)
+            failed_total += len(errors)
+            after = items[-1]["email"]
+        status = await finish_campaign(campaign_id, pool)
+        logging.info(f"Кампания {campaign_id}: продлено {done_total}, ошибок {failed_total}, статус {status}")
+        return status
+    finally:
+        _running.discard(campaign_id)
+
+
+def start(campaign_id, pool):
+    """Запуск кампании в фоне"""
+    async def execute():
+        try:
+            await run(campaign_id, pool)
+        except Exception as e:
+            logging.error(f"Ошибка кампании {campaign_id}: {e}", exc_info=True)
+
+    # Кампания переживает HTTP-запрос, который её запустил, и не ограничена его бюджетом
+    task = breaker.detached(execute())
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def run_resumer(pool):
+    """Продолжение кампаний, прерванных падением или перезапуском"""
+    while True:
+        try:
+            for campaign_id in await get_unfinished_campaigns(pool):
+                if campaign_id not in _running:
+                    await run(campaign_id, pool)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Ошибка при продолжении кампаний: {e}")
+        await asyncio.sleep(CAMPAIGN_RESUME_INTERVAL)
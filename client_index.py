@@ -0,0 +1,193 @@
+"""Кэш клиентов панелей 3x-ui: снимки inbound'ов с индексами по tg_id и email"""
+import asyncio
+import logging
+import time
+from collections import deque
+
+from py3xui import Client
+
+import breaker
+import config as cfg
+import invalidation
+import metrics
+import user_cache
+
+# Максимальный возраст снимка, после которого запрос сам перечитает панель
+CLIENT_INDEX_TTL = getattr(cfg, "CLIENT_INDEX_TTL", 120)
+# Период фонового обновления снимков
+CLIENT_INDEX_REFRESH_INTERVAL = getattr(cfg, "CLIENT_INDEX_REFRESH_INTERVAL", 60)
+# Сколько секунд хранить журнал локальных изменений для переноса в новый снимок
+JOURNAL_RETENTION = max(CLIENT_INDEX_TTL * 2, 300)
+
+_snapshots = {}
+_journals = {}
+_refreshing = {}
+
+
+def _tg_key(tg_id):
+    try:
+        return int(tg_id)
+    except (TypeError, ValueError):
+        return None
+
+
+class PanelSnapshot:
+    """Снимок клиентов одной панели с O(1) поиском по email и tg_id"""
+
+    def __init__(self, inbounds):
+        self.loaded_at = time.monotonic()
+        # Помечается при возможном пропуске изменений других воркеров
+        self.stale = False
+        self.by_email = {}
+        self.by_tg_id = {}
+        # Суммарный трафик inbound'ов на момент снимка, для оценки нагрузки
+        self.traffic = 0
+        for inbound in inbounds:
+            self.traffic += inbound.up + inbound.down
+            for client in inbound.settings.clients:
+                self.put(inbound.id, client)
+
+    def put(self, inbound_id, client):
+        self.remove(client.email)
+        entry = (inbound_id, client)
+        self.by_email[client.email] = entry
+        key = _tg_key(client.tg_id)
+        if key is not None:
+            self.by_tg_id.setdefault(key, {})[client.email] = entry
+
+    def remove(self, email):
+        entry = self.by_email.pop(email, None)
+        if not entry:
+            return
+        key = _tg_key(entry[1].tg_id)
+        clients = self.by_tg_id.get(key)
+        if clients is not None:
+            clients.pop(email, None)
+            if not clients:
+                del self.by_tg_id[key]
+
+
+def _shared_refresh(panel):
+    """Одна перезагрузка панели на всех одновременных ожидающих"""
+    name = panel["name"]
+    task = _refreshing.get(name)
+    if task is None:
+        task = _refreshing[name] = breaker.detached(refresh(panel))
+        task.add_done_callback(lambda _: _refreshing.pop(name, None))
+    return asyncio.shield(task)
+
+
+def _journal(name, op, *args):
+    now = time.monotonic()
+    journal = _journals.setdefault(name, deque())
+    journal.append((now, op, args))
+    while journal and now - journal[0][0] > JOURNAL_RETENTION:
+        journal.popleft()
+
+
+def _apply(snapshot, op, args):
+    if op == "put":
+        snapshot.put(*args)
+    else:
+        snapshot.remove(*args)
+
+
+async def refresh(panel):
+    """Полностью перечитывает панель и заменяет её снимок"""
+    name = panel["name"]
+    started = time.monotonic()
+    inbounds = await panel["api"].inbound.get_list()
+    snapshot = PanelSnapshot(inbounds)
+    # Изменения, сделанные приложением во время загрузки, переносим в новый снимок
+    for ts, op, args in _journals.get(name, ()):
+        if ts >= started:
+            _apply(snapshot, op, args)
+    _snapshots[name] = snapshot
+    logging.info(f"Снимок панели {name} обновлён: {len(snapshot.by_email)} клиентов")
+    return snapshot
+
+
+def _is_fresh(snapshot):
+    return snapshot is not None and not snapshot.stale and time.monotonic() - snapshot.loaded_at < CLIENT_INDEX_TTL
+
+
+async def get_snapshot(panel):
+    """Возвращает актуальный снимок панели, перечитывая её только при истёкшем TTL"""
+    name = panel["name"]
+    snapshot = _snapshots.get(name)
+    if _is_fresh(snapshot):
+        metrics.CACHE_REQUESTS.inc("client_index", "hit")
+        return snapshot
+    metrics.CACHE_REQUESTS.inc("client_index", "miss")
+    try:
+        # Конкурентные запросы ждут одну перезагрузку вместо того, чтобы запускать свои, даже при нулевом TTL
+        return await _shared_refresh(panel)
+    except Exception as e:
+        if snapshot is None:
+            raise
+        # Отключённая автоматом панель уже записана в лог при отключении
+        if not isinstance(e, breaker.PanelUnavailable):
+            logging.error(f"Не удалось обновить снимок панели {name}, используем устаревший: {e!r}")
+        return snapshot
+
+
+async def find_by_tg_id(panel, tg_id):
+    """Список (inbound_id, client) пользователя на панели"""
+    clients = (await get_snapshot(panel)).by_tg_id.get(_tg_key(tg_id), {})
+    return list(clients.values())
+
+
+async def find_by_email(panel, email):
+    """(inbound_id, client) по email или None"""
+    return (await get_snapshot(panel)).by_email.get(email)
+
+
+def put_client(panel_name, inbound_id, client, publish=True):
+    """Запись в кэш после добавления или продления клиента приложением.
+    Другие воркеры получают клиента целиком и обновляют свои снимки без запроса к панели"""
+    _journal(panel_name, "put", inbound_id, client)
+    snapshot = _snapshots.get(panel_name)
+    if snapshot:
+        snapshot.put(inbound_id, client)
+    user_cache.bump(client.tg_id, user_cache.SUBSCRIPTIONS, publish=False)
+    if publish:
+        invalidation.publish("put", panel=panel_name, inbound_id=inbound_id,
+                             client=client.model_dump(mode="json", by_alias=True))
+
+
+def remove_client(panel_name, email, publish=True):
+    """Удаление клиента из кэша после его удаления с панели"""
+    _journal(panel_name, "remove", email)
+    snapshot = _snapshots.get(panel_name)
+    if snapshot:
+        entry = snapshot.by_email.get(email)
+        if entry:
+            user_cache.bump(entry[1].tg_id, user_cache.SUBSCRIPTIONS, publish=False)
+        snapshot.remove(email)
+    if publish:
+        invalidation.publish("remove", panel=panel_name, email=email)
+
+
+def expire_all():
+    """Все снимки перечитываются при следующем обращении"""
+    for snapshot in _snapshots.values():
+        snapshot.stale = True
+
+
+
+async def run_refresher(panels):
+    """Фоновое периодическое обновление снимков всех панелей"""
+    while True:
+        for panel in panels:
+            try:
+                await _shared_refresh(panel)
+            except Exception as e:
+                logging.error(f"Ошибка при обновлении снимка панели {panel['name']}: {e}")
+        await asyncio.sleep(CLIENT_INDEX_REFRESH_INTERVAL)
+
+
+invalidation.subscribe("put", lambda event: put_client(
+    event["panel"], event["inbound_id"], Client.model_validate(event["client"]), publish=False
+))
+invalidation.subscribe("remove", lambda event: remove_client(event["panel"], event["email"], publish=False))
+invalidation.subscribe(invalidation.RESET, lambda event: expire_all())
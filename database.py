@@ -1,85 +1,498 @@
+import asyncio
 import asyncpg
+import json
 import logging
-from datetime import datetime, timezone, timedelta
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
 
+import config as cfg
+
+DB_POOL_MIN_SIZE = getattr(cfg, "DB_POOL_MIN_SIZE", 2)
+DB_POOL_MAX_SIZE = getattr(cfg, "DB_POOL_MAX_SIZE", 5)
+DB_MAX_INACTIVE_LIFETIME = getattr(cfg, "DB_MAX_INACTIVE_LIFETIME", 300)
+# Кэш подготовленных выражений на соединение; все запросы модуля зарегистрированы в QUERIES и в него помещаются
+DB_STATEMENT_CACHE_SIZE = getattr(cfg, "DB_STATEMENT_CACHE_SIZE", 100)
+DB_COMMAND_TIMEOUT = getattr(cfg, "DB_COMMAND_TIMEOUT", 30)
+# Запросы и ожидание соединения дольше этого времени (секунды) пишутся в лог
+DB_SLOW_QUERY = getattr(cfg, "DB_SLOW_QUERY", 0.5)
+# Необязательные хуки asyncpg: init - при открытии соединения, setup - при каждой выдаче из пула
+DB_INIT_HOOK = getattr(cfg, "DB_INIT_HOOK", None)
+DB_SETUP_HOOK = getattr(cfg, "DB_SETUP_HOOK", None)
+# Пауза между попытками взять разделяемую блокировку inbound, пока его целиком перезаписывает кампания
+DB_LOCK_RETRY_INTERVAL = getattr(cfg, "DB_LOCK_RETRY_INTERVAL", 0.05)
+
+# Именованные запросы: один и тот же текст для каждого вызова, поэтому asyncpg готовит выражение
+# один раз на соединение и дальше берёт его из кэша
+QUERIES = {}
+# Статистика по имени запроса: {"count", "errors", "total", "max"} (секунды)
+query_stats = {}
+# Ожидание свободного соединения пула; waiting - сколько запросов ждёт прямо сейчас
+acquire_stats = {"count": 0, "total": 0.0, "max": 0.0, "waiting": 0}
+
+
+def register_query(name, sql):
+    if name in QUERIES:
+        raise ValueError(f"Запрос {name} уже зарегистрирован")
+    QUERIES[name] = sql
+    query_stats[name] = {"count": 0, "errors": 0, "total": 0.0, "max": 0.0}
+
+
+def get_stats():
+    """Снимок статистики запросов и ожидания соединений"""
+    return {
+        "queries": {name: dict(stats) for name, stats in query_stats.items()},
+        "acquire": dict(acquire_stats),
+    }
+
+
+async def _init_connection(conn):
+    # Даты хранятся в timestamptz, сессия работает в UTC
+    await conn.execute("SET TIME ZONE 'UTC'")
+    if DB_INIT_HOOK:
+        await DB_INIT_HOOK(conn)
+
+
+async def init_pool(dsn=None):
+    """Инициализация пула соединений по настройкам из config"""
+    return await asyncpg.create_pool(
+        dsn or cfg.DSN,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        init=_init_connection,
+        setup=DB_SETUP_HOOK,
+    )
+
+
+@asynccontextmanager
+async def _acquire(pool):
+    started = time.perf_counter()
+    acquire_stats["waiting"] += 1
+    try:
+        conn = await pool.acquire()
+    finally:
+        acquire_stats["waiting"] -= 1
+    try:
+        waited = time.perf_counter() - started
+        acquire_stats["count"] += 1
+        acquire_stats["total"] += waited
+        acquire_stats["max"] = max(acquire_stats["max"], waited)
+        if waited > DB_SLOW_QUERY:
+            logging.warning(f"Ожидание соединения из пула: {waited:.3f} с")
+        yield conn
+    finally:
+        await pool.release(conn)
+
+
+@asynccontextmanager
+async def connection(pool):
+    """Соединение для запроса: функции модуля принимают пул или уже открытое соединение"""
+    if isinstance(pool, asyncpg.Pool):
+        async with _acquire(pool) as conn:
+            yield conn
+    else:
+        yield pool
+
+
+@asynccontextmanager
+async def unit_of_work(pool):
+    """Одно соединение и одна транзакция на несколько записей; передаётся в функции вместо пула"""
+    async with _acquire(pool) as conn:
+        async with conn.transaction():
+            yield conn
+
+
+async def _run(conn, method, name, args):
+    stats = query_stats[name]
+    started = time.perf_counter()
+    try:
+        return await getattr(conn, method)(QUERIES[name], *args)
+    except Exception:
+        stats["errors"] += 1
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        stats["count"] += 1
+        stats["total"] += elapsed
+        stats["max"] = max(stats["max"], elapsed)
+        if elapsed > DB_SLOW_QUERY:
+            logging.warning(f"Медленный запрос {name}: {elapsed:.3f} с")
+
+
+async def execute(conn, name, *args):
+    return await _run(conn, "execute", name, args)
+
+
+async def fetch(conn, name, *args):
+    return await _run(conn, "fetch", name, args)
+
+
+async def fetchrow(conn, name, *args):
+    return await _run(conn, "fetchrow", name, args)
+
+
+async def fetchval(conn, name, *args):
+    return await _run(conn, "fetchval", name, args)
+
+
+def metrics_collector(pool):
+    """Метрики пула и запросов для metrics.register_collector"""
+    def collect():
+        return [
+            ("db_pool_size", "gauge", "Open connections in the asyncpg pool", [({}, pool.get_size())]),
+            ("db_pool_idle", "gauge", "Idle connections in the asyncpg pool", [({}, pool.get_idle_size())]),
+            ("db_pool_waiting", "gauge", "Requests waiting for a pool connection", [({}, acquire_stats["waiting"])]),
+            ("db_pool_acquire_wait_seconds_total", "counter", "Time spent waiting for a pool connection",
+             [({}, acquire_stats["total"])]),
+            ("db_pool_acquires_total", "counter", "Pool connection acquires", [({}, acquire_stats["count"])]),
+            ("db_query_duration_seconds_total", "counter", "Time spent in named queries",
+             [({"query": name}, stats["total"]) for name, stats in query_stats.items()]),
+            ("db_queries_total", "counter", "Named query executions",
+             [({"query": name}, stats["count"]) for name, stats in query_stats.items()]),
+            ("db_query_errors_total", "counter", "Failed named query executions",
+             [({"query": name}, stats["errors"]) for name, stats in query_stats.items()]),
+        ]
+    return collect
+
+
+register_query("ping", "SELECT 1")
+
+
+async def ping(pool):
+    """Проверка доступности БД для /readyz"""
+    async with connection(pool) as conn:
+        return await fetchval(conn, "ping")
+
+
+register_query("try_advisory_lock", "SELECT pg_try_advisory_lock($1)")
+
+
+@asynccontextmanager
+async def advisory_lock(key, dsn=None):
+    """Сессионная advisory-блокировка без ожидания на отдельном соединении вне пула, как у listen: блок может
+    держать её долго, не отнимая соединений у запросов. Отдаёт соединение, если блокировка получена, иначе None.
+    Блокировка снимается закрытием соединения, при его обрыве - самим Postgres"""
+    conn = await asyncpg.connect(dsn or cfg.DSN, command_timeout=DB_COMMAND_TIMEOUT)
+    try:
+        yield conn if await fetchval(conn, "try_advisory_lock", key) else None
+    finally:
+        conn.terminate()
+
+
+# Ключ блокировки inbound - (hashtext(имя панели), inbound_id); одно число заняли MIGRATIONS_LOCK_KEY и им подобные
+register_query("lock_inbound", "SELECT pg_advisory_lock(hashtext($1), $2)")
+register_query("try_lock_inbound_shared", "SELECT pg_try_advisory_lock_shared(hashtext($1), $2)")
+register_query("unlock_inbound_shared", "SELECT pg_advisory_unlock_shared(hashtext($1), $2)")
+
+# Разделяемые блокировки inbound всех корутин процесса держит сессия одного отдельного соединения:
+# запросы к нему мгновенные, сессионные блокировки складываются, а соединения пула не ждут ответа панели
+_shared_lock_connection = None
+_shared_lock_guard = asyncio.Lock()
+
+
+async def _try_lock_shared(panel_name, inbound_id):
+    """Соединение с полученной разделяемой блокировкой или None, если inbound занят записью целиком"""
+    global _shared_lock_connection
+    async with _shared_lock_guard:
+        if _shared_lock_connection is None or _shared_lock_connection.is_closed():
+            _shared_lock_connection = await asyncpg.connect(cfg.DSN, command_timeout=DB_COMMAND_TIMEOUT)
+        conn = _shared_lock_connection
+        return conn if await fetchval(conn, "try_lock_inbound_shared", panel_name, inbound_id) else None
+
+
+async def _unlock_shared(conn, panel_name, inbound_id):
+    async with _shared_lock_guard:
+        if conn.is_closed():
+            # Вместе с сессией Postgres снял и её блокировки
+            return
+        try:
+            await fetchval(conn, "unlock_inbound_shared", panel_name, inbound_id)
+        except Exception as e:
+            logging.warning(f"Не удалось снять блокировку inbound {inbound_id} панели {panel_name}: {e}")
+            conn.terminate()
+
+
+def _unlock_abandoned(panel_name, inbound_id):
+    def callback(attempt):
+        if not attempt.cancelled() and attempt.exception() is None and attempt.result() is not None:
+            asyncio.ensure_future(_unlock_shared(attempt.result(), panel_name, inbound_id))
+    return callback
+
+
+@asynccontextmanager
+async def inbound_advisory_lock(panel_name, inbound_id, exclusive):
+    """Блокировка inbound между воркерами и внутри процесса на время блока, без соединений пула.
+    Изменения отдельных клиентов берут её разделяемой и идут параллельно; запись inbound целиком берёт
+    исключительную на своём соединении, и Postgres не выдаёт новых разделяемых, пока она ждёт или держится"""
+    if exclusive:
+        conn = await asyncpg.connect(cfg.DSN, command_timeout=DB_COMMAND_TIMEOUT)
+        try:
+            await fetchval(conn, "lock_inbound", panel_name, inbound_id)
+            yield
+        finally:
+            conn.terminate()
+        return
+    delay = DB_LOCK_RETRY_INTERVAL
+    while True:
+        # Отмена не должна оставить взятую блокировку без владельца: попытка доводится до конца в фоне
+        attempt = asyncio.ensure_future(_try_lock_shared(panel_name, inbound_id))
+        try:
+            conn = await asyncio.shield(attempt)
+        except asyncio.CancelledError:
+            attempt.add_done_callback(_unlock_abandoned(panel_name, inbound_id))
+            raise
+        if conn is not None:
+            break
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.5)
+    try:
+        yield
+    finally:
+        await asyncio.shield(asyncio.ensure_future(_unlock_shared(conn, panel_name, inbound_id)))
+
+
+async def close_lock_connections():
+    global _shared_lock_connection
+    if _shared_lock_connection is not None:
+        await _shared_lock_connection.close()
+        _shared_lock_connection = None
+
+
+register_query("notify", "SELECT pg_notify($1, $2)")
+
+
+async def notify(channel, payloads, pool):
+    """Отправка уведомлений NOTIFY; внутри unit_of_work доставляются только после коммита"""
+    async with connection(pool) as conn:
+        await _run(conn, "executemany", "notify", ([(channel, payload) for payload in payloads],))
+
+
+async def listen(channel, callback, on_lost, dsn=None):
+    """Отдельное соединение для LISTEN вне пула: пока оно слушает канал, его нельзя отдавать другим запросам.
+    callback(payload) вызывается на каждое уведомление, on_lost() - при обрыве соединения"""
+    conn = await asyncpg.connect(dsn or cfg.DSN, command_timeout=DB_COMMAND_TIMEOUT)
+    try:
+        conn.add_termination_listener(lambda _conn: on_lost())
+        await conn.add_listener(channel, lambda _conn, _pid, _channel, payload: callback(payload))
+    except BaseException:
+        await conn.close()
+        raise
+    return conn
 
-async def init_pool(dsn):
-    """Инициализация пула соединений"""
-    return await asyncpg.create_pool(dsn)
 
 #-------------------------------------------------------------------------------------------------------------------------------------------
 #VPN subs system
 
+register_query(
+    "add_subscription",
+    "INSERT INTO users (tg_id, email, panel, expiry_date, warn, ends) VALUES ($1, $2, $3, $4, 0, 0)"
+)
+register_query(
+    "upsert_subscription",
+    """
+    INSERT INTO users (tg_id, email, panel, expiry_date, warn, ends)
+    VALUES ($1, $2, $3, $4, 0, 0)
+    ON CONFLICT (email) DO UPDATE SET expiry_date = EXCLUDED.expiry_date, warn = 0, ends = 0
+    RETURNING xmax = 0
+    """
+)
+register_query(
+    "add_payment",
+    "INSERT INTO payments (telegram_id, label, operation_type, payment_time, amount, email) VALUES ($1, $2, $3, $4, $5, $6)"
+)
+
 async def add_subscription_to_db(tg_id, email, panel, expiry_date, pool):
-    async with pool.acquire() as conn:
-        await conn.execute(
-            "INSERT INTO users (tg_id, email, panel, expiry_date, warn, ends) VALUES ($1, $2, $3, $4, 0, 0)",
-            tg_id, email, panel, expiry_date
-        )
+    async with connection(pool) as conn:
+        await execute(conn, "add_subscription", tg_id, email, panel, expiry_date)
         logging.info(f"Подписка добавлена: {email}")
 
 
 async def update_subscriptions_on_db(tg_id, email, panel, expiry_date,  pool):
-    async with pool.acquire() as conn:
-        # Проверяем, существует ли подписка с указанным email
-        existing = await conn.fetchrow("SELECT * FROM users WHERE email = $1", email)
-
-        if existing:
-            # Если подписка существует, обновляем её
-            await conn.execute(
-                "UPDATE users SET expiry_date = $1, warn = 0, ends = 0 WHERE email = $2",
-                expiry_date, email
-            )
-            logging.info(f"Подписка обновлена: {email}")
-        else:
-            # Если подписка отсутствует, создаем новую
-            tg_id = tg_id or "unknown"  # Используем переданный tg_id или "unknown", если не указан
-            await conn.execute(
-                "INSERT INTO users (tg_id, email, panel, expiry_date, warn, ends) VALUES ($1, $2, $3, $4, 0, 0)",
-                tg_id, email, panel, expiry_date
-            )
+    """Создание или обновление подписки за один запрос"""
+    async with connection(pool) as conn:
+        inserted = await fetchval(conn, "upsert_subscription", tg_id or "unknown", email, panel, expiry_date)
+        if inserted:
             logging.info(f"Новая подписка создана: {email}")
+        else:
+            logging.info(f"Подписка обновлена: {email}")
 
 async def add_payment_to_db(telegram_id, label, operation_type, payment_time, amount, email, pool):
-    async with pool.acquire() as conn:
-        await conn.execute(
-            "INSERT INTO payments (telegram_id, label, operation_type, payment_time, amount, email) VALUES ($1, $2, $3, $4, $5, $6)",
-            telegram_id, label, operation_type, payment_time, amount, email
-        )
+    async with connection(pool) as conn:
+        await execute(conn, "add_payment", telegram_id, label, operation_type, payment_time, amount, email)
         logging.info(f"Платёж добавлен: {email}")
 
+#-------------------------------------------------------------------------------------------------------------------------------------------
+#Payment events
+
+register_query(
+    "record_payment_event",
+    """
+    INSERT INTO payment_events (payment_id, event, status, payload)
+    VALUES ($1, $2, $3, $4::jsonb)
+    ON CONFLICT (payment_id, event) DO NOTHING
+    RETURNING id
+    """
+)
+register_query(
+    "get_payment_status",
+    "SELECT status FROM payment_events WHERE payment_id = $1 ORDER BY received_at DESC LIMIT 1"
+)
+
+async def record_payment_event(payment_id, event, status, payload, pool):
+    """Запись события платежа; False, если такое событие уже было записано"""
+    async with connection(pool) as conn:
+        event_id = await fetchval(conn, "record_payment_event", payment_id, event, status, json.dumps(payload))
+        return event_id is not None
+
+async def get_payment_status(payment_id, pool):
+    """Последний записанный статус платежа или None"""
+    async with connection(pool) as conn:
+        return await fetchval(conn, "get_payment_status", payment_id)
+
+register_query(
+    "get_payment_owner",
+    "SELECT payload #>> '{metadata,tg_id}' FROM payment_events WHERE payment_id = $1 ORDER BY id LIMIT 1"
+)
+
+async def get_payment_owner(payment_id, pool):
+    """tg_id владельца платежа из metadata записанного события или None, если событий ещё нет"""
+    async with connection(pool) as conn:
+        return await fetchval(conn, "get_payment_owner", payment_id)
+
+#-------------------------------------------------------------------------------------------------------------------------------------------
+#Fulfillment ledger
+
+register_query(
+    "get_fulfillment",
+    "SELECT status, result FROM payment_fulfillments WHERE payment_id = $1"
+)
+register_query(
+    "claim_fulfillment",
+    """
+    INSERT INTO payment_fulfillments (payment_id, kind, status)
+    VALUES ($1, $2, 'in_progress')
+    ON CONFLICT (payment_id) DO UPDATE SET status = 'in_progress', claimed_at = now()
+    WHERE payment_fulfillments.status = 'released'
+       OR (payment_fulfillments.status = 'in_progress'
+           AND payment_fulfillments.claimed_at < now() - make_interval(secs => $3))
+    RETURNING payment_id
+    """
+)
+register_query(
+    "complete_fulfillment",
+    """
+    UPDATE payment_fulfillments SET status = 'done', result = $2::jsonb, fulfilled_at = now()
+    WHERE payment_id = $1
+    """
+)
+register_query(
+    "release_fulfillment",
+    "UPDATE payment_fulfillments SET status = 'released' WHERE payment_id = $1 AND status = 'in_progress'"
+)
+register_query(
+    "reserve_fulfillment_target",
+    """
+    UPDATE payment_fulfillments SET target_expiry = COALESCE(target_expiry, $2)
+    WHERE payment_id = $1
+    RETURNING target_expiry
+    """
+)
+
+async def get_fulfillment(payment_id, pool):
+    """Запись об исполнении платежа: {'status', 'result'} или None"""
+    async with connection(pool) as conn:
+        row = await fetchrow(conn, "get_fulfillment", payment_id)
+        if not row:
+            return None
+        return {"status": row["status"], "result": json.loads(row["result"]) if row["result"] else None}
+
+async def claim_fulfillment(payment_id, kind, lease_seconds, pool):
+    """Захват исполнения платежа одним воркером.
+
+    Вставка или обновление строки идёт под её блокировкой, поэтому захват получает только один
+    конкурентный запрос. Незавершённый захват старше lease_seconds (упавший воркер) можно перехватить."""
+    async with connection(pool) as conn:
+        claimed = await fetchval(conn, "claim_fulfillment", payment_id, kind, float(lease_seconds))
+        return claimed is not None
+
+async def complete_fulfillment(payment_id, result, pool):
+    async with connection(pool) as conn:
+        await execute(conn, "complete_fulfillment", payment_id, json.dumps(result))
+        logging.info(f"Платёж исполнен: {payment_id}")
+
+async def release_fulfillment(payment_id, pool):
+    """Снятие захвата после неудачного исполнения, чтобы его можно было повторить; целевой срок сохраняется"""
+    async with connection(pool) as conn:
+        await execute(conn, "release_fulfillment", payment_id)
+
+async def reserve_fulfillment_target(payment_id, target_expiry, pool):
+    """Целевой срок подписки по платежу: при первой попытке записывается target_expiry, повторная попытка
+    получает записанный срок. Иначе повтор после сбоя посчитал бы срок от уже продлённой подписки"""
+    async with connection(pool) as conn:
+        return await fetchval(conn, "reserve_fulfillment_target", payment_id, target_expiry)
+
 #-------------------------------------------------------------------------------------------------------------------------------------------
 #Trial system
 
+register_query("get_trial_status", "SELECT status FROM trials WHERE tg_id = $1")
+register_query("create_trial_user", "INSERT INTO trials (tg_id, status) VALUES ($1, 1)")
+
 async def get_trial_status(tg_id, pool):
     """Получение статуса пробного периода"""
-    async with pool.acquire() as conn:
-        result = await conn.fetchval(
-            "SELECT status FROM trials WHERE tg_id = $1", tg_id
-        )
+    async with connection(pool) as conn:
+        result = await fetchval(conn, "get_trial_status", tg_id)
         return 1 if result == 1 else 0
 
 async def create_trial_user(tg_id, pool):
     """Создание пробного пользователя"""
-    async with pool.acquire() as conn:
-        await conn.execute(
-            "INSERT INTO trials (tg_id, status) VALUES ($1, 1)", tg_id
-        )
+    async with connection(pool) as conn:
+        await execute(conn, "create_trial_user", tg_id)
         logging.info(f"Пробный пользователь создан: tg_id={tg_id}")
 
 #-------------------------------------------------------------------------------------------------------------------------------------------
 #Referal system
 
-async def get_referrals(tg_id, pool):
-    async with pool.acquire() as conn:
-        rows = await conn.fetch(
-            '''
-            SELECT referee_id, bonus_applied, bonus_date
-            FROM referrals
-            WHERE referrer_id = $1
-            ''',
-            tg_id
-        )
+# Страница по ключу referee_id (индекс referrals_referrer_referee_idx); повторные строки одной пары схлопываются
+register_query(
+    "get_referrals_page",
+    '''
+    SELECT DISTINCT ON (referee_id) referee_id, bonus_applied, bonus_date
+    FROM referrals
+    WHERE referrer_id = $1 AND referee_id > $2
+    ORDER BY referee_id, bonus_applied DESC NULLS LAST
+    LIMIT $3
+    '''
+)
+register_query(
+    "get_referral_counts",
+    '''
+    SELECT count(DISTINCT referee_id) AS total,
+           count(DISTINCT referee_id) FILTER (WHERE bonus_applied = 1) AS bonused
+    FROM referrals
+    WHERE referrer_id = $1
+    '''
+)
+# Захват бонуса до выдачи: из параллельных запросов строку получит только один
+register_query(
+    "claim_referral_bonus",
+    '''
+    UPDATE referrals SET bonus_applied = 1, bonus_date = $3
+    WHERE referrer_id = $1 AND referee_id = $2 AND COALESCE(bonus_applied, 0) = 0
+    RETURNING 1
+    '''
+)
+register_query(
+    "release_referral_bonus",
+    "UPDATE referrals SET bonus_applied = 0, bonus_date = NULL WHERE referrer_id = $1 AND referee_id = $2 AND bonus_date = $3"
+)
+register_query("referral_exists", "SELECT EXISTS (SELECT 1 FROM referrals WHERE referrer_id = $1 AND referee_id = $2)")
+
+async def get_referrals_page(tg_id, after, limit, pool):
+    async with connection(pool) as conn:
+        rows = await fetch(conn, "get_referrals_page", tg_id, after or "", limit)
         return [
             {
                 'referee_id': row['referee_id'],
@@ -89,47 +502,371 @@ async def get_referrals(tg_id, pool):
             for row in rows
         ]
 
-async def apply_referral_bonus_db(referrer_id, referee_id, pool):
-    """Применение реферального бонуса"""
-    async with pool.acquire() as conn:
-        await conn.execute(
-            "UPDATE referrals SET bonus_applied = 1, bonus_date = $1 WHERE referrer_id = $2 AND referee_id = $3",
-            datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"), referrer_id, referee_id
-        )
-        logging.info(f"Бонус применён: referrer_id={referrer_id}, referee_id={referee_id}")
+async def get_referral_counts(tg_id, pool):
+    """(всего рефералов, из них с выданным бонусом)"""
+    async with connection(pool) as conn:
+        row = await fetchrow(conn, "get_referral_counts", tg_id)
+        return row['total'], row['bonused']
+
+async def claim_referral_bonus(referrer_id, referee_id, pool):
+    """Атомарная отметка о бонусе. Возвращает время отметки для release_referral_bonus;
+    None, если бонус уже выдан или реферала нет (см. referral_exists)"""
+    claimed_at = datetime.now(timezone.utc)
+    async with connection(pool) as conn:
+        if await fetchval(conn, "claim_referral_bonus", referrer_id, referee_id, claimed_at):
+            logging.info(f"Бонус применён: referrer_id={referrer_id}, referee_id={referee_id}")
+            return claimed_at
+        return None
+
+async def release_referral_bonus(referrer_id, referee_id, claimed_at, pool):
+    """Отмена отметки, если бонус так и не был выдан"""
+    async with connection(pool) as conn:
+        await execute(conn, "release_referral_bonus", referrer_id, referee_id, claimed_at)
+        logging.info(f"Бонус возвращён: referrer_id={referrer_id}, referee_id={referee_id}")
+
+async def referral_exists(referrer_id, referee_id, pool):
+    async with connection(pool) as conn:
+        return await fetchval(conn, "referral_exists", referrer_id, referee_id)
 
 #-------------------------------------------------------------------------------------------------------------------------------------------
 #Products system
 
+register_query(
+    "upsert_product",
+    """
+    INSERT INTO products (tg_id, product, login, expiry_date)
+    VALUES ($1, $2, $3, now() + make_interval(days => $4))
+    ON CONFLICT (login, product) DO UPDATE
+    SET expiry_date = GREATEST(products.expiry_date, now()) + make_interval(days => $4)
+    RETURNING expiry_date, xmax = 0 AS inserted
+    """
+)
+
 async def add_product_to_db(tg_id, product, login, days, pool):
-    async with pool.acquire() as conn:
-        # Проверяем, существует ли уже запись с таким email
-        existing = await conn.fetchrow("SELECT * FROM products WHERE login = $1 AND product = $2", login, product)
-
-        now = datetime.now(timezone.utc)
-
-        if existing:
-            current_expiry_str = existing["expiry_date"]
-            current_expiry = datetime.strptime(current_expiry_str, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
-
-            if current_expiry < now:
-                new_expiry = now + timedelta(days=days)
-            else:
-                new_expiry = current_expiry + timedelta(days=days)
-
-            new_expiry_str = new_expiry.strftime("%Y-%m-%d %H:%M:%S")
-            await conn.execute(
-                "UPDATE products SET expiry_date = $1 WHERE login = $2",
-                new_expiry_str, login
-            )
-            logging.info(f"Подписка обновлена: {tg_id}")
+    """Выдача или продление товара; срок продлевается от текущей даты окончания, если она ещё не прошла"""
+    async with connection(pool) as conn:
+        row = await fetchrow(conn, "upsert_product", tg_id, product, login, days)
+        if row["inserted"]:
+            logging.info(f"Подписка добавлена: {tg_id}")
         else:
-            expiry_date = (now + timedelta(days)).strftime("%Y-%m-%d %H:%M:%S")
-            await conn.execute(
-                """
-                INSERT INTO products (tg_id, product, login, expiry_date)
-                VALUES ($1, $2, $3, $4)
-                """,
-                tg_id, product, login, expiry_date
-            )
-            logging.info(f"Подписка добавлена: {tg_id}")
\ No newline at end of file
+            logging.info(f"Подписка обновлена: {tg_id}")
+        return row["expiry_date"]
+
+#-------------------------------------------------------------------------------------------------------------------------------------------
+#Expiry scheduler
+
+# Постраничная выборка по ключу (expiry_date, id): каждая страница - короткий проход по частичному индексу
+register_query(
+    "get_expiring_subscriptions",
+    """
+    SELECT id, tg_id, email, panel, expiry_date FROM users
+    WHERE warn = 0 AND expiry_date > now() AND expiry_date <= now() + make_interval(secs => $1)
+      AND (expiry_date, id) > ($2, $3)
+    ORDER BY expiry_date, id
+    LIMIT $4
+    """
+)
+register_query(
+    "get_expired_subscriptions",
+    """
+    SELECT id, tg_id, email, panel, expiry_date FROM users
+    WHERE ends = 0 AND expiry_date <= now()
+      AND (expiry_date, id) > ($1, $2)
+    ORDER BY expiry_date, id
+    LIMIT $3
+    """
+)
+# Условие на expiry_date не даёт пометить подписку, продлённую после выборки
+register_query(
+    "mark_warned",
+    "UPDATE users SET warn = 1 WHERE email = ANY($1::text[]) AND expiry_date <= now() + make_interval(secs => $2)"
+)
+register_query(
+    "mark_ended",
+    "UPDATE users SET ends = 1 WHERE email = ANY($1::text[]) AND expiry_date <= now()"
+)
+
+async def get_expiring_subscriptions(warn_before, after, limit, pool):
+    """Страница подписок, истекающих в ближайшие warn_before секунд, без предупреждения; after - (expiry_date, id)"""
+    async with connection(pool) as conn:
+        return await fetch(conn, "get_expiring_subscriptions", float(warn_before), after[0], after[1], limit)
+
+async def get_expired_subscriptions(after, limit, pool):
+    """Страница истёкших, но ещё не отключённых подписок; after - (expiry_date, id)"""
+    async with connection(pool) as conn:
+        return await fetch(conn, "get_expired_subscriptions", after[0], after[1], limit)
+
+async def mark_warned(emails, warn_before, pool):
+    async with connection(pool) as conn:
+        await execute(conn, "mark_warned", list(emails), float(warn_before))
+
+async def mark_ended(emails, pool):
+    async with connection(pool) as conn:
+        await execute(conn, "mark_ended", list(emails))
+
+#-------------------------------------------------------------------------------------------------------------------------------------------
+#Reconciliation
+
+# Постраничная выборка по id: соединение пула занято только на время одной страницы
+register_query(
+    "get_subscriptions_page",
+    "SELECT id, tg_id, email, panel, expiry_date FROM users WHERE id > $1 ORDER BY id LIMIT $2"
+)
+register_query(
+    "get_subscription_expiry",
+    "SELECT expiry_date FROM users WHERE email = $1"
+)
+register_query(
+    "find_subscription_emails",
+    "SELECT email FROM users WHERE email = ANY($1::text[])"
+)
+
+async def get_subscriptions_page(after_id, limit, pool):
+    """Страница users с id больше after_id"""
+    async with connection(pool) as conn:
+        return await fetch(conn, "get_subscriptions_page", after_id, limit)
+
+async def get_subscription_expiry(email, pool):
+    """Текущий срок подписки; None, если строки нет или срок не задан"""
+    async with connection(pool) as conn:
+        return await fetchval(conn, "get_subscription_expiry", email)
+
+async def find_subscription_emails(emails, pool):
+    """Какие из переданных email есть в users"""
+    async with connection(pool) as conn:
+        rows = await fetch(conn, "find_subscription_emails", list(emails))
+        return {row["email"] for row in rows}
+
+#-------------------------------------------------------------------------------------------------------------------------------------------
+#Notification outbox
+
+register_query(
+    "enqueue_notifications",
+    "INSERT INTO notification_outbox (bot, chat_id, text) SELECT $1, unnest($2::text[]), unnest($3::text[])"
+)
+# Выдача пачки сообщений одному воркеру: строки сдвигаются на lease, чтобы после падения воркера их отправили снова
+register_query(
+    "claim_notifications",
+    """
+    UPDATE notification_outbox SET next_attempt_at = now() + make_interval(secs => $2)
+    WHERE id IN (
+        SELECT id FROM notification_outbox
+        WHERE status = 'pending' AND next_attempt_at <= now()
+        ORDER BY next_attempt_at, id
+        LIMIT $1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, bot, chat_id, text, attempts
+    """
+)
+# Текст после отправки не нужен, а в сообщениях о покупке есть пароль - не храним его
+register_query(
+    "mark_notification_sent",
+    "UPDATE notification_outbox SET status = 'sent', attempts = attempts + 1, sent_at = now(), text = '' WHERE id = $1"
+)
+register_query(
+    "retry_notification",
+    """
+    UPDATE notification_outbox
+    SET attempts = attempts + 1, last_error = $3,
+        next_attempt_at = COALESCE(now() + make_interval(secs => $2), next_attempt_at),
+        status = CASE WHEN $2 IS NULL THEN 'failed' ELSE 'pending' END,
+        text = CASE WHEN $2 IS NULL THEN '' ELSE text END
+    WHERE id = $1
+    """
+)
+
+async def enqueue_notifications(bot, chat_ids, texts, pool):
+    """Постановка сообщений в outbox одним запросом; в unit_of_work - вместе с остальными записями"""
+    async with connection(pool) as conn:
+        await execute(conn, "enqueue_notifications", bot, [str(chat_id) for chat_id in chat_ids], list(texts))
+
+async def claim_notifications(limit, lease_seconds, pool):
+    async with connection(pool) as conn:
+        return await fetch(conn, "claim_notifications", limit, float(lease_seconds))
+
+async def mark_notification_sent(notification_id, pool):
+    async with connection(pool) as conn:
+        await execute(conn, "mark_notification_sent", notification_id)
+
+async def retry_notification(notification_id, delay, error, pool):
+    """Повтор через delay секунд; delay=None - сообщение больше не отправлять"""
+    async with connection(pool) as conn:
+        await execute(conn, "retry_notification", notification_id, None if delay is None else float(delay), error)
+
+#-------------------------------------------------------------------------------------------------------------------------------------------
+#Client directory: где на панелях лежит клиент
+
+register_query(
+    "save_directory_entry",
+    """
+    INSERT INTO client_directory (email, panel, inbound_id, client_uuid, sub_id)
+    VALUES ($1, $2, $3, $4, $5)
+    ON CONFLICT (email, panel) DO UPDATE
+    SET inbound_id = EXCLUDED.inbound_id, client_uuid = EXCLUDED.client_uuid, sub_id = EXCLUDED.sub_id, updated_at = now()
+    """
+)
+register_query("get_directory_entries", "SELECT panel, inbound_id, client_uuid, sub_id FROM client_directory WHERE email = $1")
+
+async def save_directory_entry(email, panel, inbound_id, client_uuid, sub_id, pool):
+    async with connection(pool) as conn:
+        await execute(conn, "save_directory_entry", email, panel, inbound_id, client_uuid, sub_id)
+
+async def get_directory_entries(email, pool):
+    """{панель: запись} для клиента на всех панелях"""
+    async with connection(pool) as conn:
+        return {row["panel"]: row for row in await fetch(conn, "get_directory_entries", email)}
+
+#-------------------------------------------------------------------------------------------------------------------------------------------
+#Extension campaigns
+
+register_query("create_campaign", "INSERT INTO campaigns (description, days) VALUES ($1, $2) RETURNING id")
+# Целевой срок фиксируется при создании: повторное применение после сбоя его уже не меняет
+register_query(
+    "create_campaign_items",
+    """
+    WITH inserted AS (
+        INSERT INTO campaign_items (campaign_id, email, panel, target_expiry)
+        SELECT c.id, u.email, u.panel, GREATEST(u.expiry_date, c.created_at) + make_interval(days => c.days)
+        FROM users u, campaigns c
+        WHERE c.id = $1 AND u.expiry_date > $2
+          AND ($3::text IS NULL OR u.panel = $3)
+          AND (NOT $4 OR u.email NOT LIKE 'DE-FRA-TRIAL-%')
+        RETURNING 1
+    )
+    SELECT count(*) FROM inserted
+    """
+)
+register_query(
+    "claim_campaign",
+    """
+    UPDATE campaigns SET locked_until = now() + make_interval(secs => $2), status = 'running'
+    WHERE id = $1 AND status <> 'finished' AND (locked_until IS NULL OR locked_until < now())
+    RETURNING id, days, created_at
+    """
+)
+register_query("extend_campaign_lease", "UPDATE campaigns SET locked_until = now() + make_interval(secs => $2) WHERE id = $1")
+register_query(
+    "get_campaign_items",
+    """
+    SELECT email, panel, target_expiry, panel_targets FROM campaign_items
+    WHERE campaign_id = $1 AND status IN ('pending', 'failed') AND email > $2
+    ORDER BY email
+    LIMIT $3
+    """
+)
+register_query(
+    "get_directory_entries_bulk",
+    "SELECT email, panel, inbound_id, client_uuid FROM client_directory WHERE email = ANY($1::text[])"
+)
+# Тот же расчёт, что на панелях: срок, уже равный целевому, не меняется; продлённый после создания кампании
+# пользователем срок получает дни кампании сверху
+register_query(
+    "apply_campaign_items",
+    """
+    UPDATE users u
+    SET expiry_date = CASE WHEN u.expiry_date = i.target_expiry THEN u.expiry_date
+                           ELSE GREATEST(u.expiry_date, c.created_at) + make_interval(days => c.days) END,
+        warn = 0, ends = 0
+    FROM campaign_items i JOIN campaigns c ON c.id = i.campaign_id
+    WHERE i.campaign_id = $1 AND i.email = ANY($2::text[]) AND i.status <> 'done' AND u.email = i.email
+    """
+)
+register_query(
+    "record_campaign_panel_targets",
+    """
+    UPDATE campaign_items i SET panel_targets = i.panel_targets || jsonb_build_object($2::text, t.expiry)
+    FROM unnest($3::text[], $4::bigint[]) AS t (email, expiry)
+    WHERE i.campaign_id = $1 AND i.email = t.email
+    """
+)
+register_query(
+    "complete_campaign_items",
+    "UPDATE campaign_items SET status = 'done', error = NULL WHERE campaign_id = $1 AND email = ANY($2::text[])"
+)
+register_query(
+    "fail_campaign_items",
+    """
+    UPDATE campaign_items i SET status = 'failed', error = f.error
+    FROM unnest($2::text[], $3::text[]) AS f (email, error)
+    WHERE i.campaign_id = $1 AND i.email = f.email
+    """
+)
+register_query(
+    "finish_campaign",
+    """
+    UPDATE campaigns SET locked_until = NULL,
+        status = CASE WHEN EXISTS (SELECT 1 FROM campaign_items WHERE campaign_id = $1 AND status <> 'done')
+                      THEN 'incomplete' ELSE 'finished' END,
+        finished_at = now()
+    WHERE id = $1
+    RETURNING status
+    """
+)
+register_query(
+    "get_campaign",
+    """
+    SELECT c.id, c.description, c.days, c.status, c.created_at, c.finished_at,
+           count(i.email) AS total,
+           count(i.email) FILTER (WHERE i.status = 'done') AS done,
+           count(i.email) FILTER (WHERE i.status = 'failed') AS failed
+    FROM campaigns c LEFT JOIN campaign_items i ON i.campaign_id = c.id
+    WHERE c.id = $1
+    GROUP BY c.id
+    """
+)
+register_query("get_unfinished_campaigns", "SELECT id FROM campaigns WHERE status = 'running' ORDER BY id")
+
+async def create_campaign(description, days, active_after, panel, exclude_trials, pool):
+    """Кампания и её список подписок одной транзакцией; возвращает (id, количество подписок)"""
+    async with unit_of_work(pool) as conn:
+        campaign_id = await fetchval(conn, "create_campaign", description, days)
+        count = await fetchval(conn, "create_campaign_items", campaign_id, active_after, panel, exclude_trials)
+        return campaign_id, count
+
+async def claim_campaign(campaign_id, lease_seconds, pool):
+    """Захват кампании одним экземпляром приложения; None, если её уже выполняет другой"""
+    async with connection(pool) as conn:
+        return await fetchrow(conn, "claim_campaign", campaign_id, float(lease_seconds))
+
+async def extend_campaign_lease(campaign_id, lease_seconds, pool):
+    async with connection(pool) as conn:
+        await execute(conn, "extend_campaign_lease", campaign_id, float(lease_seconds))
+
+async def get_campaign_items(campaign_id, after_email, limit, pool):
+    """Пакет невыполненных подписок; panel_targets - {панель: срок в мс}, уже записанный на панель"""
+    async with connection(pool) as conn:
+        rows = await fetch(conn, "get_campaign_items", campaign_id, after_email, limit)
+    return [{**row, "panel_targets": json.loads(row["panel_targets"])} for row in rows]
+
+async def record_campaign_panel_targets(campaign_id, panel, targets, pool):
+    """Сроки {email: мс}, которые кампания сейчас запишет на панель: повтор после сбоя узнает по ним свою запись"""
+    async with connection(pool) as conn:
+        await execute(conn, "record_campaign_panel_targets", campaign_id, panel, list(targets), list(targets.values()))
+
+async def get_directory_entries_bulk(emails, pool):
+    async with connection(pool) as conn:
+        return await fetch(conn, "get_directory_entries_bulk", list(emails))
+
+async def complete_campaign_items(campaign_id, emails, pool):
+    """Новые сроки в users одним UPDATE и отметка о выполнении - одной транзакцией"""
+    async with unit_of_work(pool) as conn:
+        await execute(conn, "apply_campaign_items", campaign_id, list(emails))
+        await execute(conn, "complete_campaign_items", campaign_id, list(emails))
+
+async def fail_campaign_items(campaign_id, errors, pool):
+    """errors - {email: текст ошибки}"""
+    async with connection(pool) as conn:
+        await execute(conn, "fail_campaign_items", campaign_id, list(errors), list(errors.values()))
+
+async def finish_campaign(campaign_id, pool):
+    async with connection(pool) as conn:
+        return await fetchval(conn, "finish_campaign", campaign_id)
+
+async def get_campaign(campaign_id, pool):
+    async with connection(pool) as conn:
+        return await fetchrow(conn, "get_campaign", campaign_id)
+
+async def get_unfinished_campaigns(pool):
+    async with connection(pool) as conn:
+        return [row["id"] for row in await fetch(conn, "get_unfinished_campaigns")]
@@ -0,0 +1,150 @@
+"""Инвалидация кэшей между воркерами и хостами через Postgres LISTEN/NOTIFY"""
+import asyncio
+import json
+import logging
+import uuid
+from collections import deque
+
+import config as cfg
+import metrics
+from database import notify, listen
+
+INVALIDATION_CHANNEL = getattr(cfg, "INVALIDATION_CHANNEL", "cache_invalidation")
+# Пауза перед повторным подключением слушателя после обрыва, секунды
+INVALIDATION_RECONNECT_DELAY = getattr(cfg, "INVALIDATION_RECONNECT_DELAY", 5)
+# Проверка соединения слушателя: обрыв без закрытия сокета сам по себе не заметен
+INVALIDATION_PING_INTERVAL = getattr(cfg, "INVALIDATION_PING_INTERVAL", 30)
+# Событий в очереди на отправку, пока БД недоступна; старые вытесняются
+INVALIDATION_MAX_PENDING = getattr(cfg, "INVALIDATION_MAX_PENDING", 10000)
+
+# Предел Postgres на payload NOTIFY - 8000 байт, оставляем запас
+MAX_PAYLOAD = 7500
+# Событие "reset": слушатель переподключился и мог пропустить события, сбрасываются все кэши
+RESET = "reset"
+
+EVENTS = metrics.Counter("cache_invalidation_events_total", "Cache invalidation events", ("direction", "kind"))
+
+# Метка процесса: свои события, вернувшиеся через канал, не применяются повторно
+_instance = uuid.uuid4().hex
+# kind -> [обработчик(event)]
+_handlers = {}
+# None, пока не запущен run: без отправителя события не копятся
+_pending = None
+_wakeup = None
+
+
+def subscribe(kind, handler):
+    """Обработчик событий kind от других экземпляров"""
+    _handlers.setdefault(kind, []).append(handler)
+
+
+def publish(kind, **fields):
+    """Событие для других экземпляров; отправляется в фоне после локального изменения"""
+    if _pending is None:
+        return
+    _pending.append({"kind": kind, **fields})
+    _wakeup.set()
+
+
+def _payloads(events):
+    """События пачками, каждая в пределах MAX_PAYLOAD"""
+    empty = len(_envelope([]))
+    chunk, size = [], empty
+    for event in events:
+        encoded = json.dumps(event, ensure_ascii=False, separators=(",", ":"))
+        length = len(encoded.encode()) + 1
+        if empty + length > MAX_PAYLOAD:
+            logging.warning(f"Событие инвалидации {event['kind']} не помещается в NOTIFY, пропущено")
+            continue
+        if chunk and size + length > MAX_PAYLOAD:
+            yield _envelope(chunk)
+            chunk, size = [], empty
+        chunk.append(encoded)
+        size += length
+    if chunk:
+        yield _envelope(chunk)
+
+
+def _envelope(encoded_events):
+    return f'{{"origin":"{_instance}","events":[{",".join(encoded_events)}]}}'
+
+
+def _dispatch(event):
+    kind = event.get("kind")
+    EVENTS.inc("received", kind)
+    for handler in _handlers.get(kind, ()):
+        try:
+            handler(event)
+        except Exception as e:
+            logging.error(f"Ошибка обработки события инвалидации {kind}: {e}")
+
+
+def _on_notification(payload):
+    try:
+        message = json.loads(payload)
+    except ValueError:
+        logging.warning("Некорректное уведомление в канале инвалидации")
+        return
+    if message.get("origin") == _instance:
+        return
+    for event in message.get("events", ()):
+        _dispatch(event)
+
+
+async def _send(pool):
+    while True:
+        await _wakeup.wait()
+        _wakeup.clear()
+        events = list(_pending)
+        _pending.clear()
+        try:
+            await notify(INVALIDATION_CHANNEL, list(_payloads(events)), pool)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Остальные воркеры увидят изменения по истечении TTL своих кэшей
+            logging.error(f"Не удалось отправить {len(events)} событий инвалидации: {e}")
+            continue
+        for event in events:
+            EVENTS.inc("sent", event["kind"])
+
+
+async def _listen():
+    reconnected = False
+    while True:
+        lost = asyncio.Event()
+        conn = None
+        try:
+            conn = await listen(INVALIDATION_CHANNEL, _on_notification, lost.set)
+            logging.info(f"Слушатель инвалидации подключён к каналу {INVALIDATION_CHANNEL}")
+            if reconnected:
+                # Пока соединения не было, события других экземпляров терялись
+                _dispatch({"kind": RESET})
+            while not lost.is_set():
+                try:
+                    await asyncio.wait_for(lost.wait(), INVALIDATION_PING_INTERVAL)
+                except asyncio.TimeoutError:
+                    await conn.execute("SELECT 1")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Ошибка слушателя инвалидации: {e}")
+        finally:
+            if conn is not None and not conn.is_closed():
+                conn.terminate()
+        logging.warning(f"Слушатель инвалидации отключён, переподключение через {INVALIDATION_RECONNECT_DELAY} с")
+        reconnected = True
+        await asyncio.sleep(INVALIDATION_RECONNECT_DELAY)
+
+
+async def run(pool):
+    """Отправка своих событий и приём событий других экземпляров; запускается в lifespan"""
+    global _pending, _wakeup
+    _pending = deque(maxlen=INVALIDATION_MAX_PENDING)
+    _wakeup = asyncio.Event()
+    sender = asyncio.create_task(_send(pool))
+    try:
+        await _listen()
+    finally:
+        sender.cancel()
+        _pending = _wakeup = None
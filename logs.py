@@ -0,0 +1,114 @@
+"""Логирование через очередь: запись и форматирование в отдельном потоке, JSON, маскирование секретов, сэмплирование"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import sys
+from datetime import datetime, timezone
+
+import config as cfg
+
+LOG_LEVEL = getattr(cfg, "LOG_LEVEL", "INFO")
+# JSON-строки для сборщика логов; False - обычный текст
+LOG_JSON = getattr(cfg, "LOG_JSON", True)
+# Доля записей частых сообщений, попадающих в лог; сообщение помечается через extra={"sample": True}
+LOG_SAMPLE_RATE = getattr(cfg, "LOG_SAMPLE_RATE", 0.05)
+
+MASK = "***"
+# Поля, значения которых никогда не пишутся в лог
+SECRET_FIELDS = ("password", "passwd", "secret", "token", "init_data", "initData", "hash", "authorization",
+                 "api_key", "x-admin-key", "loginSecret", "twoFactorCode")
+_SECRET_PATTERNS = [
+    re.compile(r"(?i)(bearer\s+)[A-Za-z0-9._~+/=-]+"),
+    # key=value, key: value, "key": "value" и 'key': 'value'
+    re.compile(r"""(?i)(["']?(?:%s)["']?\s*[:=]\s*)(["']?)[^\s,;&'"}]+\2""" % "|".join(map(re.escape, SECRET_FIELDS))),
+    # Токены ботов Telegram, в том числе внутри URL api.telegram.org/bot<token>/
+    re.compile(r"(?<!\d)\d{6,}:[A-Za-z0-9_-]{30,}"),
+    # Логины и пароли из заказов товаров
+    re.compile(r"(?im)^((?:Логин|Пароль):\s*).+$"),
+]
+
+_listener = None
+
+
+def redact(text):
+    for pattern in _SECRET_PATTERNS:
+        text = pattern.sub(lambda m: (m.group(1) if m.re.groups else "") + MASK, text)
+    return text
+
+
+def _redact_value(key, value):
+    if any(field.lower() in key.lower() for field in SECRET_FIELDS):
+        return MASK
+    return redact(value) if isinstance(value, str) else value
+
+
+# Атрибуты LogRecord, которые не считаются пользовательскими полями из extra
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "sample"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": redact(record.getMessage()),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = _redact_value(key, value)
+        if record.exc_info:
+            entry["exc"] = redact(self.formatException(record.exc_info))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RedactingFormatter(logging.Formatter):
+    def format(self, record):
+        return redact(super().format(record))
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает только LOG_SAMPLE_RATE записей, помеченных extra={"sample": True}; предупреждения и ошибки - все"""
+
+    def filter(self, record):
+        if getattr(record, "sample", False) and record.levelno < logging.WARNING:
+            return random.random() < LOG_SAMPLE_RATE
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Стандартный prepare форматирует сообщение в вызывающем потоке; здесь это делает поток записи
+        return record
+
+
+def setup_logging():
+    """Корневой логгер пишет в очередь, форматирование и вывод в stdout - в фоновом потоке"""
+    global _listener
+    if _listener is not None:
+        return
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if LOG_JSON else RedactingFormatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    log_queue = queue.SimpleQueue()
+    handler = _QueueHandler(log_queue)
+    handler.addFilter(SamplingFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    # httpx пишет INFO на каждый запрос к панелям, YooKassa и Telegram
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Дописывает оставшиеся в очереди записи"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
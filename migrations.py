@@ -0,0 +1,215 @@
+"""Версионированные миграции схемы базы данных"""
+import logging
+
+# Произвольный ключ advisory-блокировки: миграции выполняет только один экземпляр приложения
+MIGRATIONS_LOCK_KEY = 730519
+
+
+def _to_timestamptz(table, column):
+    """Перевод текстовой даты "%Y-%m-%d %H:%M:%S" (UTC) в timestamptz, если колонка ещё text или varchar"""
+    return f"""
+        DO $$
+        BEGIN
+            IF (SELECT data_type FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = '{table}' AND column_name = '{column}')
+                IN ('text', 'character varying') THEN
+                ALTER TABLE {table} ALTER COLUMN {column} TYPE TIMESTAMPTZ
+                    USING NULLIF({column}, '')::timestamp AT TIME ZONE 'UTC';
+            END IF;
+        END $$
+    """
+
+
+# (версия, описание, список SQL-запросов); применённые миграции не изменяются, только добавляются новые
+MIGRATIONS = [
+    (1, "base schema", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            tg_id TEXT,
+            email TEXT,
+            panel TEXT,
+            expiry_date TIMESTAMPTZ,
+            warn INTEGER DEFAULT 0,
+            ends INTEGER DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS payments (
+            id SERIAL PRIMARY KEY,
+            telegram_id TEXT,
+            label TEXT,
+            operation_type TEXT,
+            payment_time TIMESTAMPTZ,
+            amount NUMERIC,
+            email TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS trials (
+            tg_id TEXT,
+            status INTEGER
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS referrals (
+            referrer_id TEXT,
+            referee_id TEXT,
+            bonus_applied INTEGER DEFAULT 0,
+            bonus_date TIMESTAMPTZ
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS products (
+            id SERIAL PRIMARY KEY,
+            tg_id TEXT,
+            product TEXT,
+            login TEXT,
+            expiry_date TIMESTAMPTZ
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS payment_events (
+            id BIGSERIAL PRIMARY KEY,
+            payment_id TEXT NOT NULL,
+            event TEXT NOT NULL,
+            status TEXT NOT NULL,
+            payload JSONB,
+            received_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            UNIQUE (payment_id, event)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS payment_fulfillments (
+            payment_id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL,
+            result JSONB,
+            claimed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            fulfilled_at TIMESTAMPTZ,
+            target_expiry TIMESTAMPTZ
+        )
+        """,
+    ]),
+    (2, "native timestamps", [
+        _to_timestamptz("users", "expiry_date"),
+        _to_timestamptz("payments", "payment_time"),
+        _to_timestamptz("referrals", "bonus_date"),
+        _to_timestamptz("products", "expiry_date"),
+    ]),
+    (3, "lookup indexes", [
+        "CREATE INDEX IF NOT EXISTS users_email_idx ON users (email)",
+        "CREATE INDEX IF NOT EXISTS users_tg_id_idx ON users (tg_id)",
+        "CREATE INDEX IF NOT EXISTS users_expiry_date_idx ON users (expiry_date)",
+        "CREATE INDEX IF NOT EXISTS trials_tg_id_idx ON trials (tg_id)",
+        "CREATE INDEX IF NOT EXISTS referrals_referrer_referee_idx ON referrals (referrer_id, referee_id)",
+        "CREATE INDEX IF NOT EXISTS products_login_product_idx ON products (login, product)",
+        "CREATE INDEX IF NOT EXISTS products_expiry_date_idx ON products (expiry_date)",
+        "CREATE INDEX IF NOT EXISTS payments_label_idx ON payments (label)",
+    ]),
+    (4, "unique upsert keys", [
+        # В рабочей схеме, созданной до миграций, у users и products может не быть id: на нём держатся
+        # удаление дубликатов ниже и ключ (expiry_date, id) планировщика. Без id эта миграция не применялась
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS id SERIAL",
+        "ALTER TABLE products ADD COLUMN IF NOT EXISTS id SERIAL",
+        # Дубликаты из времён SELECT-then-INSERT: оставляем последнюю запись
+        "DELETE FROM users a USING users b WHERE a.email = b.email AND a.id < b.id",
+        "DELETE FROM products a USING products b WHERE a.login = b.login AND a.product = b.product AND a.id < b.id",
+        "DROP INDEX IF EXISTS users_email_idx",
+        "DROP INDEX IF EXISTS products_login_product_idx",
+        "CREATE UNIQUE INDEX users_email_key ON users (email)",
+        "CREATE UNIQUE INDEX products_login_product_key ON products (login, product)",
+    ]),
+    (5, "expiry scheduler indexes", [
+        "UPDATE users SET warn = 0 WHERE warn IS NULL",
+        "UPDATE users SET ends = 0 WHERE ends IS NULL",
+        "CREATE INDEX users_warn_pending_idx ON users (expiry_date, id) WHERE warn = 0",
+        "CREATE INDEX users_ends_pending_idx ON users (expiry_date, id) WHERE ends = 0",
+    ]),
+    (6, "notification outbox", [
+        """
+        CREATE TABLE notification_outbox (
+            id BIGSERIAL PRIMARY KEY,
+            bot TEXT NOT NULL,
+            chat_id TEXT NOT NULL,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            last_error TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            sent_at TIMESTAMPTZ
+        )
+        """,
+        "CREATE INDEX notification_outbox_pending_idx ON notification_outbox (next_attempt_at, id) WHERE status = 'pending'",
+    ]),
+    (7, "client directory", [
+        """
+        CREATE TABLE client_directory (
+            email TEXT NOT NULL,
+            panel TEXT NOT NULL,
+            inbound_id INTEGER NOT NULL,
+            client_uuid TEXT NOT NULL,
+            sub_id TEXT,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (email, panel)
+        )
+        """,
+    ]),
+    (8, "extension campaigns", [
+        """
+        CREATE TABLE campaigns (
+            id SERIAL PRIMARY KEY,
+            description TEXT,
+            days INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            locked_until TIMESTAMPTZ,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            finished_at TIMESTAMPTZ
+        )
+        """,
+        """
+        CREATE TABLE campaign_items (
+            campaign_id INTEGER NOT NULL REFERENCES campaigns (id),
+            email TEXT NOT NULL,
+            panel TEXT NOT NULL,
+            target_expiry TIMESTAMPTZ NOT NULL,
+            -- {панель: срок в мс}, записанный кампанией на панель; сохраняется до записи на панель
+            panel_targets JSONB NOT NULL DEFAULT '{}',
+            status TEXT NOT NULL DEFAULT 'pending',
+            error TEXT,
+            PRIMARY KEY (campaign_id, email)
+        )
+        """,
+    ]),
+]
+
+
+async def migrate(pool):
+    """Применение недостающих миграций, каждая в своей транзакции"""
+    async with pool.acquire() as conn:
+        await conn.execute("SELECT pg_advisory_lock($1)", MIGRATIONS_LOCK_KEY)
+        try:
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+                """
+            )
+            applied = {row["version"] for row in await conn.fetch("SELECT version FROM schema_migrations")}
+            for version, description, statements in MIGRATIONS:
+                if version in applied:
+                    continue
+                async with conn.transaction():
+                    for statement in statements:
+                        await conn.execute(statement)
+                    await conn.execute(
+                        "INSERT INTO schema_migrations (version, description) VALUES ($1, $2)",
+                        version, description
+                    )
+                logging.info(f"Миграция {version} применена: {description}")
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK_KEY)
@@ -0,0 +1,192 @@
+"""Отправка сообщений Telegram из outbox в БД с ограничением частоты и повторами.
+Ограничения частоты считаются в памяти процесса, поэтому outbox отправляет один воркер на всё развёртывание -
+тот, что держит advisory-блокировку NOTIFY_LOCK_KEY; остальные ждут её освобождения"""
+import asyncio
+import logging
+import time
+from collections import defaultdict
+
+import httpx
+
+import config as cfg
+from database import claim_notifications, mark_notification_sent, retry_notification, advisory_lock
+
+# Боты, от имени которых отправляются сообщения
+BOTS = {
+    "order": cfg.ORDER_BOT_TOKEN,
+    "main": cfg.MAIN_API_TOKEN,
+}
+
+# Ограничения Telegram: около 30 сообщений в секунду на бота и 1 в секунду в один чат
+TELEGRAM_GLOBAL_RATE = getattr(cfg, "TELEGRAM_GLOBAL_RATE", 30)
+TELEGRAM_CHAT_RATE = getattr(cfg, "TELEGRAM_CHAT_RATE", 1)
+TELEGRAM_TIMEOUT = getattr(cfg, "TELEGRAM_TIMEOUT", 10)
+# Сообщений, забираемых из outbox за раз, и одновременных отправок в разные чаты
+NOTIFY_BATCH_SIZE = getattr(cfg, "NOTIFY_BATCH_SIZE", 100)
+NOTIFY_CONCURRENCY = getattr(cfg, "NOTIFY_CONCURRENCY", 10)
+# Период опроса outbox, если воркер не разбудили раньше
+NOTIFY_POLL_INTERVAL = getattr(cfg, "NOTIFY_POLL_INTERVAL", 5)
+# Через сколько секунд забранное, но не отправленное сообщение снова станет доступно
+NOTIFY_LEASE = getattr(cfg, "NOTIFY_LEASE", 120)
+NOTIFY_MAX_ATTEMPTS = getattr(cfg, "NOTIFY_MAX_ATTEMPTS", 8)
+NOTIFY_BACKOFF_BASE = getattr(cfg, "NOTIFY_BACKOFF_BASE", 2)
+NOTIFY_BACKOFF_MAX = getattr(cfg, "NOTIFY_BACKOFF_MAX", 600)
+NOTIFY_LOCK_KEY = 730521
+
+# Ответы, после которых повтор бессмысленен: неверный запрос, бот заблокирован, чат не найден
+PERMANENT_STATUSES = {400, 401, 403, 404}
+
+_wakeup = asyncio.Event()
+_http = None
+
+
+class TokenBucket:
+    """Не больше rate событий в секунду с запасом capacity"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+_global_buckets = defaultdict(lambda: TokenBucket(TELEGRAM_GLOBAL_RATE))
+_chat_buckets = {}
+
+
+def _chat_bucket(bot, chat_id):
+    key = (bot, chat_id)
+    bucket = _chat_buckets.get(key)
+    if bucket is None:
+        if len(_chat_buckets) > 10000:
+            # Полные корзины ничего не ограничивают, их можно выбросить
+            now = time.monotonic()
+            for stale in [k for k, b in _chat_buckets.items() if now - b.updated_at > b.capacity / b.rate]:
+                del _chat_buckets[stale]
+        bucket = _chat_buckets[key] = TokenBucket(TELEGRAM_CHAT_RATE)
+    return bucket
+
+
+def wake():
+    """Разбудить воркер после коммита транзакции, добавившей сообщения"""
+    _wakeup.set()
+
+
+def _client():
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(
+            base_url="https://api.telegram.org/",
+            timeout=TELEGRAM_TIMEOUT,
+            limits=httpx.Limits(max_connections=NOTIFY_CONCURRENCY),
+        )
+    return _http
+
+
+async def close():
+    global _http
+    if _http is not None:
+        await _http.aclose()
+        _http = None
+
+
+def _backoff(attempts):
+    return min(NOTIFY_BACKOFF_BASE * 2 ** attempts, NOTIFY_BACKOFF_MAX)
+
+
+async def _send(row, pool):
+    bot, chat_id = row["bot"], row["chat_id"]
+    await _chat_bucket(bot, chat_id).acquire()
+    await _global_buckets[bot].acquire()
+    try:
+        response = await _client().post(
+            f"bot{BOTS[bot]}/sendMessage", json={"chat_id": chat_id, "text": row["text"]}
+        )
+    except httpx.TransportError as e:
+        error, delay = str(e) or type(e).__name__, _backoff(row["attempts"])
+    else:
+        if response.status_code == 200:
+            await mark_notification_sent(row["id"], pool)
+            return
+        error = f"HTTP {response.status_code}: {response.text[:200]}"
+        if response.status_code in PERMANENT_STATUSES:
+            delay = None
+        elif response.status_code == 429:
+            # Telegram сам говорит, сколько ждать
+            try:
+                delay = response.json()["parameters"]["retry_after"]
+            except (ValueError, KeyError, TypeError):
+                delay = _backoff(row["attempts"])
+        else:
+            delay = _backoff(row["attempts"])
+    if row["attempts"] + 1 >= NOTIFY_MAX_ATTEMPTS:
+        delay = None
+    logging.warning(f"Сообщение {row['id']} в чат {chat_id} не отправлено: {error}"
+                    + (f", повтор через {delay} с" if delay is not None else ", отправка прекращена"))
+    await retry_notification(row["id"], delay, error, pool)
+
+
+async def deliver(pool):
+    """Отправка одной пачки из outbox; сообщения одного чата уходят по порядку. Возвращает размер пачки"""
+    rows = await claim_notifications(NOTIFY_BATCH_SIZE, NOTIFY_LEASE, pool)
+    by_chat = defaultdict(list)
+    for row in rows:
+        by_chat[(row["bot"], row["chat_id"])].append(row)
+    semaphore = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+
+    async def send_chat(chat_rows):
+        async with semaphore:
+            for row in chat_rows:
+                try:
+                    await _send(row, pool)
+                except Exception as e:
+                    # Сообщение вернётся в работу после истечения lease
+                    logging.error(f"Ошибка при отправке сообщения {row['id']}: {e}")
+
+    await asyncio.gather(*(send_chat(chat_rows) for chat_rows in by_chat.values()))
+    return len(rows)
+
+
+async def _deliver_while_locked(pool, lock_connection):
+    """Отправка, пока жива сессия с блокировкой: с обрывом соединения Postgres снимает блокировку,
+    и отправителем может стать другой воркер"""
+    while True:
+        # Обрыв без закрытия сокета сам по себе не заметен; ошибка здесь завершает работу отправителя
+        await lock_connection.fetchval("SELECT 1")
+        try:
+            if await deliver(pool) == NOTIFY_BATCH_SIZE:
+                continue
+        except Exception as e:
+            logging.error(f"Ошибка воркера уведомлений: {e}")
+        try:
+            await asyncio.wait_for(_wakeup.wait(), NOTIFY_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
+
+
+async def run(pool):
+    """Фоновая отправка сообщений из outbox; запускается в каждом воркере, отправляет только держатель блокировки"""
+    try:
+        while True:
+            try:
+                async with advisory_lock(NOTIFY_LOCK_KEY) as lock_connection:
+                    if lock_connection is not None:
+                        await _deliver_while_locked(pool, lock_connection)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Ошибка блокировки воркера уведомлений: {e}")
+            await asyncio.sleep(NOTIFY_POLL_INTERVAL)
+    finally:
+        await close()
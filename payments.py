@@ -0,0 +1,176 @@
+"""Асинхронный шлюз платежей YooKassa на общем пуле соединений httpx"""
+import asyncio
+import ipaddress
+import logging
+import time
+import uuid
+from types import SimpleNamespace
+
+import httpx
+
+import config as cfg
+import metrics
+
+YOOKASSA_API_URL = "https://api.yookassa.ru/v3/"
+YOOKASSA_TIMEOUT = getattr(cfg, "YOOKASSA_TIMEOUT", 10)
+YOOKASSA_CONNECT_TIMEOUT = getattr(cfg, "YOOKASSA_CONNECT_TIMEOUT", 5)
+YOOKASSA_RETRIES = getattr(cfg, "YOOKASSA_RETRIES", 2)
+YOOKASSA_MAX_CONNECTIONS = getattr(cfg, "YOOKASSA_MAX_CONNECTIONS", 20)
+# yookassa | fake
+PAYMENT_GATEWAY = getattr(cfg, "PAYMENT_GATEWAY", "yookassa")
+
+# 202 - YooKassa ещё обрабатывает запрос и просит повторить его позже
+RETRY_STATUSES = {202, 429, 500, 502, 503, 504}
+
+# Адреса, с которых YooKassa отправляет HTTP-уведомления
+YOOKASSA_WEBHOOK_NETWORKS = [
+    ipaddress.ip_network(network) for network in getattr(cfg, "YOOKASSA_WEBHOOK_IPS", [
+        "185.71.76.0/27",
+        "185.71.77.0/27",
+        "77.75.153.0/25",
+        "77.75.156.11/32",
+        "77.75.156.35/32",
+        "77.75.154.128/25",
+        "2a02:5180::/32",
+    ])
+]
+
+
+def is_yookassa_address(address):
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in YOOKASSA_WEBHOOK_NETWORKS)
+
+
+# Поля metadata, которые не сохраняются в журнале событий платежей
+SECRET_METADATA = {"password"}
+
+
+class PaymentInfo:
+    """Платёж YooKassa с тем же доступом к полям, что и у yookassa.Payment"""
+
+    def __init__(self, data):
+        self.data = data
+        self.id = data["id"]
+        self.status = data["status"]
+        self.paid = data.get("paid", False)
+        self.amount = SimpleNamespace(**data["amount"])
+        confirmation = data.get("confirmation")
+        self.confirmation = SimpleNamespace(**confirmation) if confirmation else None
+        self.metadata = data.get("metadata") or {}
+
+    def audit_payload(self):
+        """Поля платежа для журнала payment_events: без секретов из metadata (пароль товара)"""
+        return {
+            "id": self.id,
+            "status": self.status,
+            "paid": self.paid,
+            "amount": self.data["amount"],
+            "metadata": {key: value for key, value in self.metadata.items() if key not in SECRET_METADATA},
+        }
+
+
+class YooKassaGateway:
+    def __init__(self, shop_id, secret_key):
+        self._auth = (str(shop_id), secret_key)
+        self._http = None
+
+    @property
+    def http(self):
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                base_url=YOOKASSA_API_URL,
+                auth=self._auth,
+                timeout=httpx.Timeout(YOOKASSA_TIMEOUT, connect=YOOKASSA_CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_connections=YOOKASSA_MAX_CONNECTIONS),
+            )
+        return self._http
+
+    async def _request(self, method, path, operation, json=None, idempotence_key=None):
+        # Повтор POST безопасен: YooKassa не выполнит запрос дважды с одним Idempotence-Key
+        headers = {"Idempotence-Key": idempotence_key} if idempotence_key else {}
+        for attempt in range(YOOKASSA_RETRIES + 1):
+            started = time.perf_counter()
+            try:
+                response = await self.http.request(method, path, json=json, headers=headers)
+                if response.status_code not in RETRY_STATUSES:
+                    response.raise_for_status()
+                    return response.json()
+                error = f"HTTP {response.status_code}"
+            except httpx.TransportError as e:
+                error = str(e) or type(e).__name__
+            except httpx.HTTPStatusError:
+                metrics.YOOKASSA_ERRORS.inc(operation)
+                raise
+            finally:
+                metrics.YOOKASSA_LATENCY.observe(time.perf_counter() - started, operation)
+            metrics.YOOKASSA_ERRORS.inc(operation)
+            if attempt == YOOKASSA_RETRIES:
+                raise ConnectionError(f"YooKassa {method} {path} не выполнен: {error}")
+            logging.warning(f"YooKassa {method} {path}: {error}, повтор {attempt + 1} из {YOOKASSA_RETRIES}")
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+    async def create(self, params, idempotence_key=None):
+        data = await self._request("POST", "payments", "create", json=params,
+                                   idempotence_key=idempotence_key or str(uuid.uuid4()))
+        return PaymentInfo(data)
+
+    async def find_one(self, payment_id):
+        return PaymentInfo(await self._request("GET", f"payments/{payment_id}", "find_one"))
+
+    async def cancel(self, payment_id, idempotence_key=None):
+        data = await self._request("POST", f"payments/{payment_id}/cancel", "cancel", json={},
+                                   idempotence_key=idempotence_key or str(uuid.uuid4()))
+        return PaymentInfo(data)
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+
+class FakeGateway:
+    """Локальная реализация для тестов: платежи хранятся в памяти"""
+
+    def __init__(self):
+        self.payments = {}
+
+    async def create(self, params, idempotence_key=None):
+        payment_id = str(uuid.uuid4())
+        self.payments[payment_id] = {
+            "id": payment_id,
+            "status": "pending",
+            "paid": False,
+            "amount": dict(params["amount"]),
+            "confirmation": {"type": "redirect", "confirmation_url": f"https://yookassa.local/checkout/{payment_id}"},
+            "metadata": dict(params.get("metadata") or {}),
+        }
+        return PaymentInfo(self.payments[payment_id])
+
+    async def find_one(self, payment_id):
+        if payment_id not in self.payments:
+            raise LookupError(f"Payment {payment_id} not found")
+        return PaymentInfo(self.payments[payment_id])
+
+    async def cancel(self, payment_id, idempotence_key=None):
+        return self.set_status(payment_id, "canceled")
+
+    def set_status(self, payment_id, status):
+        payment = self.payments[payment_id]
+        payment["status"] = status
+        payment["paid"] = status == "succeeded"
+        return PaymentInfo(payment)
+
+    async def close(self):
+        pass
+
+
+def create_gateway():
+    if PAYMENT_GATEWAY == "fake":
+        return FakeGateway()
+    return YooKassaGateway(cfg.YOOKASSA_SHOP_ID, cfg.YOOKASSA_SECRET_KEY)
+
+
+gateway = create_gateway()
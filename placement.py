@@ -0,0 +1,146 @@
+"""Выбор панели для новых подписок по фоновым замерам нагрузки"""
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+
+import client_index
+import config as cfg
+
+# Период фонового замера нагрузки панелей
+LOAD_SAMPLE_INTERVAL = getattr(cfg, "LOAD_SAMPLE_INTERVAL", 30)
+# Панель без успешного замера дольше этого времени считается нездоровой
+LOAD_SAMPLE_MAX_AGE = getattr(cfg, "LOAD_SAMPLE_MAX_AGE", 180)
+# Сколько неудачных замеров подряд панель выдерживает на последнем удачном; отключённую автоматом
+# панель choose_panel исключает сразу
+LOAD_SAMPLE_MAX_FAILURES = getattr(cfg, "LOAD_SAMPLE_MAX_FAILURES", 3)
+# least_active | weighted_capacity | round_robin
+PLACEMENT_POLICY = getattr(cfg, "PLACEMENT_POLICY", "least_active")
+# Ёмкость панели по умолчанию (активных клиентов), если в PANELS не задан ключ "capacity"
+DEFAULT_PANEL_CAPACITY = getattr(cfg, "DEFAULT_PANEL_CAPACITY", 1000)
+
+# Последний удачный замер по имени панели и число неудачных после него:
+# {"active": int, "online": int, "traffic_rate": байт/с, "sampled_at": monotonic, "failures": int}
+_loads = {}
+# (loaded_at снимка, суммарный трафик) для расчёта скорости между замерами
+_traffic_marks = {}
+_round_robin_position = 0
+
+
+def _is_active(client, now_ms):
+    # expiry_time <= 0: бессрочный клиент или отсчёт с первого подключения
+    return client.enable and (client.expiry_time <= 0 or client.expiry_time > now_ms)
+
+
+async def _online(panel):
+    """Число клиентов онлайн; None, если панель его не отдала - замер без него остаётся удачным"""
+    try:
+        return len(await panel["api"].client.online())
+    except Exception as e:
+        logging.warning(f"Не удалось получить клиентов онлайн на панели {panel['name']}: {e}")
+        return None
+
+
+async def sample(panel):
+    """Замер нагрузки одной панели: активные клиенты, онлайн и скорость трафика"""
+    name = panel["name"]
+    previous_load = _loads.get(name)
+    try:
+        snapshot, online = await asyncio.gather(client_index.get_snapshot(panel), _online(panel))
+    except Exception as e:
+        logging.error(f"Ошибка при замере нагрузки панели {name}: {e}")
+        if previous_load is None:
+            # Удачного замера ещё не было: до LOAD_SAMPLE_MAX_FAILURES неудач панель считается пустой
+            _loads[name] = previous_load = {"active": 0, "online": 0, "traffic_rate": 0.0,
+                                            "sampled_at": time.monotonic(), "failures": 0}
+        previous_load["failures"] += 1
+        return
+    if online is None:
+        online = previous_load["online"] if previous_load else 0
+
+    now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+    active = sum(1 for _, client in snapshot.by_email.values() if _is_active(client, now_ms))
+
+    traffic_rate = previous_load["traffic_rate"] if previous_load else 0.0
+    previous = _traffic_marks.get(name)
+    if previous and snapshot.loaded_at > previous[0]:
+        # Счётчики могут сбрасываться на панели, отрицательную разницу не учитываем
+        traffic_rate = max(snapshot.traffic - previous[1], 0) / (snapshot.loaded_at - previous[0])
+    _traffic_marks[name] = (snapshot.loaded_at, snapshot.traffic)
+
+    _loads[name] = {
+        "active": active,
+        "online": online,
+        "traffic_rate": traffic_rate,
+        "sampled_at": time.monotonic(),
+        "failures": 0,
+    }
+
+
+async def run_sampler(panels):
+    """Фоновый замер нагрузки всех панелей"""
+    while True:
+        await asyncio.gather(*(sample(panel) for panel in panels))
+        await asyncio.sleep(LOAD_SAMPLE_INTERVAL)
+
+
+def get_load(name):
+    return _loads.get(name)
+
+
+def _is_healthy(load):
+    return (bool(load) and load["failures"] < LOAD_SAMPLE_MAX_FAILURES
+            and time.monotonic() - load["sampled_at"] < LOAD_SAMPLE_MAX_AGE)
+
+
+#-------------------------------------------------------------------------------------------------------------------------------------------
+#Policies: получают непустой список (panel, load) здоровых панелей и возвращают одну панель.
+#При равной загрузке выбирается панель с меньшим трафиком за последний интервал замера
+
+def least_active(candidates):
+    return min(candidates, key=lambda item: (item[1]["active"], item[1]["online"], item[1]["traffic_rate"]))[0]
+
+
+def weighted_capacity(candidates):
+    def utilization(item):
+        panel, load = item
+        capacity = panel.get("capacity", DEFAULT_PANEL_CAPACITY)
+        return load["active"] / capacity if capacity > 0 else float("inf")
+    return min(candidates, key=lambda item: (utilization(item), item[1]["traffic_rate"]))[0]
+
+
+def round_robin(candidates):
+    global _round_robin_position
+    _round_robin_position += 1
+    return candidates[_round_robin_position % len(candidates)][0]
+
+
+POLICIES = {
+    "least_active": least_active,
+    "weighted_capacity": weighted_capacity,
+    "round_robin": round_robin,
+}
+
+
+def register_policy(name, policy):
+    POLICIES[name] = policy
+
+
+def choose_panel(panels, policy=None):
+    """Выбор панели для нового клиента без запросов к панелям"""
+    if not panels:
+        return None
+    if not _loads:
+        # Первый замер ещё не завершён: первая панель, не отключённая автоматом
+        return next((panel for panel in panels if panel["api"].breaker.available()), None)
+    # Отключённая автоматом панель исключается сразу, не дожидаясь следующего замера
+    candidates = [
+        (panel, _loads[panel["name"]]) for panel in panels
+        if _is_healthy(_loads.get(panel["name"])) and panel["api"].breaker.available()
+    ]
+    if not candidates:
+        return None
+    panel = POLICIES[policy or PLACEMENT_POLICY](candidates)
+    # Учитываем размещение до следующего замера, чтобы всплеск покупок не ушёл на одну панель
+    _loads[panel["name"]]["active"] += 1
+    return panel
@@ -0,0 +1,184 @@
+"""Сверка таблицы users с клиентами на панелях"""
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+import client_index
+import config as cfg
+from database import get_subscriptions_page, get_subscription_expiry, find_subscription_emails
+from xui_utils import PANELS, SUB_PANELS, PANEL_DEADLINE, add_client, get_panel_by_name, inbound_lock
+
+# Строк users на одной странице выборки, она же пакет сверки
+RECONCILE_BATCH_SIZE = getattr(cfg, "RECONCILE_BATCH_SIZE", 500)
+# Одновременных исправлений на панелях в режиме repair
+RECONCILE_CONCURRENCY = getattr(cfg, "RECONCILE_CONCURRENCY", 10)
+# Допустимое расхождение срока подписки между БД и панелью, секунды
+RECONCILE_EXPIRY_TOLERANCE = getattr(cfg, "RECONCILE_EXPIRY_TOLERANCE", 60)
+# Сколько примеров расхождений включать в отчёт
+RECONCILE_REPORT_SAMPLES = getattr(cfg, "RECONCILE_REPORT_SAMPLES", 100)
+
+DRIFT_KINDS = ("missing_on_panel", "missing_on_sub_panel", "expiry_mismatch", "orphan_client")
+
+_lock = asyncio.Lock()
+
+
+def is_running():
+    return _lock.locked()
+
+
+def _to_ms(dt):
+    return int(dt.timestamp() * 1000)
+
+
+class Report:
+    """Счётчики расхождений и ограниченный список примеров, чтобы отчёт не рос вместе с users"""
+
+    def __init__(self, repair):
+        self.repair = repair
+        self.checked = 0
+        self.drift = dict.fromkeys(DRIFT_KINDS, 0)
+        self.repaired = dict.fromkeys(DRIFT_KINDS, 0)
+        self.failed = 0
+        self.unavailable_panels = []
+        self.samples = []
+
+    def add(self, kind, email, panel, db_expiry=None, panel_expiry=None):
+        self.drift[kind] += 1
+        if len(self.samples) < RECONCILE_REPORT_SAMPLES:
+            self.samples.append({
+                "kind": kind,
+                "email": email,
+                "panel": panel,
+                "db_expiry": db_expiry.strftime("%Y-%m-%d %H:%M:%S") if db_expiry else None,
+                "panel_expiry": panel_expiry,
+            })
+
+    def as_dict(self):
+        return {
+            "repair": self.repair,
+            "checked": self.checked,
+            "drift": self.drift,
+            "repaired": self.repaired,
+            "failed": self.failed,
+            "unavailable_panels": self.unavailable_panels,
+            "samples": self.samples,
+        }
+
+
+async def _restore_client(panel, reference, pool):
+    """Создание клиента на панели по его копии с другой панели, со сроком, перечитанным из БД.
+    Возвращает False, если подписка за время сверки истекла или удалена"""
+    expiry_date = await get_subscription_expiry(reference.email, pool)
+    if expiry_date is None or expiry_date <= datetime.now(timezone.utc):
+        return False
+    client = reference.model_copy(update={"expiry_time": _to_ms(expiry_date), "enable": True, "inbound_id": None})
+    # У основных панелей из PANELS inbound не указан, подписки создаются в первом
+    await add_client(panel, panel.get("inbound_id", 1), client, pool)
+    return True
+
+
+async def _set_expiry(panel, inbound_id, client, pool):
+    """Продление клиента на панели до срока из БД; возвращает False, если исправлять уже нечего.
+
+    Оплата сначала продлевает клиента на панели и только потом фиксирует срок в БД, поэтому оба срока
+    перечитываются под исключительной блокировкой inbound, а срок на панели только увеличивается:
+    более поздний срок на панели может быть оплатой, ещё не записанной в БД."""
+    async with inbound_lock(panel, inbound_id, exclusive=True):
+        expiry_date = await get_subscription_expiry(client.email, pool)
+        if expiry_date is None:
+            return False
+        expiry_ms = _to_ms(expiry_date)
+        current = await panel["api"].client.get_by_email(client.email)
+        if current is None or current.expiry_time >= expiry_ms - RECONCILE_EXPIRY_TOLERANCE * 1000:
+            return False
+        client = client.model_copy(update={"expiry_time": expiry_ms, "inbound_id": inbound_id})
+        await panel["api"].client.update(client.id, client)
+    client_index.put_client(panel["name"], inbound_id, client)
+    return True
+
+
+async def _check_batch(pool, rows, snapshots, report, semaphore):
+    now = datetime.now(timezone.utc)
+    repairs = []
+    for row in rows:
+        email, expiry_date = row["email"], row["expiry_date"]
+        report.checked += 1
+        if expiry_date is None:
+            continue
+        expiry_ms = _to_ms(expiry_date)
+        main_panel = get_panel_by_name(row["panel"])
+        expected = [main_panel] if main_panel in PANELS else []
+        expected += SUB_PANELS
+        entries = {name: snapshot.by_email.get(email) for name, snapshot in snapshots.items()}
+        reference = next((entry[1] for entry in entries.values() if entry), None)
+
+        for panel in expected:
+            if panel["name"] not in snapshots:
+                continue
+            entry = entries[panel["name"]]
+            if entry is None:
+                # Истёкшие подписки могли быть удалены с панели намеренно
+                if expiry_date <= now:
+                    continue
+                kind = "missing_on_panel" if panel in PANELS else "missing_on_sub_panel"
+                report.add(kind, email, panel["name"], expiry_date)
+                if report.repair and reference is not None:
+                    repairs.append((kind, _restore_client(panel, reference, pool)))
+                continue
+            inbound_id, client = entry
+            if abs(client.expiry_time - expiry_ms) > RECONCILE_EXPIRY_TOLERANCE * 1000:
+                report.add("expiry_mismatch", email, panel["name"], expiry_date, client.expiry_time)
+                # Срок на панели больше, чем в БД: это только отчёт, уменьшать срок должен человек
+                if report.repair and client.expiry_time < expiry_ms:
+                    repairs.append(("expiry_mismatch", _set_expiry(panel, inbound_id, client, pool)))
+
+    async def apply(kind, operation):
+        async with semaphore:
+            try:
+                if await asyncio.wait_for(operation, PANEL_DEADLINE):
+                    report.repaired[kind] += 1
+            except Exception as e:
+                report.failed += 1
+                logging.error(f"Сверка: не удалось исправить {kind}: {e}")
+
+    await asyncio.gather(*(apply(kind, operation) for kind, operation in repairs))
+
+
+async def _check_orphans(pool, snapshots, report):
+    """Клиенты панелей без строки в users; проверяются пакетами запросов к БД"""
+    for name, snapshot in snapshots.items():
+        emails = list(snapshot.by_email)
+        for start in range(0, len(emails), RECONCILE_BATCH_SIZE):
+            batch = emails[start:start + RECONCILE_BATCH_SIZE]
+            known = await find_subscription_emails(batch, pool)
+            for email in batch:
+                if email not in known:
+                    report.add("orphan_client", email, name, panel_expiry=snapshot.by_email[email][1].expiry_time)
+
+
+async def run(pool, repair=False):
+    """Сверка users с панелями; в режиме repair недостающие клиенты восстанавливаются, а отставшие сроки
+    на панелях продлеваются до БД. Клиенты без строки в users и сроки на панели больше, чем в БД, только
+    попадают в отчёт: удалять клиентов и уменьшать сроки должен человек."""
+    async with _lock:
+        report = Report(repair)
+        snapshots = {}
+        for panel in PANELS + SUB_PANELS:
+            try:
+                snapshots[panel["name"]] = await client_index.get_snapshot(panel)
+            except Exception as e:
+                logging.error(f"Сверка: панель {panel['name']} недоступна: {e}")
+                report.unavailable_panels.append(panel["name"])
+
+        semaphore = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+        after = 0
+        while True:
+            batch = await get_subscriptions_page(after, RECONCILE_BATCH_SIZE, pool)
+            if not batch:
+                break
+            await _check_batch(pool, batch, snapshots, report, semaphore)
+            after = batch[-1]["id"]
+        await _check_orphans(pool, snapshots, report)
+
+        logging.info(f"Сверка завершена: проверено {report.checked}, расхождения {report.drift}, исправлено {report.repaired}")
+        return report.as_dict()
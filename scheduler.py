@@ -0,0 +1,102 @@
+"""Фоновые предупреждения об окончании подписок и отключение истёкших клиентов"""
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+import config as cfg
+import notifications
+from database import get_expiring_subscriptions, get_expired_subscriptions, mark_warned, mark_ended, \
+    enqueue_notifications, unit_of_work, advisory_lock
+from xui_utils import PANELS, SUB_PANELS, disable_expired_clients
+
+# Период проверки сроков подписок
+EXPIRY_CHECK_INTERVAL = getattr(cfg, "EXPIRY_CHECK_INTERVAL", 300)
+# За сколько до окончания подписки предупреждать пользователя
+EXPIRY_WARN_BEFORE = getattr(cfg, "EXPIRY_WARN_BEFORE", 3 * 24 * 3600)
+# Размер страницы выборки из users
+EXPIRY_BATCH_SIZE = getattr(cfg, "EXPIRY_BATCH_SIZE", 500)
+
+# Ключ advisory-блокировки: проход выполняет один воркер, остальные его пропускают
+SCHEDULER_LOCK_KEY = 730520
+
+# Начало выборки по ключу (expiry_date, id)
+_FIRST_KEY = (datetime(1970, 1, 1, tzinfo=timezone.utc), 0)
+
+
+def _warning_text(row):
+    expiry = row["expiry_date"].strftime("%d.%m.%Y %H:%M")
+    return f"⏳ Подписка {row['email']} заканчивается {expiry} (UTC). Продлите её, чтобы не потерять доступ."
+
+
+async def _pages(fetch_page):
+    after = _FIRST_KEY
+    while True:
+        rows = await fetch_page(after)
+        if not rows:
+            return
+        yield rows
+        after = (rows[-1]["expiry_date"], rows[-1]["id"])
+        if len(rows) < EXPIRY_BATCH_SIZE:
+            return
+
+
+async def send_warnings(pool):
+    """Предупреждения в outbox и пометка warn одним UPDATE, одной транзакцией на страницу"""
+    sent = 0
+    async for rows in _pages(lambda after: get_expiring_subscriptions(EXPIRY_WARN_BEFORE, after, EXPIRY_BATCH_SIZE, pool)):
+        async with unit_of_work(pool) as conn:
+            await enqueue_notifications("main", [row["tg_id"] for row in rows], [_warning_text(row) for row in rows], conn)
+            await mark_warned([row["email"] for row in rows], EXPIRY_WARN_BEFORE, conn)
+        notifications.wake()
+        sent += len(rows)
+    if sent:
+        logging.info(f"Поставлено в очередь предупреждений об окончании подписки: {sent}")
+
+
+async def enforce_expiry(pool):
+    """Отключение истёкших клиентов на всех панелях и пометка ends одним UPDATE на страницу"""
+    panels = PANELS + SUB_PANELS
+    ended = 0
+    async for rows in _pages(lambda after: get_expired_subscriptions(after, EXPIRY_BATCH_SIZE, pool)):
+        emails = [row["email"] for row in rows]
+        results = await asyncio.gather(*(disable_expired_clients(panel, emails) for panel in panels), return_exceptions=True)
+        done = set(emails)
+        for panel, result in zip(panels, results):
+            if isinstance(result, Exception):
+                logging.error(f"Панель {panel['name']} недоступна для отключения истёкших клиентов: {result}")
+                done = set()
+                break
+            done &= result
+        # Не отключённые хотя бы на одной панели останутся с ends = 0 и попадут в следующий проход
+        if done:
+            await mark_ended(done, pool)
+            ended += len(done)
+    if ended:
+        logging.info(f"Отключено истёкших подписок: {ended}")
+
+
+async def _run_pass(pool):
+    for job in (send_warnings, enforce_expiry):
+        try:
+            await job(pool)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Ошибка планировщика подписок ({job.__name__}): {e}")
+
+
+async def run(pool):
+    """Фоновая проверка сроков подписок. Запускается в каждом воркере, но страницы выбираются до пометки
+    warn/ends, поэтому одновременный проход в двух воркерах дублировал бы предупреждения и отключения:
+    проход выполняет только воркер, получивший advisory-блокировку"""
+    while True:
+        try:
+            async with advisory_lock(SCHEDULER_LOCK_KEY) as lock_connection:
+                if lock_connection is not None:
+                    await _run_pass(pool)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Ошибка планировщика подписок: {e}")
+        await asyncio.sleep(EXPIRY_CHECK_INTERVAL)
+
@@ -0,0 +1,76 @@
+"""Подписанные сессионные токены мини-приложения"""
+import base64
+import hashlib
+import hmac
+import time
+
+from fastapi import Header, HTTPException
+
+import config as cfg
+
+# Время жизни токена, выдаваемого /api/auth
+SESSION_TTL = getattr(cfg, "SESSION_TTL", 3600)
+
+# Ключ проверки initData Telegram: HMAC-SHA256("WebAppData", токен бота), считается один раз
+WEBAPP_SECRET = hmac.new(b"WebAppData", cfg.MAIN_API_TOKEN.encode(), hashlib.sha256).digest()
+# Ключ подписи сессий; без SESSION_SECRET в конфиге выводится из токена бота
+SESSION_KEY = (
+    getattr(cfg, "SESSION_SECRET", "").encode()
+    or hmac.new(b"WSocksSession", cfg.MAIN_API_TOKEN.encode(), hashlib.sha256).digest()
+)
+
+
+def _sign(payload):
+    digest = hmac.new(SESSION_KEY, payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+
+def issue_token(tg_id):
+    """Токен вида '<tg_id>.<истекает, unix>.<подпись>'"""
+    payload = f"{int(tg_id)}.{int(time.time()) + SESSION_TTL}"
+    return f"{payload}.{_sign(payload)}"
+
+
+def verify_token(token):
+    """tg_id владельца токена; ValueError, если токен подделан или истёк"""
+    try:
+        tg_id, expires, signature = token.split(".")
+        payload = f"{tg_id}.{expires}"
+        if not hmac.compare_digest(signature, _sign(payload)):
+            raise ValueError("Invalid signature")
+        if int(expires) < time.time():
+            raise ValueError("Token expired")
+        return int(tg_id)
+    except (AttributeError, TypeError) as e:
+        raise ValueError("Malformed token") from e
+
+
+async def current_user(authorization: str = Header(default="")):
+    """Зависимость FastAPI: tg_id из заголовка 'Authorization: Bearer <токен>'"""
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        raise HTTPException(status_code=401, detail="Missing session token")
+    try:
+        return verify_token(token)
+    except ValueError as e:
+        raise HTTPException(status_code=401, detail=f"Invalid session token: {e}")
+
+
+def ensure_same_user(session_tg_id, tg_id):
+    """Запрет действий от имени другого пользователя; нечисловой tg_id тоже чужой"""
+    try:
+        same_user = int(tg_id) == session_tg_id
+    except (TypeError, ValueError):
+        same_user = False
+    if not same_user:
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+# Ключ служебных эндпоинтов; пока не задан в конфиге, они недоступны
+ADMIN_API_KEY = getattr(cfg, "ADMIN_API_KEY", "")
+
+
+async def admin_key(x_admin_key: str = Header(default="")):
+    """Зависимость FastAPI для служебных эндпоинтов: заголовок 'X-Admin-Key'"""
+    if not ADMIN_API_KEY or not hmac.compare_digest(x_admin_key.encode(), ADMIN_API_KEY.encode()):
+        raise HTTPException(status_code=403, detail="Forbidden")
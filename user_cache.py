@@ -0,0 +1,122 @@
+"""Версии данных пользователя для ETag и короткий кэш ответов /api/subscriptions и /api/referrals"""
+import hashlib
+import itertools
+import json
+import time
+
+import config as cfg
+import invalidation
+import metrics
+
+# Сколько секунд ответ и его ETag считаются актуальными без изменений со стороны приложения.
+# Изменения других воркеров приходят через invalidation, TTL ограничивает устаревание только из-за
+# изменений в обход приложения (бот, ручные правки панели)
+USER_CACHE_MAX_AGE = getattr(cfg, "USER_CACHE_MAX_AGE", 300)
+USER_CACHE_MAX_ENTRIES = getattr(cfg, "USER_CACHE_MAX_ENTRIES", 10000)
+
+SUBSCRIPTIONS = "subscriptions"
+REFERRALS = "referrals"
+
+# Общий счётчик: номера построений и инвалидаций никогда не повторяются
+_counter = itertools.count(1)
+# (раздел, tg_id) -> (etag, body, актуален до)
+_entries = {}
+# (раздел, tg_id) -> (номер последней инвалидации, время)
+_invalidated = {}
+# Номер последнего полного сброса
+_cleared = 0
+
+
+def _key(kind, tg_id):
+    return kind, int(tg_id)
+
+
+def _tg_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _etag(kind, body):
+    """ETag по содержимому ответа: одинаков на всех воркерах и после перестроения тех же данных"""
+    encoded = json.dumps(body, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str).encode()
+    return f'W/"{kind}-{hashlib.blake2b(encoded, digest_size=12).hexdigest()}"'
+
+
+def lookup(kind, tg_id):
+    """(etag, body) актуального ответа или None"""
+    key = _key(kind, tg_id)
+    entry = _entries.get(key)
+    if entry is None or entry[2] <= time.time():
+        metrics.CACHE_REQUESTS.inc("user_cache", "miss")
+        return None
+    metrics.CACHE_REQUESTS.inc("user_cache", "hit")
+    return entry[0], entry[1]
+
+
+def begin():
+    """Отметка перед построением ответа; передаётся в store"""
+    return next(_counter)
+
+
+def store(kind, tg_id, started, body, stale_at=None):
+    """Сохранение построенного ответа, возвращает его ETag. Если данные пользователя изменились, пока ответ
+    строился, ответ не кэшируется и ETag не выдаётся (None)"""
+    key = _key(kind, tg_id)
+    if _cleared > started or _invalidated.get(key, (0, 0))[0] > started:
+        return None
+    now = time.time()
+    valid_until = now + USER_CACHE_MAX_AGE
+    if stale_at is not None:
+        valid_until = min(valid_until, stale_at)
+    if len(_entries) >= USER_CACHE_MAX_ENTRIES:
+        _evict(now)
+    etag = _etag(kind, body)
+    _entries[key] = (etag, body, valid_until)
+    return etag
+
+
+def _evict(now):
+    for key in [key for key, entry in _entries.items() if entry[2] <= now]:
+        del _entries[key]
+    # Так долго ответ не строится, более старые отметки уже ничему не помешают
+    for key in [key for key, mark in _invalidated.items() if now - mark[1] > USER_CACHE_MAX_AGE]:
+        del _invalidated[key]
+    if len(_entries) >= USER_CACHE_MAX_ENTRIES:
+        _entries.clear()
+
+
+def bump(tg_id, *kinds, publish=True):
+    """Новая версия данных пользователя; вызывается после коммита изменений.
+    publish=False - без события для других воркеров (они узнают об изменении сами)"""
+    if _tg_id(tg_id) is None:
+        return
+    mark = next(_counter), time.time()
+    if len(_invalidated) >= USER_CACHE_MAX_ENTRIES:
+        _evict(mark[1])
+    for kind in kinds:
+        key = _key(kind, tg_id)
+        _entries.pop(key, None)
+        _invalidated[key] = mark
+    if publish:
+        invalidation.publish("user", tg_id=_tg_id(tg_id), kinds=list(kinds))
+
+
+def clear():
+    """Сброс всех ответов: ответы, которые уже строятся, тоже не сохранятся"""
+    global _cleared
+    _cleared = next(_counter)
+    _entries.clear()
+
+
+def not_modified(if_none_match, etag):
+    """Совпадает ли заголовок If-None-Match с ETag"""
+    if not if_none_match or etag is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or etag.removeprefix("W/") in tags
+
+
+invalidation.subscribe("user", lambda event: bump(event["tg_id"], *event["kinds"], publish=False))
+invalidation.subscribe(invalidation.RESET, lambda event: clear())
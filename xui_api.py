@@ -0,0 +1,312 @@
+"""Асинхронный клиент API панелей 3x-ui на общем пуле соединений httpx"""
+import asyncio
+import json
+import logging
+import os
+import time
+
+import httpx
+import pyotp
+from py3xui import Client, Inbound
+
+import breaker
+import config as cfg
+import metrics
+
+PANEL_TIMEOUT = getattr(cfg, "PANEL_TIMEOUT", 10)
+PANEL_CONNECT_TIMEOUT = getattr(cfg, "PANEL_CONNECT_TIMEOUT", 5)
+PANEL_MAX_CONNECTIONS = getattr(cfg, "PANEL_MAX_CONNECTIONS", 20)
+PANEL_MAX_KEEPALIVE = getattr(cfg, "PANEL_MAX_KEEPALIVE", 10)
+PANEL_KEEPALIVE_EXPIRY = getattr(cfg, "PANEL_KEEPALIVE_EXPIRY", 60)
+# Срок сессии, если панель не указала срок в cookie, и за сколько до окончания сессии входить заново
+PANEL_SESSION_TTL = getattr(cfg, "PANEL_SESSION_TTL", 3600)
+PANEL_SESSION_REFRESH_BEFORE = getattr(cfg, "PANEL_SESSION_REFRESH_BEFORE", 300)
+# Каталог для cookie сессий, чтобы после перезапуска не входить заново; None - не сохранять
+PANEL_SESSION_DIR = getattr(cfg, "PANEL_SESSION_DIR", ".panel_sessions")
+
+COOKIE_NAMES = ("3x-ui", "session")
+# Так 3x-ui отвечает на запрос API без действующей сессии: 404 в новых версиях, редирект на вход в старых
+AUTH_FAILURE_STATUSES = {401, 404}
+
+
+def _is_panel_failure(error):
+    """Ошибка, говорящая о недоступности панели, а не об отказе в конкретной операции"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, (httpx.TransportError, TimeoutError, OSError))
+
+
+class PanelApi:
+    """Асинхронный аналог py3xui.Api: один keep-alive пул соединений на панель"""
+
+    def __init__(self, host, username, password, token=None, secret=None, use_tls_verify=True):
+        self.host = host.rstrip("/")
+        self.username = username
+        self.password = password
+        self.token = token
+        # Секрет TOTP, если на панели включена двухфакторная авторизация
+        self.secret = secret
+        self.use_tls_verify = use_tls_verify
+        # Автомат отключения: пока панель недоступна, запросы к ней отклоняются сразу
+        self.breaker = breaker.CircuitBreaker(self.host)
+        self._http = None
+        # Время окончания сессии и номер входа: запрос, получивший отказ при старой сессии, не входит повторно
+        self.session_expires_at = None
+        self.login_error = None
+        self._session_epoch = 0
+        self._login_task = None
+        # Выполняющиеся чтения: одинаковые одновременные GET ждут один запрос к панели
+        self._inflight = {}
+        self.inbound = InboundApi(self)
+        self.client = ClientApi(self)
+
+    @property
+    def name(self):
+        """Имя панели в метриках и автомате отключения; xui_utils подставляет имя из PANELS"""
+        return self.breaker.name
+
+    @name.setter
+    def name(self, value):
+        self.breaker.name = value
+
+    @property
+    def http(self):
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                base_url=self.host,
+                verify=self.use_tls_verify,
+                timeout=httpx.Timeout(PANEL_TIMEOUT, connect=PANEL_CONNECT_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=PANEL_MAX_CONNECTIONS,
+                    max_keepalive_connections=PANEL_MAX_KEEPALIVE,
+                    keepalive_expiry=PANEL_KEEPALIVE_EXPIRY,
+                ),
+                headers={"Accept": "application/json"},
+            )
+        return self._http
+
+    async def login(self, two_factor_code=None, timeout=None):
+        data = {"username": self.username, "password": self.password}
+        if two_factor_code is None and self.secret:
+            two_factor_code = pyotp.TOTP(self.secret).now()
+        if two_factor_code is not None:
+            data["twoFactorCode"] = str(two_factor_code)
+        if self.token is not None:
+            data["loginSecret"] = self.token
+        started = time.perf_counter()
+        try:
+            response = await self.http.post("login", json=data, timeout=timeout or httpx.USE_CLIENT_DEFAULT)
+            response.raise_for_status()
+            if not any(name in response.cookies for name in COOKIE_NAMES):
+                raise ValueError("No session cookie found, something wrong with the login...")
+        except Exception as e:
+            metrics.PANEL_ERRORS.inc(self.name, "login")
+            self.login_error = str(e) or type(e).__name__
+            raise
+        finally:
+            metrics.PANEL_LATENCY.observe(time.perf_counter() - started, self.name, "login")
+        expires = [cookie.expires for cookie in self.http.cookies.jar if cookie.name in COOKIE_NAMES and cookie.expires]
+        self.session_expires_at = min(expires) if expires else time.time() + PANEL_SESSION_TTL
+        self._session_epoch += 1
+        self.login_error = None
+        await asyncio.to_thread(self._save_session)
+        logging.info("Авторизация на панели %s выполнена", self.host)
+
+    async def relogin(self, epoch=None):
+        """Вход с защитой от лавины: одновременные запросы ждут один общий вход.
+        epoch - номер сессии, с которой запрос получил отказ; если сессию уже обновили, повторный вход не нужен"""
+        if epoch is not None and epoch != self._session_epoch:
+            return
+        if self._login_task is None:
+            self._login_task = asyncio.ensure_future(self._login_once())
+        # Отмена одного ожидающего запроса не должна прерывать вход для остальных
+        await asyncio.shield(self._login_task)
+
+    async def _login_once(self):
+        try:
+            await self.login()
+        finally:
+            self._login_task = None
+
+    def _session_path(self):
+        return os.path.join(PANEL_SESSION_DIR, f"{self.name}.json")
+
+    def _save_session(self):
+        if not PANEL_SESSION_DIR:
+            return
+        cookies = [
+            {"name": cookie.name, "value": cookie.value, "domain": cookie.domain, "path": cookie.path}
+            for cookie in self.http.cookies.jar
+        ]
+        try:
+            os.makedirs(PANEL_SESSION_DIR, mode=0o700, exist_ok=True)
+            path = self._session_path()
+            # Запись во временный файл и переименование: другой процесс не прочитает недописанный файл
+            temporary = f"{path}.{os.getpid()}.tmp"
+            with open(os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as file:
+                json.dump({"host": self.host, "expires_at": self.session_expires_at, "cookies": cookies}, file)
+            os.replace(temporary, path)
+        except OSError as e:
+            logging.warning(f"Не удалось сохранить сессию панели {self.name}: {e}")
+
+    def load_session(self):
+        """Восстановление сохранённой сессии; False, если её нет или она скоро истечёт"""
+        if not PANEL_SESSION_DIR:
+            return False
+        try:
+            with open(self._session_path()) as file:
+                session = json.load(file)
+        except (OSError, ValueError):
+            return False
+        if session.get("host") != self.host or session.get("expires_at", 0) - PANEL_SESSION_REFRESH_BEFORE <= time.time():
+            return False
+        for cookie in session["cookies"]:
+            self.http.cookies.set(cookie["name"], cookie["value"], domain=cookie["domain"], path=cookie["path"])
+        self.session_expires_at = session["expires_at"]
+        self._session_epoch += 1
+        logging.info("Восстановлена сессия панели %s", self.host)
+        return True
+
+    def has_session(self):
+        """Есть действующая сессия и последний вход не завершился ошибкой"""
+        return self.login_error is None and self.session_expires_at is not None and self.session_expires_at > time.time()
+
+    async def _ensure_session(self):
+        if self.session_expires_at is None or self.session_expires_at - PANEL_SESSION_REFRESH_BEFORE <= time.time():
+            await self.relogin(self._session_epoch)
+
+    async def request(self, method, endpoint, timeout=None, operation=None, **kwargs):
+        """Запрос к API панели; возвращает поле obj успешного ответа.
+
+        Одинаковые одновременные чтения (GET того же пути с теми же параметрами) получают результат одного
+        запроса, поэтому число запросов к панели ограничено числом разных операций, а не пользователей.
+        Результат общий: вызывающий код не должен его изменять.
+        Ожидание ограничено остатком бюджета HTTP-запроса (breaker.budget)."""
+        async with breaker.timeout():
+            if method != "GET":
+                return await self._request(method, endpoint, timeout, operation, **kwargs)
+            key = (endpoint, json.dumps(kwargs.get("params"), sort_keys=True, default=str))
+            task = self._inflight.get(key)
+            if task is None:
+                task = self._inflight[key] = breaker.detached(self._request(method, endpoint, timeout, operation, **kwargs))
+                task.add_done_callback(lambda done: self._read_done(key, done))
+                metrics.CACHE_REQUESTS.inc("panel_reads", "upstream")
+            else:
+                metrics.CACHE_REQUESTS.inc("panel_reads", "coalesced")
+            # Отмена одного ожидающего не прерывает запрос для остальных
+            return await asyncio.shield(task)
+
+    def _read_done(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # Ошибку уже получили ожидающие; если все они отменены, она не должна попасть в лог как необработанная
+            task.exception()
+
+    async def _request(self, method, endpoint, timeout, operation, **kwargs):
+        """Запрос с одним повторным входом и одним повтором при отказе в авторизации"""
+        operation = operation or endpoint
+        probe = self.breaker.acquire()
+        started = time.perf_counter()
+        ok = None
+        try:
+            await self._ensure_session()
+            epoch = self._session_epoch
+            response = await self.http.request(
+                method, endpoint, timeout=timeout or httpx.USE_CLIENT_DEFAULT, **kwargs
+            )
+            if response.status_code in AUTH_FAILURE_STATUSES or response.is_redirect:
+                if self._login_task is None and epoch == self._session_epoch:
+                    logging.warning(f"Панель {self.name} отклонила сессию ({response.status_code}), повторный вход")
+                await self.relogin(epoch)
+                response = await self.http.request(
+                    method, endpoint, timeout=timeout or httpx.USE_CLIENT_DEFAULT, **kwargs
+                )
+            response.raise_for_status()
+            data = response.json()
+            ok = True
+            if not data.get("success"):
+                raise ValueError(f"Response status is not successful, message: {data.get('msg')}")
+        except Exception as e:
+            metrics.PANEL_ERRORS.inc(self.name, operation)
+            if ok is None:
+                ok = not _is_panel_failure(e)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.PANEL_LATENCY.observe(elapsed, self.name, operation)
+            self.breaker.record(probe, ok, elapsed)
+        return data.get("obj")
+
+    async def close(self):
+        if self._login_task is not None:
+            self._login_task.cancel()
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+
+class InboundApi:
+    def __init__(self, api):
+        self._api = api
+
+    async def get_list(self, timeout=None):
+        inbounds = await self._api.request("GET", "panel/api/inbounds/list", timeout=timeout, operation="inbound.get_list")
+        return [Inbound.model_validate(data) for data in inbounds or []]
+
+    async def get_by_id(self, inbound_id, timeout=None):
+        inbound = await self._api.request(
+            "GET", f"panel/api/inbounds/get/{inbound_id}", timeout=timeout, operation="inbound.get_by_id"
+        )
+        return Inbound.model_validate(inbound)
+
+    async def get_raw(self, inbound_id, timeout=None):
+        """Inbound в том виде, в каком его отдала панель: модель py3xui теряет часть полей настроек.
+        Возвращается копия, которую можно изменять"""
+        return dict(await self._api.request(
+            "GET", f"panel/api/inbounds/get/{inbound_id}", timeout=timeout, operation="inbound.get_by_id"
+        ))
+
+    async def update_raw(self, inbound_id, inbound, timeout=None):
+        """Запись inbound целиком, включая всех клиентов в settings"""
+        inbound = {key: value for key, value in inbound.items() if key != "clientStats"}
+        await self._api.request(
+            "POST", f"panel/api/inbounds/update/{inbound_id}", json=inbound, timeout=timeout, operation="inbound.update"
+        )
+
+
+class ClientApi:
+    def __init__(self, api):
+        self._api = api
+
+    async def get_by_email(self, email, timeout=None):
+        client = await self._api.request(
+            "GET", f"panel/api/inbounds/getClientTraffics/{email}", timeout=timeout, operation="client.get_by_email"
+        )
+        return Client.model_validate(client) if client else None
+
+    async def add(self, inbound_id, clients, timeout=None):
+        settings = {"clients": [client.model_dump(by_alias=True, exclude_defaults=True) for client in clients]}
+        await self._api.request(
+            "POST", "panel/api/inbounds/addClient",
+            json={"id": inbound_id, "settings": json.dumps(settings)}, timeout=timeout, operation="client.add",
+        )
+
+    async def update(self, client_uuid, client, timeout=None):
+        settings = {"clients": [client.model_dump(by_alias=True, exclude_defaults=True)]}
+        await self._api.request(
+            "POST", f"panel/api/inbounds/updateClient/{client_uuid}",
+            json={"id": client.inbound_id, "settings": json.dumps(settings)}, timeout=timeout, operation="client.update",
+        )
+
+    async def online(self, timeout=None):
+        """Список email клиентов, подключённых в данный момент"""
+        return await self._api.request(
+            "POST", "panel/api/inbounds/onlines", json={}, timeout=timeout, operation="client.online"
+        ) or []
+
+    async def delete(self, inbound_id, client_uuid, timeout=None):
+        await self._api.request(
+            "POST", f"panel/api/inbounds/{inbound_id}/delClient/{client_uuid}", json={}, timeout=timeout,
+            operation="client.delete"
+        )
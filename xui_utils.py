@@ -1,16 +1,28 @@
+import asyncio
 import logging
 import uuid
 
-import pyotp
-from py3xui import Api, Client
-from datetime import datetime, timezone, timedelta
+from py3xui import Client
+from datetime import datetime, timezone
+import breaker
+import client_index
 import config as cfg
+import placement
+from database import save_directory_entry, get_directory_entries, inbound_advisory_lock
+from xui_api import PanelApi
+
+# Дедлайн на все запросы к одной панели в рамках одной операции
+PANEL_DEADLINE = getattr(cfg, "PANEL_DEADLINE", 15)
+# Одновременных запросов к одной панели при пакетных операциях
+PANEL_BATCH_CONCURRENCY = getattr(cfg, "PANEL_BATCH_CONCURRENCY", 5)
+# Сколько ждать входа в панели при старте приложения
+PANEL_LOGIN_DEADLINE = getattr(cfg, "PANEL_LOGIN_DEADLINE", 10)
 
 PANELS = [
 
    {
         "name": "Panel1",
-        "api": Api(host=cfg.PANEL1_HOST, username=cfg.PANEL1_USERNAME, password=cfg.PANEL1_PASSWORD, token=cfg.PANEL1_TOKEN),
+        "api": PanelApi(host=cfg.PANEL1_HOST, username=cfg.PANEL1_USERNAME, password=cfg.PANEL1_PASSWORD, token=cfg.PANEL1_TOKEN),
         "create_key": lambda client: (
             f"vless://{client.id}@de-1.wsocks.ru:443?type=tcp&security=reality&pbk=c0DrIcQXeWqnmFysSVgfIVCcEr0LS_WJhlwxWsDnPWg&fp=chrome&sni=google.com&sid=bbdbd6f3&spx=%2F&flow=xtls-rprx-vision#WSocks VPN Germany"
          ),
@@ -20,7 +32,7 @@ PANELS = [
      }
     # {
     #     "name": "Panel2",
-    #     "api": Api(host=cfg.PANEL2_HOST, username=cfg.PANEL2_USERNAME, password=cfg.PANEL2_PASSWORD, token=cfg.PANEL2_TOKEN),
+    #     "api": PanelApi(host=cfg.PANEL2_HOST, username=cfg.PANEL2_USERNAME, password=cfg.PANEL2_PASSWORD, token=cfg.PANEL2_TOKEN),
     #     "create_key": lambda client: (
     #         f"vless://{client.id}@de-2.wsocks.ru:443?type=tcp&security=reality&pbk=s"
     #         f"-R4V_XUgnbRlLLCtqri10dcdd1QLNEAU6B04LpRX3U&fp=chrome&sni=google.com&sid=5f&spx=%2F&flow=xtls-rprx-vision#WSocks VPN Germany"
@@ -28,7 +40,7 @@ PANELS = [
     # },
     # {
     #     "name": "Panel3",
-    #     "api": Api(host=cfg.PANEL3_HOST, username=cfg.PANEL3_USERNAME, password=cfg.PANEL3_PASSWORD, token=cfg.PANEL3_TOKEN),
+    #     "api": PanelApi(host=cfg.PANEL3_HOST, username=cfg.PANEL3_USERNAME, password=cfg.PANEL3_PASSWORD, token=cfg.PANEL3_TOKEN),
     #     "create_key": lambda client: (
     #         f"vless://{client.id}@de-3.wsocks.ru:443?type=tcp&security=reality&pbk"
     #         f"=MCEDsjvqBrJGLXk-yJOsSu5-RK8fO7kkFT_RC_giNgM&fp=chrome&sni=google.com&sid=8e&spx=%2F&flow=xtls-rprx-vision#WSocks VPN Germany"
@@ -43,216 +55,234 @@ PANELS = [
 SUB_PANELS = [
    {
         "name": "Panel_Ind",
-        "api": Api(host=cfg.PANEL_IND_HOST, username=cfg.PANEL_IND_USERNAME, password=cfg.PANEL_IND_PASSWORD),
-        "secret": cfg.PANEL_IND_SECRET,
+        "api": PanelApi(host=cfg.PANEL_IND_HOST, username=cfg.PANEL_IND_USERNAME, password=cfg.PANEL_IND_PASSWORD,
+                        secret=cfg.PANEL_IND_SECRET),
         "inbound_id": 1
      },
    {
         "name": "Panel_SPB",
-        "api": Api(host=cfg.PANEL_SPB_HOST, username=cfg.PANEL_SPB_USERNAME, password=cfg.PANEL_SPB_PASSWORD),
-        "secret": cfg.PANEL_SPB_SECRET,
+        "api": PanelApi(host=cfg.PANEL_SPB_HOST, username=cfg.PANEL_SPB_USERNAME, password=cfg.PANEL_SPB_PASSWORD,
+                        secret=cfg.PANEL_SPB_SECRET),
         "inbound_id": 3
      },
 ]
 
-for panel in PANELS:
-    panel["api"].login()
+for _panel in PANELS + SUB_PANELS:
+    _panel["api"].name = _panel["name"]
 
-for panel in SUB_PANELS:
-    panel["api"].login()
+def inbound_lock(panel, inbound_id, exclusive=False):
+    """Блокировка inbound во всех воркерах: запись inbound целиком (кампании продления, exclusive=True)
+    не должна затереть клиента, добавленного или изменённого между её чтением и записью.
+    Изменения отдельных клиентов друг друга не блокируют"""
+    return inbound_advisory_lock(panel["name"], inbound_id, exclusive)
 
-def auth_xui(panel):
-    try:
-        totp = pyotp.TOTP(panel['secret'])
-        totp_code = totp.now()
-        logging.info(f"Generated TOTP code: {totp_code}")
-    except Exception as e:
-        logging.error(f"Failed to generate TOTP code: {str(e)}")
-        return
+async def _login_panel(panel):
+    if not panel["api"].load_session():
+        await panel["api"].relogin()
+
+async def login_panels():
+    """Параллельная авторизация на всех панелях при старте приложения; сохранённые сессии используются повторно.
+    Недоступная панель не останавливает старт: она остаётся degraded, и вход повторится при первом запросе к ней.
+    Дальше сессии обновляются сами: перед истечением и при отказе панели в авторизации"""
+    panels = PANELS + SUB_PANELS
+    results = await asyncio.gather(
+        *(asyncio.wait_for(_login_panel(panel), PANEL_LOGIN_DEADLINE) for panel in panels), return_exceptions=True
+    )
+    for panel, result in zip(panels, results):
+        if isinstance(result, Exception):
+            logging.error(f"Не удалось войти в панель {panel['name']} при старте, панель degraded: {result!r}")
+
+def _panel_state(api):
+    state = api.breaker.current_state()
+    if state != breaker.CLOSED:
+        return state
+    return "ok" if api.has_session() else "degraded"
 
-    # Step 2: Authenticate with 3X-UI API
-    try:
-        panel['api'].login(totp_code)
-        print("Success: Logged in to 3X-UI")
-    except Exception as e:
-        logging.error(f"Login failed: {str(e)}")
-
-def get_panel_load(api):
-    try:
-        inbounds = api.inbound.get_list()
-        total_clients = sum(len(inbound.settings.clients) for inbound in inbounds)
-        return total_clients
-    except Exception as e:
-        logging.error(f"Ошибка при получении нагрузки панели: {e}")
-        return float("inf")
+def panel_status():
+    """Состояние панелей для /readyz: ok - есть действующая сессия, degraded - нет,
+    open/half_open - панель отключена автоматом или проверяется пробными запросами"""
+    return {panel["name"]: _panel_state(panel["api"]) for panel in PANELS + SUB_PANELS}
+
+async def close_panels():
+    for panel in PANELS + SUB_PANELS:
+        await panel["api"].close()
 
 def get_best_panel():
-    suitable_panel = None
-    min_load = float("inf")
-    for panel in PANELS:
-        load = get_panel_load(panel["api"])
-        if load < min_load:
-            min_load = load
-            suitable_panel = panel
-    return suitable_panel
-
-def get_api_by_name(name):
-    panel = next((panel for panel in PANELS if panel['name'] == name), None)
-    return panel['api'] if panel else None
-
-def get_active_subscriptions(tg_id):
-    subscriptions = []
-    for panel in PANELS:
-        try:
-            inbounds = panel["api"].inbound.get_list()
-            for inbound in inbounds:
-                for client in inbound.settings.clients:
-                    if client.tg_id == tg_id:
-                        expiry_date = datetime.fromtimestamp(client.expiry_time / 1000.0, tz=timezone.utc)
-                        subscriptions.append({
-                            "email": client.email,
-                            "id": client.id,
-                            "key": panel["create_key"](client),
-                            "sub_link": panel["create_link"](client),
-                            "expiry_date": expiry_date,
-                            "sub_id": client.sub_id,
-                            "is_expired": expiry_date <= datetime.now(timezone.utc),
-                            "panel": panel["name"]
-                        })
+    """Панель для нового клиента по последним замерам нагрузки (см. placement)"""
+    return placement.choose_panel(PANELS)
 
-        except Exception as e:
-            logging.error(f"Ошибка при проверке подписок на {panel['name']}: {e}")
-    return subscriptions
+def get_panel_by_name(name):
+    return next((panel for panel in PANELS + SUB_PANELS if panel['name'] == name), None)
 
-def get_sub(email):
-    subscriptions = []
-    for panel in SUB_PANELS:
-        try:
-            inbounds = panel["api"].inbound.get_list()
-            for inbound in inbounds:
-                for client in inbound.settings.clients:
-                    if client.email == email:
-                        expiry_date = datetime.fromtimestamp(client.expiry_time / 1000.0, tz=timezone.utc)
-                        subscriptions.append({
-                            "email": client.email,
-                            "id": client.id,
-                            "inbound_id": panel["inbound_id"],
-                            "key": panel["create_key"](client),
-                            "sub_link": panel["create_link"](client),
-                            "expiry_date": expiry_date,
-                            "sub_id": client.sub_id,
-                            "is_expired": expiry_date <= datetime.now(timezone.utc),
-                            "panel": panel["name"]
-                        })
+async def add_client(panel, inbound_id, client, pool):
+    """Добавление клиента на панель с записью в кэш клиентов и в client_directory"""
+    async with inbound_lock(panel, inbound_id):
+        await panel["api"].client.add(inbound_id, [client])
+    client_index.put_client(panel["name"], inbound_id, client)
+    await save_directory_entry(client.email, panel["name"], inbound_id, client.id, client.sub_id, pool)
 
-        except Exception as e:
-            logging.error(f"Ошибка при проверке подписок на {panel['name']}: {e}")
-    return subscriptions
-
-def extend_subscription(user_email: str, user_uuid: str, days_extension: int, tg_id, subscription_id, api):
-    try:
-        client = api.client.get_by_email(user_email)
-        if not client:
-            print(f"Ошибка: клиент с Email {user_email} не найден.")
-            return
-        current_time = int(datetime.now(timezone.utc).timestamp() * 1000)
-        if client.expiry_time < current_time:
-            new_expiry_time = current_time + int(timedelta(days=days_extension).total_seconds() * 1000)
-        else:
-            new_expiry_time = client.expiry_time + int(timedelta(days=days_extension).total_seconds() * 1000)
-        client.expiry_time = new_expiry_time
-        client.id = user_uuid
-        client.tg_id = tg_id
-        client.flow = "xtls-rprx-vision"
-        client.enable = True
-        client.limit_ip = 5
-        client.sub_id = subscription_id
-        api.client.update(user_uuid, client)
-        print(f"Подписка {client.email} успешно продлена.")
-    except Exception as e:
-        print(f"Ошибка при продлении подписки: {e}")
-
-
-def create_sub_panel_subscriptions(email: str, tg_id: int, subscription_id: str, expiry_time: int):
-    """Создание подписок на всех панелях из SUB_PANELS с данными основного подключения."""
-    for panel in SUB_PANELS:
+def _subscription(panel, inbound_id, client):
+    expiry_date = datetime.fromtimestamp(client.expiry_time / 1000.0, tz=timezone.utc)
+    return {
+        "email": client.email,
+        "id": client.id,
+        "inbound_id": inbound_id,
+        "key": panel["create_key"](client),
+        "sub_link": panel["create_link"](client),
+        "expiry_date": expiry_date,
+        "sub_id": client.sub_id,
+        "is_expired": expiry_date <= datetime.now(timezone.utc),
+        "panel": panel["name"]
+    }
+
+async def _collect(panels, lookup, unavailable):
+    """Подписки со всех панелей параллельно, каждая панель в пределах дедлайна и бюджета запроса.
+    Недоступная панель не задерживает остальные: её имя попадает в unavailable, результат - частичный"""
+    async def run(panel):
         try:
-            api = panel["api"]
-            inbound_id = panel["inbound_id"]
-            # Проверяем, не существует ли уже клиент с таким email
-            existing_client = api.client.get_by_email(email)
-            if existing_client:
-                logging.info(f"Клиент {email} уже существует на панели {panel['name']}, пропускаем создание.")
-                continue
-            # Создаем нового клиента
-            new_client = Client(
-                id=str(uuid.uuid4()),
-                enable=True,
-                tg_id=tg_id,
-                expiry_time=expiry_time,
-                flow="xtls-rprx-vision",
-                email=email,
-                sub_id=subscription_id,
-                limit_ip=5
-            )
-            api.client.add(inbound_id, [new_client])
-            logging.info(f"Подписка успешно создана на панели {panel['name']} для {email}")
+            async with breaker.timeout(PANEL_DEADLINE):
+                return await lookup(panel)
         except Exception as e:
-            logging.error(f"Не удалось создать подписку на панели {panel['name']} для {email}: {e}")
-            continue  # Продолжаем обработку следующей панели
+            logging.error(f"Ошибка при проверке подписок на {panel['name']}: {e!r}")
+            if unavailable is not None:
+                unavailable.append(panel["name"])
+            return []
+
+    return [subscription for found in await asyncio.gather(*(run(panel) for panel in panels)) for subscription in found]
 
-def extend_sub_panel_subscriptions(email: str, days_extension: int, tg_id: int, subscription_id: str):
-    """Продление подписок на всех панелях из SUB_PANELS."""
-    for panel in SUB_PANELS:
+async def get_active_subscriptions(tg_id, unavailable=None):
+    async def lookup(panel):
+        return [
+            _subscription(panel, inbound_id, client)
+            for inbound_id, client in await client_index.find_by_tg_id(panel, tg_id)
+        ]
+    return await _collect(PANELS, lookup, unavailable)
+
+async def _fan_out(operations, action):
+    """Параллельное выполнение операций на панелях, у каждой панели свой дедлайн в пределах бюджета запроса.
+
+    operations - список пар (panel, coroutine). Возвращает {имя панели: успех}."""
+    async def run(panel, operation):
         try:
-            api = panel["api"]
-            inbound_id = panel["inbound_id"]
-            inbound = api.inbound.get_by_id(inbound_id)
-            for c in inbound.settings.clients:
-                if c.email == email:
-                    client = c
-                    break
-
-            if not client:
-                logging.error(f"Клиент {email} не найден на панели {panel['name']}, пропускаем продление.")
-                continue
-            user_uuid = client.id
-
-            client = api.client.get_by_email(email)
-            current_time = int(datetime.now(timezone.utc).timestamp() * 1000)
-            if client.expiry_time < current_time:
-                new_expiry_time = current_time + int(timedelta(days=days_extension).total_seconds() * 1000)
-            else:
-                new_expiry_time = client.expiry_time + int(timedelta(days=days_extension).total_seconds() * 1000)
-            client.expiry_time = new_expiry_time
-            client.id = user_uuid
-            client.tg_id = tg_id
-            client.flow = "xtls-rprx-vision"
-            client.enable = True
-            client.limit_ip = 5
-            client.sub_id = subscription_id
-            api.client.update(user_uuid, client)
-            logging.info(f"Подписка {email} успешно продлена на панели {panel['name']}.")
+            async with breaker.timeout(PANEL_DEADLINE):
+                await operation
+            return panel["name"], True
+        except TimeoutError:
+            logging.error(f"{action}: панель {panel['name']} не ответила за отведённое время")
         except Exception as e:
-            logging.error(f"Не удалось продлить подписку на панели {panel['name']} для {email}: {e}")
-            continue  # Продолжаем обработку следующей панели
-
-
-
-def delete_trial_subscription(panel, email):
-    api = get_api_by_name(panel)
-    inbounds = api.inbound.get_list()
-    for inbound in inbounds:
-        for client in inbound.settings.clients:
-            if client.email == email:
-                api.client.delete(1, client.id)
-    logging.info(f"Удалена пробная подписка {email} с панели {panel}.")
-
-def delete_subscriptions(panel, email):
-    api = get_api_by_name(panel)
-    inbounds = api.inbound.get_list()
-    for inbound in inbounds:
-        for client in inbound.settings.clients:
-            if client.email == email and ("DE-FRA-USER" in email or "DE-FRA-TRIAL" in email):
-                api.client.delete(1, client.id)
-    logging.info(f"Удалена подписка {email} с панели {panel}.")
\ No newline at end of file
+            logging.error(f"{action}: ошибка на панели {panel['name']}: {e}")
+        return panel["name"], False
+
+    return dict(await asyncio.gather(*(run(panel, operation) for panel, operation in operations)))
+
+async def _locate(panel, email, directory, pool):
+    """(inbound_id, uuid) клиента на панели по client_directory. Клиентов, созданных до появления справочника,
+    ищем в снимке панели и дописываем в справочник"""
+    entry = directory.get(panel["name"])
+    if entry:
+        return entry["inbound_id"], entry["client_uuid"]
+    found = await client_index.find_by_email(panel, email)
+    if not found:
+        raise LookupError(f"клиент {email} не найден")
+    inbound_id, client = found
+    await save_directory_entry(email, panel["name"], inbound_id, client.id, client.sub_id, pool)
+    return inbound_id, client.id
+
+async def _extend_client(panel, email, expiry_time, tg_id, subscription_id, directory, pool):
+    """Продление клиента на одной панели одним запросом updateClient в нужный inbound"""
+    inbound_id, client_uuid = await _locate(panel, email, directory, pool)
+    client = Client(
+        id=client_uuid,
+        inbound_id=inbound_id,
+        enable=True,
+        tg_id=tg_id,
+        expiry_time=expiry_time,
+        flow="xtls-rprx-vision",
+        email=email,
+        sub_id=subscription_id,
+        limit_ip=5
+    )
+    async with inbound_lock(panel, inbound_id):
+        await panel["api"].client.update(client_uuid, client)
+    client_index.put_client(panel['name'], inbound_id, client)
+    logging.info("Подписка %s успешно продлена на панели %s.", email, panel['name'])
+
+async def _create_on_sub_panel(panel, email, tg_id, subscription_id, expiry_time, pool):
+    # Проверяем, не существует ли уже клиент с таким email
+    if await client_index.find_by_email(panel, email):
+        logging.info("Клиент %s уже существует на панели %s, пропускаем создание.", email, panel['name'])
+        return
+    new_client = Client(
+        id=str(uuid.uuid4()),
+        enable=True,
+        tg_id=tg_id,
+        expiry_time=expiry_time,
+        flow="xtls-rprx-vision",
+        email=email,
+        sub_id=subscription_id,
+        limit_ip=5
+    )
+    await add_client(panel, panel["inbound_id"], new_client, pool)
+    logging.info("Подписка успешно создана на панели %s для %s", panel['name'], email)
+
+async def create_subscription_on_panels(panel, inbound_id, client, pool):
+    """Создание клиента на основной панели, затем на всех SUB_PANELS одновременно.
+
+    Если основная панель не создала клиента, вызывающий код не выдаёт подписку, поэтому на SUB_PANELS
+    клиенты не создаются: иначе они остались бы без подписки. Возвращает {имя панели: успех}."""
+    action = f"Создание подписки {client.email}"
+    outcome = await _fan_out([(panel, add_client(panel, inbound_id, client, pool))], action)
+    if not outcome[panel["name"]]:
+        return outcome
+    outcome.update(await _fan_out(
+        [
+            (sub_panel, _create_on_sub_panel(sub_panel, client.email, client.tg_id, client.sub_id, client.expiry_time, pool))
+            for sub_panel in SUB_PANELS
+        ],
+        action
+    ))
+    return outcome
+
+async def extend_subscription_on_panels(panel_name, email, expiry_time, tg_id, subscription_id, pool):
+    """Продление клиента на основной панели и на всех SUB_PANELS одновременно до expiry_time (мс).
+
+    Срок абсолютный, поэтому повтор продления не добавляет дни второй раз. Возвращает {имя панели: успех}."""
+    directory = await get_directory_entries(email, pool)
+    panels = [get_panel_by_name(panel_name)] + SUB_PANELS
+    return await _fan_out(
+        [(panel, _extend_client(panel, email, expiry_time, tg_id, subscription_id, directory, pool)) for panel in panels],
+        f"Продление подписки {email}"
+    )
+
+
+async def disable_expired_clients(panel, emails):
+    """Отключение истёкших клиентов на одной панели.
+
+    Клиенты ищутся в снимке панели, запросы идут с ограниченной параллельностью. Клиент, который
+    на панели уже продлён, не трогается. Возвращает email, которые на панели больше не активны."""
+    snapshot = await client_index.get_snapshot(panel)
+    now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+    semaphore = asyncio.Semaphore(PANEL_BATCH_CONCURRENCY)
+    done = set()
+
+    async def disable(email):
+        entry = snapshot.by_email.get(email)
+        if not entry or not entry[1].enable:
+            done.add(email)
+            return
+        inbound_id, client = entry
+        if client.expiry_time <= 0 or client.expiry_time > now_ms:
+            return
+        client = client.model_copy(update={"enable": False, "inbound_id": inbound_id})
+        async with semaphore, inbound_lock(panel, inbound_id):
+            try:
+                await asyncio.wait_for(panel["api"].client.update(client.id, client), PANEL_DEADLINE)
+            except Exception as e:
+                logging.error(f"Ошибка при отключении {email} на панели {panel['name']}: {e}")
+                return
+        client_index.put_client(panel["name"], inbound_id, client)
+        done.add(email)
+
+    await asyncio.gather(*(disable(email) for email in emails))
+    logging.info(f"Отключено истёкших клиентов на панели {panel['name']}: {len(done)} из {len(emails)}")
+    return done